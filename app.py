@@ -58,6 +58,11 @@ def run():
         if channel_name == "wxy":
             os.environ["WECHATY_LOG"] = "warn"
 
+        # 指标接口与channel无关，配置端口后开启
+        if conf().get("metrics_port", 0):
+            from common import metrics
+            metrics.start_server(conf().get("metrics_port"), conf().get("metrics_host", "0.0.0.0"))
+
         start_channel(channel_name)
 
         while True:
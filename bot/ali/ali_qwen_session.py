@@ -28,9 +28,9 @@ class AliQwenSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                self.pop_message(1)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                self.pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -49,7 +49,7 @@ class AliQwenSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        return self.calc_tokens_incremental(num_tokens_from_messages)
 
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
@@ -1,6 +1,6 @@
 # encoding:utf-8
 
-import requests
+from common import http_client
 
 from bot.bot import Bot
 from bridge.reply import Reply, ReplyType
@@ -18,8 +18,8 @@ class BaiduUnitBot(Bot):
         )
         print(post_data)
         headers = {"content-type": "application/x-www-form-urlencoded"}
-        response = requests.post(url, data=post_data.encode(), headers=headers)
-        if response:
+        response = http_client.post(url, data=post_data.encode(), headers=headers)
+        if response.status_code == 200:
             reply = Reply(
                 ReplyType.TEXT,
                 response.json()["result"]["context"]["SYS_PRESUMED_HIST"][1],
@@ -30,7 +30,7 @@ class BaiduUnitBot(Bot):
         access_key = "YOUR_ACCESS_KEY"
         secret_key = "YOUR_SECRET_KEY"
         host = "https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id=" + access_key + "&client_secret=" + secret_key
-        response = requests.get(host)
-        if response:
+        response = http_client.get(host)
+        if response.status_code == 200:
             print(response.json())
             return response.json()["access_token"]
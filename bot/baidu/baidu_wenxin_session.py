@@ -28,8 +28,8 @@ class BaiduWenxinSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) >= 2:
-                self.messages.pop(0)
-                self.messages.pop(0)
+                self.pop_message(0)
+                self.pop_message(0)
             else:
                 logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
                 break
@@ -40,7 +40,7 @@ class BaiduWenxinSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        return self.calc_tokens_incremental(num_tokens_from_messages)
 
 
 def num_tokens_from_messages(messages, model):
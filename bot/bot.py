@@ -8,6 +8,9 @@ from bridge.reply import Reply
 
 
 class Bot(object):
+    # reply除了读写self.sessions中的会话外没有其他副作用(如自行向channel推送消息、在服务端保存对话)时才能参与对冲请求
+    hedgeable = True
+
     def reply(self, query, context: Context = None) -> Reply:
         """
         bot auto-reply content
@@ -15,3 +18,12 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def reply_async(self, query, context: Context = None) -> Reply:
+        """
+        asyncio引擎下的回复接口，默认将同步的reply卸载到线程中执行，
+        支持异步HTTP的bot可以覆盖此方法
+        """
+        from common.async_engine import AsyncEngine
+
+        return await AsyncEngine().run_blocking(self.reply, query, context)
@@ -2,6 +2,14 @@
 channel factory
 """
 from common import const
+from common.retry import RetryPolicy
+from config import conf
+
+# 各bot类型默认的重试策略，可通过配置retry_policies按bot类型覆盖，default对所有bot生效
+DEFAULT_RETRY_POLICIES = {
+    const.ZHIPU_AI: {"max_retries": 2, "base_delay": 2, "overload_delay": 5},
+    const.LINKAI: {"max_retries": 2, "base_delay": 2},
+}
 
 
 def create_bot(bot_type):
@@ -70,3 +78,16 @@ def create_bot(bot_type):
 
 
     raise RuntimeError
+
+
+def get_retry_policy(bot_type) -> RetryPolicy:
+    """
+    获取bot类型对应的重试策略，每次调用都读取配置，#更新配置 后立即生效
+    :param bot_type: bot type code
+    :return: RetryPolicy
+    """
+    policies = conf().get("retry_policies", {})
+    options = dict(DEFAULT_RETRY_POLICIES.get(bot_type, {}))
+    options.update(policies.get("default", {}))
+    options.update(policies.get(bot_type, {}))
+    return RetryPolicy(name=bot_type, **options)
@@ -4,7 +4,7 @@ import time
 
 import openai
 import openai.error
-import requests
+from common import http_client
 
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
@@ -12,6 +12,7 @@ from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.limiter import Limiter
 from common.log import logger
 from common.token_bucket import TokenBucket
 from config import conf, load_config
@@ -71,9 +72,9 @@ class ChatGPTBot(Bot, OpenAIImage):
             if model:
                 new_args = self.args.copy()
                 new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
+            if context.get("stream"):
+                # reply in stream
+                return Reply(ReplyType.STREAM, self.reply_text_stream(session, api_key, args=new_args))
 
             reply_content = self.reply_text(session, api_key, args=new_args)
             logger.debug(
@@ -106,6 +107,33 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    def reply_text_stream(self, session: ChatGPTSession, api_key=None, args=None):
+        """
+        流式调用ChatCompletion，逐个返回增量文本，输出完毕后将完整回复写入会话，出错时抛出异常
+        :param session: a conversation session
+        :return: 增量文本的迭代器
+        """
+        if args is None:
+            args = self.args
+        content = ""
+        try:
+            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, stream=True, **args)
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].get("delta", {}).get("content")
+                if delta:
+                    content += delta
+                    yield delta
+        except Exception as e:
+            logger.warn("[CHATGPT] stream failed: {}".format(e))
+            raise
+        logger.debug("[CHATGPT] stream reply={}".format(content))
+        if content:
+            self.sessions.session_reply(content, session.session_id)
+
     def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -121,6 +149,7 @@ class ChatGPTBot(Bot, OpenAIImage):
             if args is None:
                 args = self.args
             response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+            Limiter().report_tokens(response["usage"]["total_tokens"])
             # logger.debug("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
             return {
@@ -133,11 +162,13 @@ class ChatGPTBot(Bot, OpenAIImage):
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+                Limiter().report_overload()
                 result["content"] = "提问太快啦，请休息一下再问我吧"
                 if need_retry:
                     time.sleep(20)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[CHATGPT] Timeout: {}".format(e))
+                Limiter().report_overload()
                 result["content"] = "我没有收到你的消息"
                 if need_retry:
                     time.sleep(5)
@@ -183,13 +214,13 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 operation_location = submission.headers['operation-location']
                 status = ""
                 while (status != "succeeded"):
                     if retry_count > 3:
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url']
@@ -208,7 +239,7 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get("dalle3_image_quality", "standard")}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 image_url = submission.json()['data'][0]['url']
                 return True, image_url
             except Exception as e:
@@ -1,3 +1,5 @@
+import threading
+
 from bot.session_manager import Session
 from common.log import logger
 from common import const
@@ -29,9 +31,9 @@ class ChatGPTSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                self.pop_message(1)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                self.pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -50,48 +52,109 @@ class ChatGPTSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        return self.calc_tokens_incremental(num_tokens_from_messages)
 
 
-# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-def num_tokens_from_messages(messages, model):
-    """Returns the number of tokens used by a list of messages."""
+GPT35_ALIASES = ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]
+GPT4_ALIASES = ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+                "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
+                const.GPT_4o, const.LINKAI_4o, const.LINKAI_4_TURBO]
+CHARACTER_MODELS = ["wenxin", "xunfei", const.GEMINI]
+
+# 小于该条数时逐条encode，避免encode_batch为每次调用创建线程池的开销
+ENCODE_BATCH_THRESHOLD = 16
+
+
+class TokenEncoder(object):
+    def __init__(self, encoding, tokens_per_message, tokens_per_name):
+        self.encoding = encoding
+        self.tokens_per_message = tokens_per_message
+        self.tokens_per_name = tokens_per_name
+
+
+# model -> TokenEncoder，按字符计数的模型对应None
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+def _resolve_model(model):
+    if model in GPT35_ALIASES:
+        return "gpt-3.5-turbo"
+    elif model in GPT4_ALIASES:
+        return "gpt-4"
+    elif isinstance(model, str) and model.startswith("claude-3"):
+        return "gpt-3.5-turbo"
+    elif model in ["gpt-3.5-turbo", "gpt-4"]:
+        return model
+    logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+    return "gpt-3.5-turbo"
 
-    if model in ["wenxin", "xunfei", const.GEMINI]:
-        return num_tokens_by_character(messages)
 
-    import tiktoken
-
-    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
-                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
-                   "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
-                   const.GPT_4o, const.LINKAI_4o, const.LINKAI_4_TURBO]:
-        return num_tokens_from_messages(messages, model="gpt-4")
-    elif model.startswith("claude-3"):
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+def get_token_encoder(model):
+    """
+    解析model对应的编码方式并缓存，每个model只解析一次
+    :return: TokenEncoder，按字符计数的模型返回None
+    """
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return _encoders[model]
     except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
-        tokens_per_message = 3
-        tokens_per_name = 1
+        pass
+    with _encoders_lock:
+        if model in _encoders:
+            return _encoders[model]
+        if model in CHARACTER_MODELS:
+            encoder = None
+        else:
+            import tiktoken
+
+            base_model = _resolve_model(model)
+            try:
+                encoding = tiktoken.encoding_for_model(base_model)
+            except KeyError:
+                logger.debug("Warning: model not found. Using cl100k_base encoding.")
+                encoding = tiktoken.get_encoding("cl100k_base")
+            if base_model == "gpt-3.5-turbo":
+                # every message follows <|start|>{role/name}\n{content}<|end|>\n, if there's a name, the role is omitted
+                encoder = TokenEncoder(encoding, tokens_per_message=4, tokens_per_name=-1)
+            else:
+                encoder = TokenEncoder(encoding, tokens_per_message=3, tokens_per_name=1)
+        _encoders[model] = encoder
+        return encoder
+
+
+def count_message_tokens(messages, model):
+    """
+    批量计算每条消息的token数（不含回复引导的3个token），条数较多时使用encode_batch一次编码
+    :return: 与messages一一对应的token数列表
+    """
+    encoder = get_token_encoder(model)
+    if encoder is None:
+        return [len(msg["content"]) for msg in messages]
+    values = [value for message in messages for value in message.values()]
+    if len(values) >= ENCODE_BATCH_THRESHOLD:
+        lengths = [len(tokens) for tokens in encoder.encoding.encode_batch(values)]
     else:
-        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
+        lengths = [len(encoder.encoding.encode(value)) for value in values]
+    counts = []
+    i = 0
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+        num_tokens = encoder.tokens_per_message
+        for key in message:
+            num_tokens += lengths[i]
+            i += 1
             if key == "name":
-                num_tokens += tokens_per_name
+                num_tokens += encoder.tokens_per_name
+        counts.append(num_tokens)
+    return counts
+
+
+# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+def num_tokens_from_messages(messages, model):
+    """Returns the number of tokens used by a list of messages."""
+    if get_token_encoder(model) is None:
+        return num_tokens_by_character(messages)
+    num_tokens = sum(count_message_tokens(messages, model))
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
@@ -102,3 +165,4 @@ def num_tokens_by_character(messages):
     for msg in messages:
         tokens += len(msg["content"])
     return tokens
+
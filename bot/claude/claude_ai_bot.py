@@ -14,6 +14,9 @@ from config import conf
 
 
 class ClaudeAIBot(Bot, OpenAIImage):
+    # 对话保存在claude.ai服务端，落败的对冲请求无法撤回
+    hedgeable = False
+
     def __init__(self):
         super().__init__()
         self.sessions = SessionManager(ClaudeAiSession, model=conf().get("model") or "gpt-3.5-turbo")
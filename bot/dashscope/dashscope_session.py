@@ -5,6 +5,7 @@ from common.log import logger
 class DashscopeSession(Session):
     def __init__(self, session_id, system_prompt=None, model="qwen-turbo"):
         super().__init__(session_id)
+        self.model = model
         self.reset()
 
     def discard_exceeding(self, max_tokens, cur_tokens=None):
@@ -18,9 +19,9 @@ class DashscopeSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                self.pop_message(1)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                self.pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -40,10 +41,10 @@ class DashscopeSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages)
+        return self.calc_tokens_incremental(num_tokens_from_messages)
 
 
-def num_tokens_from_messages(messages):
+def num_tokens_from_messages(messages, model=None):
     # 只是大概，具体计算规则：https://help.aliyun.com/zh/dashscope/developer-reference/token-api?spm=a2c4g.11186623.0.0.4d8b12b0BkP3K9
     tokens = 0
     for msg in messages:
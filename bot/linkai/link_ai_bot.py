@@ -4,13 +4,16 @@
 import re
 import time
 import requests
+from common import const, http_client
 import config
 from bot.bot import Bot
+from bot.bot_factory import get_retry_policy
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry import RetryableError
 from config import conf, pconf
 import threading
 from common import memory, utils
@@ -21,6 +24,8 @@ class LinkAIBot(Bot):
     # authentication failed
     AUTH_FAILED_CODE = 401
     NO_QUOTA_CODE = 406
+    # 回复中的图片由后台线程直接发送给用户，落败的对冲请求也会推送
+    hedgeable = False
 
     def __init__(self):
         super().__init__()
@@ -44,137 +49,129 @@ class LinkAIBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def _chat(self, query, context, retry_count=0) -> Reply:
+    def _chat(self, query, context) -> Reply:
         """
-        发起对话请求
+        发起对话请求，失败时按linkai的重试策略退避重试
         :param query: 请求提示词
         :param context: 对话上下文
-        :param retry_count: 当前递归重试次数
         :return: 回复
         """
-        if retry_count > 2:
-            # exit from retry 2 times
+        try:
+            return get_retry_policy(const.LINKAI).call(self._chat_once, query, context)
+        except Exception as e:
+            logger.exception(e)
             logger.warn("[LINKAI] failed after maximum number of retry times")
-            return Reply(ReplyType.TEXT, "请再问我一次吧")
+            return Reply(ReplyType.ERROR, "请再问我一次吧")
 
+    def _chat_once(self, query, context) -> Reply:
+        # load config
+        if context.get("generate_breaked_by"):
+            logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
+            app_code = None
+        else:
+            plugin_app_code = self._find_group_mapping_code(context)
+            app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
+        linkai_api_key = conf().get("linkai_api_key")
+
+        session_id = context["session_id"]
+        session_message = self.sessions.session_msg_query(query, session_id)
+        logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
+
+        # image process
+        img_cache = memory.USER_IMAGE_CACHE.get(session_id)
+        if img_cache:
+            messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
+            if messages:
+                session_message = messages
+
+        model = conf().get("model")
+        # remove system message
+        if session_message[0].get("role") == "system":
+            if app_code or model == "wenxin":
+                session_message.pop(0)
+        body = {
+            "app_code": app_code,
+            "messages": session_message,
+            "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
+            "temperature": conf().get("temperature"),
+            "top_p": conf().get("top_p", 1),
+            "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "session_id": session_id,
+            "sender_id": session_id,
+            "channel_type": conf().get("channel_type", "wx")
+        }
         try:
-            # load config
-            if context.get("generate_breaked_by"):
-                logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
-                app_code = None
-            else:
-                plugin_app_code = self._find_group_mapping_code(context)
-                app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
-            linkai_api_key = conf().get("linkai_api_key")
-
-            session_id = context["session_id"]
-            session_message = self.sessions.session_msg_query(query, session_id)
-            logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
-
-            # image process
-            img_cache = memory.USER_IMAGE_CACHE.get(session_id)
-            if img_cache:
-                messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
-                if messages:
-                    session_message = messages
-
-            model = conf().get("model")
-            # remove system message
-            if session_message[0].get("role") == "system":
-                if app_code or model == "wenxin":
-                    session_message.pop(0)
-            body = {
-                "app_code": app_code,
-                "messages": session_message,
-                "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
-                "temperature": conf().get("temperature"),
-                "top_p": conf().get("top_p", 1),
-                "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "session_id": session_id,
-                "sender_id": session_id,
-                "channel_type": conf().get("channel_type", "wx")
-            }
-            try:
-                from linkai import LinkAIClient
-                client_id = LinkAIClient.fetch_client_id()
-                if client_id:
-                    body["client_id"] = client_id
-                    # start: client info deliver
-                    if context.kwargs.get("msg"):
-                        body["session_id"] = context.kwargs.get("msg").from_user_id
-                        if context.kwargs.get("msg").is_group:
-                            body["is_group"] = True
-                            body["group_name"] = context.kwargs.get("msg").from_user_nickname
-                            body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
+            from linkai import LinkAIClient
+            client_id = LinkAIClient.fetch_client_id()
+            if client_id:
+                body["client_id"] = client_id
+                # start: client info deliver
+                if context.kwargs.get("msg"):
+                    body["session_id"] = context.kwargs.get("msg").from_user_id
+                    if context.kwargs.get("msg").is_group:
+                        body["is_group"] = True
+                        body["group_name"] = context.kwargs.get("msg").from_user_nickname
+                        body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
+                    else:
+                        if body.get("channel_type") in ["wechatcom_app"]:
+                            body["sender_name"] = context.kwargs.get("msg").from_user_id
                         else:
-                            if body.get("channel_type") in ["wechatcom_app"]:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_id
-                            else:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_nickname
-
-            except Exception as e:
-                pass
-            file_id = context.kwargs.get("file_id")
-            if file_id:
-                body["file_id"] = file_id
-            logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
-            headers = {"Authorization": "Bearer " + linkai_api_key}
-
-            # do http request
-            base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
-            if res.status_code == 200:
-                # execute success
-                response = res.json()
-                reply_content = response["choices"][0]["message"]["content"]
-                total_tokens = response["usage"]["total_tokens"]
-                res_code = response.get('code')
-                logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
-                if res_code == 429:
-                    logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
-                else:
-                    self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
-                agent_suffix = self._fetch_agent_suffix(response)
-                if agent_suffix:
-                    reply_content += agent_suffix
-                if not agent_suffix:
-                    knowledge_suffix = self._fetch_knowledge_search_suffix(response)
-                    if knowledge_suffix:
-                        reply_content += knowledge_suffix
-                # image process
-                if response["choices"][0].get("img_urls"):
-                    thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
-                    thread.start()
-                    if response["choices"][0].get("text_content"):
-                        reply_content = response["choices"][0].get("text_content")
-                reply_content = self._process_url(reply_content)
-                return Reply(ReplyType.TEXT, reply_content)
+                            body["sender_name"] = context.kwargs.get("msg").from_user_nickname
 
+        except Exception as e:
+            pass
+        file_id = context.kwargs.get("file_id")
+        if file_id:
+            body["file_id"] = file_id
+        logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
+        headers = {"Authorization": "Bearer " + linkai_api_key}
+
+        # do http request
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+        res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+                            timeout=conf().get("request_timeout", 180))
+        if res.status_code == 200:
+            # execute success
+            response = res.json()
+            reply_content = response["choices"][0]["message"]["content"]
+            total_tokens = response["usage"]["total_tokens"]
+            res_code = response.get('code')
+            logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
+            if res_code == 429:
+                logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
+                return Reply(ReplyType.ERROR, reply_content)
             else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
-
-                error_reply = "提问太快啦，请休息一下再问我吧"
-                if res.status_code == 409:
-                    error_reply = "这个问题我还没有学会，请问我其它问题吧"
-                return Reply(ReplyType.TEXT, error_reply)
+                self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
+            agent_suffix = self._fetch_agent_suffix(response)
+            if agent_suffix:
+                reply_content += agent_suffix
+            if not agent_suffix:
+                knowledge_suffix = self._fetch_knowledge_search_suffix(response)
+                if knowledge_suffix:
+                    reply_content += knowledge_suffix
+            # image process
+            if response["choices"][0].get("img_urls"):
+                thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
+                thread.start()
+                if response["choices"][0].get("text_content"):
+                    reply_content = response["choices"][0].get("text_content")
+            reply_content = self._process_url(reply_content)
+            return Reply(ReplyType.TEXT, reply_content)
 
-        except Exception as e:
-            logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+        else:
+            if res.status_code >= 500:
+                # server error, need retry
+                raise RetryableError(f"chat failed, status_code={res.status_code}", status=res.status_code)
+            response = res.json()
+            error = response.get("error")
+            logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
+                         f"msg={error.get('message')}, type={error.get('type')}")
+
+            error_reply = "提问太快啦，请休息一下再问我吧"
+            if res.status_code == 409:
+                error_reply = "这个问题我还没有学会，请问我其它问题吧"
+            return Reply(ReplyType.ERROR, error_reply)
 
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
@@ -236,9 +233,11 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
 
-    def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0) -> dict:
-        if retry_count >= 2:
-            # exit from retry 2 times
+    def reply_text(self, session: ChatGPTSession, app_code="") -> dict:
+        try:
+            return get_retry_policy(const.LINKAI).call(self._reply_text_once, session, app_code)
+        except Exception as e:
+            logger.exception(e)
             logger.warn("[LINKAI] failed after maximum number of retry times")
             return {
                 "total_tokens": 0,
@@ -246,67 +245,57 @@ class LinkAIBot(Bot):
                 "content": "请再问我一次吧"
             }
 
-        try:
-            body = {
-                "app_code": app_code,
-                "messages": session.messages,
-                "model": conf().get("model") or "gpt-3.5-turbo",  # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
-                "temperature": conf().get("temperature"),
-                "top_p": conf().get("top_p", 1),
-                "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+    def _reply_text_once(self, session: ChatGPTSession, app_code="") -> dict:
+        body = {
+            "app_code": app_code,
+            "messages": session.messages,
+            "model": conf().get("model") or "gpt-3.5-turbo",  # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
+            "temperature": conf().get("temperature"),
+            "top_p": conf().get("top_p", 1),
+            "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+        }
+        if self.args.get("max_tokens"):
+            body["max_tokens"] = self.args.get("max_tokens")
+        headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
+
+        # do http request
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+        res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+                               timeout=conf().get("request_timeout", 180))
+        if res.status_code == 200:
+            # execute success
+            response = res.json()
+            reply_content = response["choices"][0]["message"]["content"]
+            total_tokens = response["usage"]["total_tokens"]
+            logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
+            return {
+                "total_tokens": total_tokens,
+                "completion_tokens": response["usage"]["completion_tokens"],
+                "content": reply_content,
             }
-            if self.args.get("max_tokens"):
-                body["max_tokens"] = self.args.get("max_tokens")
-            headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
-
-            # do http request
-            base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
-            if res.status_code == 200:
-                # execute success
-                response = res.json()
-                reply_content = response["choices"][0]["message"]["content"]
-                total_tokens = response["usage"]["total_tokens"]
-                logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
-                return {
-                    "total_tokens": total_tokens,
-                    "completion_tokens": response["usage"]["completion_tokens"],
-                    "content": reply_content,
-                }
 
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
-
-                return {
-                    "total_tokens": 0,
-                    "completion_tokens": 0,
-                    "content": "提问太快啦，请休息一下再问我吧"
-                }
+        else:
+            if res.status_code >= 500:
+                # server error, need retry
+                raise RetryableError(f"chat failed, status_code={res.status_code}", status=res.status_code)
+            response = res.json()
+            error = response.get("error")
+            logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
+                         f"msg={error.get('message')}, type={error.get('type')}")
 
-        except Exception as e:
-            logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self.reply_text(session, app_code, retry_count + 1)
+            return {
+                "total_tokens": 0,
+                "completion_tokens": 0,
+                "content": "提问太快啦，请休息一下再问我吧"
+            }
 
     def _fetch_app_info(self, app_code: str):
         headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http_client.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +316,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -429,7 +418,7 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
+        response = requests.get(url, timeout=(conf().get("http_connect_timeout", 5), conf().get("request_timeout", 180)))
         with open(file_path, "wb") as f:
             f.write(response.content)
         return file_path
@@ -448,12 +437,14 @@ class LinkAISessionManager(SessionManager):
         if query:
             session.add_query(query)
         session.add_reply(reply)
+        new_messages = session.messages[-2:] if query else session.messages[-1:]
         try:
             max_tokens = conf().get("conversation_max_tokens", 2500)
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
             logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_messages(session, new_messages)
         return session
 
 
@@ -15,15 +15,7 @@ class OpenAISession(Session):
               A: xxx
               Q: xxx
         """
-        prompt = ""
-        for item in self.messages:
-            if item["role"] == "system":
-                prompt += item["content"] + "<|endoftext|>\n\n\n"
-            elif item["role"] == "user":
-                prompt += "Q: " + item["content"] + "\n"
-            elif item["role"] == "assistant":
-                prompt += "\n\nA: " + item["content"] + "<|endoftext|>\n"
-
+        prompt = format_messages(self.messages)
         if len(self.messages) > 0 and self.messages[-1]["role"] == "user":
             prompt += "A: "
         return prompt
@@ -39,9 +31,9 @@ class OpenAISession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 1:
-                self.messages.pop(0)
+                self.pop_message(0)
             elif len(self.messages) == 1 and self.messages[0]["role"] == "assistant":
-                self.messages.pop(0)
+                self.pop_message(0)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -60,7 +52,27 @@ class OpenAISession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_string(str(self), self.model)
+        # 按条增量计数，结尾的"A: "单独计入，与整体编码str(self)相比仅在拼接边界处有微小误差
+        tokens = self.calc_tokens_incremental(num_tokens_from_messages)
+        if len(self.messages) > 0 and self.messages[-1]["role"] == "user":
+            tokens += num_tokens_from_string("A: ", self.model)
+        return tokens
+
+
+def format_messages(messages):
+    prompt = ""
+    for item in messages:
+        if item["role"] == "system":
+            prompt += item["content"] + "<|endoftext|>\n\n\n"
+        elif item["role"] == "user":
+            prompt += "Q: " + item["content"] + "\n"
+        elif item["role"] == "assistant":
+            prompt += "\n\nA: " + item["content"] + "<|endoftext|>\n"
+    return prompt
+
+
+def num_tokens_from_messages(messages, model):
+    return num_tokens_from_string(format_messages(messages), model)
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
@@ -1,32 +1,95 @@
+import threading
+
 from common.expired_dict import ExpiredDict
+from bot.session_store import get_session_store
+from common.knowledge_cache import KnowledgeCache
 from common.log import logger
 from config import conf
-from zhipuai import ZhipuAI
-import json
+
+# 渲染后的system prompt按(模板, 知识库版本)缓存，所有session共享同一个字符串对象
+_rendered_prompts = {}
+# system prompt的token数按(计数函数, 模型, prompt)缓存
+_prompt_tokens = {}
+_prompt_lock = threading.Lock()
+
+
+def render_system_prompt(template, knowledge):
+    key = (template, knowledge.version)
+    prompt = _rendered_prompts.get(key)
+    if prompt is None:
+        with _prompt_lock:
+            prompt = _rendered_prompts.get(key)
+            if prompt is None:
+                # 知识库版本变化后，丢弃同一模板的旧版本
+                for k in [k for k in _rendered_prompts if k[0] == template]:
+                    del _rendered_prompts[k]
+                prompt = template.format(file_content=knowledge.content)
+                _rendered_prompts[key] = prompt
+    return prompt
+
+
+def render_retrieval_prompt(template, query):
+    """
+    只把与问题最相关的知识库片段填入模板，每次提问都重新检索，不做缓存
+    """
+    from common.knowledge_index import KnowledgeIndex
+
+    chunks = KnowledgeIndex().search(query)
+    return template.format(file_content="\n\n".join(chunks))
+
+
+def base_tokens(model, count_func):
+    """
+    返回count_func对空消息列表的计数（如tiktoken回复引导的3个token），按(计数函数, 模型)缓存
+    """
+    key = (count_func, model, None)
+    tokens = _prompt_tokens.get(key)
+    if tokens is None:
+        tokens = count_func([], model)
+        _prompt_tokens[key] = tokens
+    return tokens
+
+
+def system_prompt_tokens(prompt, model, count_func):
+    """
+    返回system消息在count_func计数方式下所占的token数，每个(prompt, model)只计算一次
+    """
+    key = (count_func, model, prompt)
+    tokens = _prompt_tokens.get(key)
+    if tokens is None:
+        tokens = count_func([{"role": "system", "content": prompt}], model) - base_tokens(model, count_func)
+        with _prompt_lock:
+            if len(_prompt_tokens) >= 64:
+                _prompt_tokens.clear()
+            _prompt_tokens[key] = tokens
+    return tokens
+
 
 class Session(object):
 
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
-        file_content = self.get_file_content()
-        system_prompt = system_prompt_1.format(file_content=file_content)
+        knowledge = KnowledgeCache().get(conf().get("knowledge_file_id"))
+        system_prompt = render_system_prompt(system_prompt_1, knowledge)
         self.messages = []
+        # 每条消息的token数，与messages一一对应，只在消息首次出现时计算
+        self.token_counts = []
+        self.total_tokens = 0
+        self.counted_messages = None
+        self.counted_system = None
         if system_prompt is None:
             self.system_prompt = conf().get("character_desc", "")
         else:
             self.system_prompt = system_prompt
-    
+
     def get_file_content(self):
         '''
-        根据已上传的文件id获取文件内容。
+        根据已上传的文件id获取文件内容，内容由进程级缓存提供，不会每个session都重新拉取。
         word格式： 1732238678_b1c0653faead42538b5b98cca4b707c4
         md格式： 1736833122_c97254d492df4115b80ea72d4092d4e6
         '''
-        zhipu_ai_api_key = conf().get("zhipu_ai_api_key")
-        client = ZhipuAI(api_key=zhipu_ai_api_key)
-        file_content = json.loads(client.files.content(file_id='1736833122_c97254d492df4115b80ea72d4092d4e6').content)["content"]
-        return file_content
-    
+        return KnowledgeCache().get_content(conf().get("knowledge_file_id"))
+
     # 重置会话
     def reset(self):
         system_item = {"role": "system", "content": self.system_prompt}
@@ -36,6 +99,14 @@ class Session(object):
         self.system_prompt = system_prompt
         self.reset()
 
+    def replace_system_prompt(self, system_prompt):
+        """
+        替换system prompt，保留对话历史
+        """
+        self.system_prompt = system_prompt
+        if self.messages and self.messages[0].get("role") == "system":
+            self.messages[0] = {"role": "system", "content": system_prompt}
+
     def add_query(self, query):
         user_item = {"role": "user", "content": query}
         self.messages.append(user_item)
@@ -50,16 +121,53 @@ class Session(object):
     def calc_tokens(self):
         raise NotImplementedError
 
+    def calc_tokens_incremental(self, count_func):
+        """
+        增量计算token数，count_func为num_tokens_from_messages(messages, model)形式的计数函数
+        已计数的消息不会重新编码，system prompt使用进程级缓存
+        """
+        if self.counted_messages is not self.messages or len(self.token_counts) > len(self.messages):
+            # messages被整体替换(如reset)，重新计数
+            self.counted_messages = self.messages
+            self.token_counts = []
+            self.total_tokens = 0
+        if self.token_counts and self.messages[0].get("role") == "system" and self.counted_system is not self.messages[0]:
+            # system prompt被原地替换，只重新计算这一条
+            tokens = system_prompt_tokens(self.messages[0]["content"], self.model, count_func)
+            self.total_tokens += tokens - self.token_counts[0]
+            self.token_counts[0] = tokens
+            self.counted_system = self.messages[0]
+        for message in self.messages[len(self.token_counts):]:
+            if message.get("role") == "system":
+                tokens = system_prompt_tokens(message["content"], self.model, count_func)
+                self.counted_system = message
+            else:
+                tokens = count_func([message], self.model) - base_tokens(self.model, count_func)
+            self.token_counts.append(tokens)
+            self.total_tokens += tokens
+        return base_tokens(self.model, count_func) + self.total_tokens
+
+    def pop_message(self, index):
+        """
+        删除一条消息并同步扣减累计的token数
+        """
+        message = self.messages.pop(index)
+        if self.counted_messages is self.messages and index < len(self.token_counts):
+            self.total_tokens -= self.token_counts.pop(index)
+        return message
+
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
         if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
+            sessions = ExpiredDict(conf().get("expires_in_seconds"), max_size=conf().get("session_max_count", 0))
         else:
             sessions = dict()
         self.sessions = sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.store = get_session_store()
+        self.store_namespace = sessioncls.__name__
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -70,40 +178,108 @@ class SessionManager(object):
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
         if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+            session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            if self.store:  # 首次访问时从持久化存储中恢复历史消息
+                session.messages.extend(self.store.load(self.store_namespace, session_id))
+            self.sessions[session_id] = session
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
             self.sessions[session_id].set_system_prompt(system_prompt)
+            if self.store:
+                self.store.clear(self.store_namespace, session_id)
         session = self.sessions[session_id]
         return session
 
     def session_query(self, query, session_id):
         session = self.build_session(session_id)
+        if conf().get("knowledge_retrieval", False):
+            session.replace_system_prompt(render_retrieval_prompt(system_prompt_1, query))
         session.add_query(query)
+        new_messages = session.messages[-1:]
         try:
             max_tokens = conf().get("conversation_max_tokens", 1000)
             total_tokens = session.discard_exceeding(max_tokens, None)
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.save_messages(session, new_messages)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
         session = self.build_session(session_id)
         session.add_reply(reply)
+        new_messages = session.messages[-1:]
         try:
             max_tokens = conf().get("conversation_max_tokens", 1000)
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_messages(session, new_messages)
+        return session
+
+    def save_messages(self, session, new_messages):
+        """
+        将新增的消息追加写入持久化存储，并按裁剪后的会话长度截断存储中的旧消息
+        """
+        if not self.store or session.session_id is None:
+            return
+        try:
+            self.store.append(self.store_namespace, session.session_id, new_messages)
+            keep = len([m for m in session.messages if m.get("role") != "system"])
+            self.store.truncate(self.store_namespace, session.session_id, keep)
+        except Exception as e:
+            logger.warning("[SessionStore] save session failed, session_id={}, err={}".format(session.session_id, e))
+
+    def export_messages(self, session_id) -> list:
+        """
+        :return: 会话中的对话消息(不含system prompt)，用于切换bot时迁移上下文
+        """
+        if session_id not in self.sessions and not self.store:
+            return []
+        session = self.build_session(session_id)
+        return [dict(m) for m in session.messages if m.get("role") != "system"]
+
+    def has_history(self, session_id) -> bool:
+        """
+        :return: 会话中是否已有对话消息(不含system prompt)
+        """
+        if session_id not in self.sessions and not self.store:
+            return False
+        session = self.build_session(session_id)
+        return any(m.get("role") != "system" for m in session.messages)
+
+    def import_messages(self, session_id, messages: list):
+        """
+        用其他bot导出的对话消息替换当前会话的历史，保留本bot的system prompt
+        末尾没有回复的提问会被丢弃，由本bot重新加入
+        """
+        messages = list(messages)
+        while messages and messages[-1].get("role") == "user":
+            messages.pop()
+        session = self.build_session(session_id)
+        session.messages = [m for m in session.messages if m.get("role") == "system"] + [dict(m) for m in messages]
+        try:
+            session.discard_exceeding(conf().get("conversation_max_tokens", 1000), None)
+        except Exception as e:
+            logger.warning("Exception when counting tokens precisely for imported session: {}".format(str(e)))
+        if self.store:
+            try:
+                self.store.clear(self.store_namespace, session_id)
+                self.save_messages(session, [m for m in session.messages if m.get("role") != "system"])
+            except Exception as e:
+                logger.warning("[SessionStore] import session failed, session_id={}, err={}".format(session_id, e))
         return session
 
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        if self.store:
+            self.store.clear(self.store_namespace, session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        if self.store:
+            self.store.clear_all(self.store_namespace)
 
 system_prompt_1 = '''
 # 知识库
@@ -0,0 +1,216 @@
+"""
+会话历史的持久化存储，重启后会话上下文不丢失，多个进程可以共享同一份会话历史
+对话消息以追加方式写入，裁剪时只保留最新的若干条；会话在进程内首次访问时才从存储中加载
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class SessionStore(object):
+    def load(self, namespace, session_id) -> list:
+        """
+        加载会话的对话消息（不含system prompt），按时间顺序
+        """
+        raise NotImplementedError
+
+    def append(self, namespace, session_id, messages: list):
+        """
+        追加对话消息
+        """
+        raise NotImplementedError
+
+    def truncate(self, namespace, session_id, keep: int):
+        """
+        只保留最新的keep条消息
+        """
+        raise NotImplementedError
+
+    def clear(self, namespace, session_id):
+        raise NotImplementedError
+
+    def clear_all(self, namespace):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """
+    进程内存储，不跨进程也不落盘，用于测试或作为其他存储的替身
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def load(self, namespace, session_id) -> list:
+        with self.lock:
+            return [json.loads(item) for item in self.data.get((namespace, session_id), [])]
+
+    def append(self, namespace, session_id, messages: list):
+        with self.lock:
+            self.data.setdefault((namespace, session_id), []).extend(json.dumps(m, ensure_ascii=False) for m in messages)
+
+    def truncate(self, namespace, session_id, keep: int):
+        with self.lock:
+            items = self.data.get((namespace, session_id))
+            if items is not None and len(items) > keep:
+                del items[: len(items) - keep]
+
+    def clear(self, namespace, session_id):
+        with self.lock:
+            self.data.pop((namespace, session_id), None)
+
+    def clear_all(self, namespace):
+        with self.lock:
+            for key in [key for key in self.data if key[0] == namespace]:
+                del self.data[key]
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    本地SQLite存储，按session_id哈希分到多个数据库文件，降低写锁竞争
+    超过expires_in_seconds未更新的会话在加载时视为过期
+    """
+
+    def __init__(self, path, shards=4, expires_in_seconds=None):
+        os.makedirs(path, exist_ok=True)
+        self.paths = [os.path.join(path, "sessions_{}.db".format(i)) for i in range(shards)]
+        self.expires_in_seconds = expires_in_seconds
+        self.local = threading.local()
+        for i in range(shards):
+            db = self._db(i)
+            db.execute("CREATE TABLE IF NOT EXISTS turns (ns TEXT, session_id TEXT, seq INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_turns_session ON turns (ns, session_id, seq)")
+            db.execute("CREATE TABLE IF NOT EXISTS heads (ns TEXT, session_id TEXT, updated_at REAL, PRIMARY KEY (ns, session_id))")
+            db.commit()
+
+    def _db(self, shard):
+        # sqlite连接不能跨线程使用，每个线程每个分片一个连接
+        conns = getattr(self.local, "conns", None)
+        if conns is None:
+            conns = self.local.conns = {}
+        if shard not in conns:
+            conns[shard] = sqlite3.connect(self.paths[shard], timeout=10)
+            conns[shard].execute("PRAGMA journal_mode=WAL")
+        return conns[shard]
+
+    def _shard(self, session_id):
+        return int(hashlib.md5(str(session_id).encode("utf-8")).hexdigest(), 16) % len(self.paths)
+
+    def load(self, namespace, session_id) -> list:
+        db = self._db(self._shard(session_id))
+        row = db.execute("SELECT updated_at FROM heads WHERE ns=? AND session_id=?", (namespace, session_id)).fetchone()
+        if row is None:
+            return []
+        if self.expires_in_seconds and time.time() - row[0] > self.expires_in_seconds:
+            self.clear(namespace, session_id)
+            return []
+        rows = db.execute("SELECT message FROM turns WHERE ns=? AND session_id=? ORDER BY seq", (namespace, session_id)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def append(self, namespace, session_id, messages: list):
+        db = self._db(self._shard(session_id))
+        with db:
+            db.executemany(
+                "INSERT INTO turns (ns, session_id, message) VALUES (?, ?, ?)",
+                [(namespace, session_id, json.dumps(m, ensure_ascii=False)) for m in messages],
+            )
+            db.execute("INSERT OR REPLACE INTO heads (ns, session_id, updated_at) VALUES (?, ?, ?)", (namespace, session_id, time.time()))
+
+    def truncate(self, namespace, session_id, keep: int):
+        db = self._db(self._shard(session_id))
+        with db:
+            db.execute(
+                "DELETE FROM turns WHERE ns=? AND session_id=? AND seq NOT IN "
+                "(SELECT seq FROM turns WHERE ns=? AND session_id=? ORDER BY seq DESC LIMIT ?)",
+                (namespace, session_id, namespace, session_id, keep),
+            )
+
+    def clear(self, namespace, session_id):
+        db = self._db(self._shard(session_id))
+        with db:
+            db.execute("DELETE FROM turns WHERE ns=? AND session_id=?", (namespace, session_id))
+            db.execute("DELETE FROM heads WHERE ns=? AND session_id=?", (namespace, session_id))
+
+    def clear_all(self, namespace):
+        for i in range(len(self.paths)):
+            db = self._db(i)
+            with db:
+                db.execute("DELETE FROM turns WHERE ns=?", (namespace,))
+                db.execute("DELETE FROM heads WHERE ns=?", (namespace,))
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis协议存储，每个会话一个list，可被多个进程共享，key在expires_in_seconds后过期
+    """
+
+    def __init__(self, url, prefix="cow:session", expires_in_seconds=None):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.expires_in_seconds = expires_in_seconds
+
+    def _key(self, namespace, session_id):
+        return "{}:{}:{}".format(self.prefix, namespace, session_id)
+
+    def load(self, namespace, session_id) -> list:
+        return [json.loads(item) for item in self.client.lrange(self._key(namespace, session_id), 0, -1)]
+
+    def append(self, namespace, session_id, messages: list):
+        key = self._key(namespace, session_id)
+        pipe = self.client.pipeline()
+        pipe.rpush(key, *[json.dumps(m, ensure_ascii=False) for m in messages])
+        if self.expires_in_seconds:
+            pipe.expire(key, int(self.expires_in_seconds))
+        pipe.execute()
+
+    def truncate(self, namespace, session_id, keep: int):
+        key = self._key(namespace, session_id)
+        if keep <= 0:
+            self.client.delete(key)
+        else:
+            self.client.ltrim(key, -keep, -1)
+
+    def clear(self, namespace, session_id):
+        self.client.delete(self._key(namespace, session_id))
+
+    def clear_all(self, namespace):
+        keys = list(self.client.scan_iter(match=self._key(namespace, "*")))
+        if keys:
+            self.client.delete(*keys)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    根据配置session_store创建存储，未配置时返回None，会话只保存在内存中
+    """
+    global _store
+    store_type = conf().get("session_store", "")
+    if not store_type:
+        return None
+    with _store_lock:
+        if _store is None:
+            expires_in_seconds = conf().get("expires_in_seconds")
+            if store_type == "memory":
+                _store = MemorySessionStore()
+            elif store_type == "sqlite":
+                path = os.path.join(get_appdata_dir(), conf().get("session_store_path", "sessions"))
+                _store = SqliteSessionStore(path, conf().get("session_store_shards", 4), expires_in_seconds)
+            elif store_type == "redis":
+                _store = RedisSessionStore(conf().get("session_store_redis_url", "redis://localhost:6379/0"), expires_in_seconds=expires_in_seconds)
+            else:
+                raise RuntimeError("unknown session_store: {}".format(store_type))
+            logger.info("[SessionStore] use {} session store".format(store_type))
+        return _store
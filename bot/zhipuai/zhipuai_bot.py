@@ -1,16 +1,19 @@
 # encoding:utf-8
 
-import time
 import re
 import openai
-import openai.error
 from bot.bot import Bot
+from bot.bot_factory import get_retry_policy
 from bot.zhipuai.zhipu_ai_session import ZhipuAISession
 from bot.zhipuai.zhipu_ai_image import ZhipuAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import const
+from common.async_engine import AsyncEngine
+from common.limiter import Limiter
 from common.log import logger
+from common.retry import RetryableError, classify
 from config import conf, load_config
 from zhipuai import ZhipuAI
 import json
@@ -43,17 +46,7 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             logger.info("[ZHIPU_AI] query={}".format(query))
 
             session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply = self._handle_command(query, session_id)
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
@@ -65,28 +58,12 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             if model:
                 new_args = self.args.copy()
                 new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
+            if context.get("stream"):
+                # reply in stream
+                return Reply(ReplyType.STREAM, self.reply_text_stream(session, args=new_args))
 
             reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[ZHIPU_AI] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._build_text_reply(session, reply_content)
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
             reply = None
@@ -100,62 +77,147 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ZhipuAISession, api_key=None, args=None, retry_count=0) -> dict:
+    async def reply_async(self, query, context=None):
+        if context.type != ContextType.TEXT or context.get("stream") or AsyncEngine().http_session() is None:
+            return await super().reply_async(query, context)
+        logger.info("[ZHIPU_AI] async query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._handle_command(query, session_id)
+        if reply:
+            return reply
+        # 新建session时可能需要拉取知识库，放到线程中执行
+        session = await AsyncEngine().run_blocking(self.sessions.session_query, query, session_id)
+        logger.debug("[ZHIPU_AI] session query={}".format(session.messages))
+        args = self.args
+        model = context.get("gpt_model")
+        if model:
+            args = self.args.copy()
+            args["model"] = model
+        reply_content = await self.reply_text_async(session, args=args)
+        return self._build_text_reply(session, reply_content)
+
+    def _handle_command(self, query, session_id):
+        reply = None
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            reply = Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            reply = Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            reply = Reply(ReplyType.INFO, "配置已更新")
+        return reply
+
+    def _build_text_reply(self, session: ZhipuAISession, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        logger.debug(
+            "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[ZHIPU_AI] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    async def reply_text_async(self, session: ZhipuAISession, args=None) -> dict:
         """
-        call openai's ChatCompletion to get the answer
+        asyncio引擎下通过共享的aiohttp会话调用智谱AI接口，重试等待不占用线程
         :param session: a conversation session
-        :param session_id: session id
-        :param retry_count: retry count
         :return: {}
         """
+        if args is None:
+            args = self.args
         try:
-            # if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-            #     raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
-            if args is None:
-                args = self.args
-            # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            response = self.client.chat.completions.create(messages=session.messages, **args)
-            # print("xxxxxxxxxxxxxmessagesxxxxxxxxxxxxx")
-            # logger.debug("[ZHIPU_AI] response={}".format(response))
-            # logger.info("[ZHIPU_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+            return await get_retry_policy(const.ZHIPU_AI).call_async(self._request_async, session, args)
+        except Exception as e:
+            if classify(e) is None:
+                # 与reply_text一致，不可重试的错误可能由会话内容引起，清除会话
+                logger.exception("[ZHIPU_AI] Exception: {}".format(e))
+                await AsyncEngine().run_blocking(self.sessions.clear_session, session.session_id)
+            else:
+                logger.warn("[ZHIPU_AI] chat failed: {}".format(e))
+            return {"completion_tokens": 0, "content": "机器人故障，请稍后再试"}
 
+    async def _request_async(self, session: ZhipuAISession, args) -> dict:
+        url = conf().get("zhipu_ai_api_base", "https://open.bigmodel.cn/api/paas/v4").rstrip("/") + "/chat/completions"
+        headers = {"Content-Type": "application/json", "Authorization": "Bearer " + conf().get("zhipu_ai_api_key")}
+        body = dict(args)
+        body["messages"] = session.messages
+        async with AsyncEngine().http_session().post(url, headers=headers, json=body) as res:
+            response = await res.json(content_type=None)
+            if res.status != 200:
+                logger.warn("[ZHIPU_AI] chat failed, status_code={}, response={}".format(res.status, response))
+                if res.status == 429 or res.status >= 500:
+                    raise RetryableError("status_code={}".format(res.status), status=res.status)
+                raise Exception("status_code={}".format(res.status))
+            Limiter().report_tokens(response["usage"]["total_tokens"])
             return {
-                "total_tokens": response.usage.total_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "content": response.choices[0].message.content,
+                "total_tokens": response["usage"]["total_tokens"],
+                "completion_tokens": response["usage"]["completion_tokens"],
+                "content": response["choices"][0]["message"]["content"],
             }
+
+    def reply_text_stream(self, session: ZhipuAISession, args=None):
+        """
+        流式调用智谱AI接口，逐个返回增量文本，输出完毕后将完整回复写入会话，出错时抛出异常
+        :param session: a conversation session
+        :return: 增量文本的迭代器
+        """
+        if args is None:
+            args = self.args
+        content = ""
+        total_tokens = None
+        try:
+            response = self.client.chat.completions.create(messages=session.messages, stream=True, **args)
+            for chunk in response:
+                if getattr(chunk, "usage", None):
+                    total_tokens = chunk.usage.total_tokens
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content += chunk.choices[0].delta.content
+                    yield chunk.choices[0].delta.content
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "机器人故障，请稍后再试"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
-                result["content"] = "机器人故障，请稍后再试"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
-                result["content"] = "机器人故障，请稍后再试"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
-                result["content"] = "机器人故障，请稍后再试"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
-                result["content"] = "机器人故障，请稍后再试"
-                if need_retry:
-                    time.sleep(5)
-            else:
-                logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
-                need_retry = False
+            logger.warn("[ZHIPU_AI] stream failed: {}".format(e))
+            raise
+        logger.debug("[ZHIPU_AI] stream reply={}, total_tokens={}".format(content, total_tokens))
+        Limiter().report_tokens(total_tokens)
+        if content:
+            self.sessions.session_reply(content, session.session_id, total_tokens)
+
+    def reply_text(self, session: ZhipuAISession, api_key=None, args=None) -> dict:
+        """
+        call openai's ChatCompletion to get the answer
+        :param session: a conversation session
+        :return: {}
+        """
+        if args is None:
+            args = self.args
+        try:
+            return get_retry_policy(const.ZHIPU_AI).call(self._request, session, args)
+        except Exception as e:
+            if classify(e) is None:
+                logger.exception("[ZHIPU_AI] Exception: {}".format(e))
                 self.sessions.clear_session(session.session_id)
+            return {"completion_tokens": 0, "content": "机器人故障，请稍后再试"}
 
-            if need_retry:
-                logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
-                return result
+    def _request(self, session: ZhipuAISession, args) -> dict:
+        # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+        response = self.client.chat.completions.create(messages=session.messages, **args)
+        Limiter().report_tokens(response.usage.total_tokens)
+        # logger.debug("[ZHIPU_AI] response={}".format(response))
+        return {
+            "total_tokens": response.usage.total_tokens,
+            "completion_tokens": response.usage.completion_tokens,
+            "content": response.choices[0].message.content,
+        }
 
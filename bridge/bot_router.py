@@ -0,0 +1,128 @@
+"""
+多bot路由：根据每个bot最近的耗时和错误率，把请求发给最合适的健康bot，失败时自动切换到下一个
+连续失败的bot暂时熔断，冷却后放行请求试探是否恢复
+同一会话切换bot时，把上一个bot的对话历史迁移到新bot的会话中
+"""
+import threading
+import time
+
+from common.expired_dict import ExpiredDict
+from common.latency_stats import LatencyStats
+from common.log import logger
+from config import conf
+
+
+class BotHealth(object):
+    def __init__(self):
+        self.consecutive_failures = 0
+        self.open_until = 0.0  # 熔断结束时间
+        self.probing = False  # 熔断冷却后的试探阶段，再次失败立即重新熔断
+
+    def is_open(self, now) -> bool:
+        return now < self.open_until
+
+
+class BotRouter(object):
+    # 会话当前使用的bot得分不超过最优bot的该倍数时继续使用，避免会话在耗时相近的bot之间来回切换
+    SWITCH_RATIO = 1.2
+
+    def __init__(self, bot_types: list, latency: dict):
+        """
+        :param bot_types: 参与路由的bot类型，按优先级排列，没有耗时数据时按该顺序选择
+        :param latency: bot类型 -> LatencyStats，由Bridge在每次请求后记录
+        """
+        self.bot_types = list(bot_types)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.health = {bot_type: BotHealth() for bot_type in self.bot_types}
+        self.session_bots = ExpiredDict(conf().get("expires_in_seconds") or 3600, max_size=conf().get("session_max_count", 0))
+
+    def _score(self, bot_type) -> float:
+        stats = self.latency.get(bot_type)
+        if stats is None or len(stats.samples) < conf().get("router_min_samples", 5):
+            return 0.0  # 样本不足时优先尝试，尽快获得耗时数据
+        return stats.percentile(0.5) * (1 + 2 * stats.error_rate())
+
+    def _healthy(self, bot_type, now) -> bool:
+        return not self.health[bot_type].is_open(now)
+
+    def _degraded(self, bot_type, health: BotHealth) -> bool:
+        if health.probing or health.consecutive_failures >= conf().get("router_failure_threshold", 3):
+            return True
+        stats = self.latency.get(bot_type)
+        if stats is None or len(stats.outcomes) < conf().get("router_min_samples", 5):
+            return False
+        return stats.error_rate() > conf().get("router_max_error_rate", 0.5)
+
+    def select(self, session_id=None) -> list:
+        """
+        :return: 按优先级排列的bot类型，第一个为本次请求使用的bot，其余依次用于故障转移
+        """
+        now = time.time()
+        with self.lock:
+            healthy = [t for t in self.bot_types if self._healthy(t, now)]
+            unhealthy = [t for t in self.bot_types if t not in healthy]
+            scores = {t: self._score(t) for t in healthy}
+            healthy.sort(key=lambda t: scores[t])  # 稳定排序，得分相同时保持配置顺序
+            current = self.session_bots.get(session_id) if session_id else None
+            if current in scores and healthy[0] != current and scores[current] <= scores[healthy[0]] * self.SWITCH_RATIO:
+                healthy.remove(current)
+                healthy.insert(0, current)
+        # 全部不健康时仍按配置顺序尝试
+        return healthy + unhealthy
+
+    def record(self, bot_type, success: bool):
+        with self.lock:
+            health = self.health.get(bot_type)
+            if health is None:
+                return
+            if success:
+                health.consecutive_failures = 0
+                health.probing = False
+                return
+            health.consecutive_failures += 1
+            if self._degraded(bot_type, health):
+                cooldown = conf().get("router_cooldown", 30)
+                health.open_until = time.time() + cooldown
+                health.consecutive_failures = 0
+                health.probing = True
+                logger.warning("[BotRouter] bot {} degraded, skip it for {}s".format(bot_type, cooldown))
+
+    def session_bot(self, session_id):
+        """
+        :return: 会话最近使用的bot类型
+        """
+        with self.lock:
+            return self.session_bots.get(session_id)
+
+    def switch(self, session_id, bot_type, find_bot):
+        """
+        记录会话使用的bot，与上次使用的bot不同时迁移对话历史
+        :param find_bot: bot类型 -> bot实例
+        """
+        if not session_id:
+            return
+        with self.lock:
+            previous = self.session_bots.get(session_id)
+            self.session_bots[session_id] = bot_type
+        if previous is None or previous == bot_type:
+            return
+        try:
+            source = getattr(find_bot(previous), "sessions", None)
+            target = getattr(find_bot(bot_type), "sessions", None)
+            if source is None or target is None:
+                return
+            messages = source.export_messages(session_id)
+            target.import_messages(session_id, messages)
+            logger.info("[BotRouter] session {} switched from {} to {}, migrated {} messages".format(session_id, previous, bot_type, len(messages)))
+        except Exception as e:
+            logger.warning("[BotRouter] migrate session {} from {} to {} failed: {}".format(session_id, previous, bot_type, e))
+
+    def stats(self) -> dict:
+        now = time.time()
+        result = {}
+        with self.lock:
+            for bot_type in self.bot_types:
+                stats = self.latency.get(bot_type) or LatencyStats()
+                result[bot_type] = dict(stats.summary(), healthy=self._healthy(bot_type, now), score=self._score(bot_type))
+        return result
@@ -1,14 +1,55 @@
-from bot.bot_factory import create_bot
-from bridge.context import Context
-from bridge.reply import Reply
+import asyncio
+import concurrent.futures
+import contextvars
+import itertools
+import threading
+import time
+
+from bot.bot_factory import create_bot, get_retry_policy
+from bridge.bot_router import BotRouter
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from bridge.reply_cache import ReplyCache
 from common import const
+from common import metrics
+from common.async_engine import AsyncEngine
+from common.latency_stats import LatencyStats
+from common.limiter import Limiter
 from common.log import logger
+from common.retry import RetryPolicy, bind_deadline, classify, reset_deadline
 from common.singleton import singleton
 from config import conf
 from translate.factory import create_translator
 from voice.factory import create_voice
 
 
+BOT_REPLY_SECONDS = metrics.histogram("cow_bot_reply_seconds", "Time spent waiting for a chat bot reply", ["bot"])
+BOT_ERRORS = metrics.counter("cow_bot_errors_total", "Chat bot calls that raised or returned an error reply", ["bot"])
+VOICE_SECONDS = metrics.histogram("cow_voice_seconds", "Time spent in voice conversion", ["op", "engine"])
+
+_hedge_executor = None
+_hedge_lock = threading.Lock()
+_hedge_tasks = set()  # 对冲请求中落败但仍在执行的asyncio任务，保持引用避免被回收
+_hedge_seq = itertools.count()
+
+
+def _hedge_pool() -> concurrent.futures.ThreadPoolExecutor:
+    global _hedge_executor
+    with _hedge_lock:
+        if _hedge_executor is None:
+            _hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=conf().get("llm_max_inflight", 64), thread_name_prefix="hedge")
+        return _hedge_executor
+
+
+def _release_result(e: Exception):
+    """
+    bot抛出异常时如何调整并发窗口：只有限流、超时说明服务过载，已由重试策略上报过的不重复缩小
+    """
+    if classify(e) == "overload" and not getattr(e, "overload_reported", False):
+        return False
+    return None
+
+
 @singleton
 class Bridge(object):
     def __init__(self):
@@ -61,6 +102,12 @@ class Bridge(object):
 
         self.bots = {}
         self.chat_bots = {}
+        self.latency = {}  # bot类型 -> LatencyStats，用于计算对冲等待时间和路由选择
+        self.router = None
+        router_bots = conf().get("router_bots", [])
+        if len(router_bots) > 1:
+            self.btype["chat"] = router_bots[0]
+            self.router = BotRouter(router_bots, self.latency)
 
     # 模型对应的接口
     def get_bot(self, typename):
@@ -80,13 +127,288 @@ class Bridge(object):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        cache = ReplyCache()
+        if not self._reply_cache_enabled(cache, query, context):
+            return self._fetch_routed(query, context)
+        reply = cache.get(self.btype["chat"], query)
+        if reply:
+            self._record_reply(query, context, reply)
+            return reply
+        return cache.put(self.btype["chat"], query, self._fetch_routed(query, context))
+
+    async def fetch_reply_content_async(self, query, context: Context) -> Reply:
+        cache = ReplyCache()
+        if not self._reply_cache_enabled(cache, query, context):
+            return await self._fetch_routed_async(query, context)
+        reply = cache.get(self.btype["chat"], query)
+        if reply:
+            self._record_reply(query, context, reply)
+            return reply
+        return cache.put(self.btype["chat"], query, await self._fetch_routed_async(query, context))
+
+    # 配置了router_bots时按各bot最近的耗时和错误率选择，失败时依次切换到其他bot
+    def _fetch_routed(self, query, context: Context) -> Reply:
+        if self.router is None:
+            return self._fetch_hedged(query, context)
+        session_id = context.get("session_id") if context else None
+        candidates = self.router.select(session_id)
+        for i, bot_type in enumerate(candidates):
+            last = i == len(candidates) - 1
+            try:
+                self.router.switch(session_id, bot_type, self._chat_bot)
+                reply = self._fetch_limited(query, context, bot_type)
+            except Exception as e:
+                self.router.record(bot_type, False)
+                if last:
+                    raise
+                logger.warning("[Bridge] bot {} failed: {}, fail over to {}".format(bot_type, e, candidates[i + 1]))
+                continue
+            success = reply is not None and reply.type != ReplyType.ERROR
+            self.router.record(bot_type, success)
+            if success or last:
+                return reply
+            logger.warning("[Bridge] bot {} replied error, fail over to {}".format(bot_type, candidates[i + 1]))
+
+    async def _fetch_routed_async(self, query, context: Context) -> Reply:
+        if self.router is None:
+            return await self._fetch_hedged_async(query, context)
+        session_id = context.get("session_id") if context else None
+        candidates = self.router.select(session_id)
+        for i, bot_type in enumerate(candidates):
+            last = i == len(candidates) - 1
+            try:
+                # 迁移会话可能读写持久化存储，放到线程中执行
+                await AsyncEngine().run_blocking(self.router.switch, session_id, bot_type, self._chat_bot)
+                reply = await self._fetch_limited_async(query, context, bot_type)
+            except Exception as e:
+                self.router.record(bot_type, False)
+                if last:
+                    raise
+                logger.warning("[Bridge] bot {} failed: {}, fail over to {}".format(bot_type, e, candidates[i + 1]))
+                continue
+            success = reply is not None and reply.type != ReplyType.ERROR
+            self.router.record(bot_type, success)
+            if success or last:
+                return reply
+            logger.warning("[Bridge] bot {} replied error, fail over to {}".format(bot_type, candidates[i + 1]))
+
+    # 主bot超过等待时间未回复时同时请求备用bot，先成功返回的结果生效，慢的请求继续执行完并释放限流名额
+    # 两个请求都在复制了会话历史的临时会话中执行，只有生效的回答写回真实会话
+    def _fetch_hedged(self, query, context: Context) -> Reply:
+        policy = get_retry_policy(self.btype["chat"])
+        if not self._should_hedge(policy, query, context):
+            return self._fetch_limited(query, context)
+        history = self._session_manager(context).export_messages(context["session_id"])
+        futures = [_hedge_pool().submit(contextvars.copy_context().run, self._fetch_isolated, query, context, history, self.btype["chat"])]
+        done, _ = concurrent.futures.wait(futures, timeout=self._hedge_delay(policy, context))
+        if not done:
+            logger.info("[Bridge] {} reply slow, hedge request to {}".format(self.btype["chat"], policy.hedge_bot))
+            futures.append(_hedge_pool().submit(contextvars.copy_context().run, self._fetch_isolated, query, context, history, policy.hedge_bot))
+        reply, error = None, None
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if result and result.type != ReplyType.ERROR:
+                self._record_reply(query, context, result)
+                return result
+            reply = reply or result
+        if reply is None and error:
+            raise error
+        return reply
+
+    async def _fetch_hedged_async(self, query, context: Context) -> Reply:
+        policy = get_retry_policy(self.btype["chat"])
+        if not self._should_hedge(policy, query, context):
+            return await self._fetch_limited_async(query, context)
+        history = await AsyncEngine().run_blocking(self._session_manager(context).export_messages, context["session_id"])
+        tasks = [asyncio.ensure_future(self._fetch_isolated_async(query, context, history, self.btype["chat"]))]
+        done, _ = await asyncio.wait(tasks, timeout=self._hedge_delay(policy, context))
+        if not done:
+            logger.info("[Bridge] {} reply slow, hedge request to {}".format(self.btype["chat"], policy.hedge_bot))
+            tasks.append(asyncio.ensure_future(self._fetch_isolated_async(query, context, history, policy.hedge_bot)))
+        for task in tasks:
+            _hedge_tasks.add(task)
+            task.add_done_callback(_hedge_tasks.discard)
+        reply, error = None, None
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                result = await next_done
+            except Exception as e:
+                error = e
+                continue
+            if result and result.type != ReplyType.ERROR:
+                await AsyncEngine().run_blocking(self._record_reply, query, context, result)
+                return result
+            reply = reply or result
+        if reply is None and error:
+            raise error
+        return reply
+
+    def _should_hedge(self, policy: RetryPolicy, query, context: Context) -> bool:
+        # 流式回复已经开始输出，无法再切换到备用bot；#清除记忆等指令要作用于真实会话，不能对冲
+        if not policy.hedge_bot or policy.hedge_bot == self.btype["chat"] or context is None or context.type != ContextType.TEXT or context.get("stream"):
+            return False
+        if query.startswith("#"):
+            return False
+        # 只对冲没有会话以外副作用的bot，落败的请求才能完全丢弃
+        bots = (self.get_bot("chat"), self.find_chat_bot(policy.hedge_bot))
+        return all(bot.hedgeable and getattr(bot, "sessions", None) is not None for bot in bots)
+
+    def _isolated_context(self, bot_type, context: Context, history) -> Context:
+        isolated = Context(context.type, context.content, dict(context.kwargs))
+        isolated["session_id"] = "{}#hedge{}".format(context["session_id"], next(_hedge_seq))
+        self._chat_bot(bot_type).sessions.import_messages(isolated["session_id"], history)
+        return isolated
+
+    def _fetch_isolated(self, query, context: Context, history, bot_type) -> Reply:
+        isolated = self._isolated_context(bot_type, context, history)
+        try:
+            return self._fetch_limited(query, isolated, bot_type)
+        finally:
+            self._chat_bot(bot_type).sessions.clear_session(isolated["session_id"])
+
+    async def _fetch_isolated_async(self, query, context: Context, history, bot_type) -> Reply:
+        isolated = await AsyncEngine().run_blocking(self._isolated_context, bot_type, context, history)
+        try:
+            return await self._fetch_limited_async(query, isolated, bot_type)
+        finally:
+            await AsyncEngine().run_blocking(self._chat_bot(bot_type).sessions.clear_session, isolated["session_id"])
+
+    def _hedge_delay(self, policy: RetryPolicy, context: Context) -> float:
+        delay = policy.hedge_delay
+        if delay is None:
+            stats = self.latency.get(self.btype["chat"])
+            delay = max(policy.hedge_min_delay, stats.percentile(0.95) if stats else 0)
+        deadline = context.get("deadline")
+        if deadline:
+            # 留出备用bot的请求时间
+            delay = max(0, min(delay, deadline - time.time() - policy.min_attempt_time))
+        return delay
+
+    # 所有bot共用同一个限流器，按bot类型和api key限流
+    def _fetch_limited(self, query, context: Context, bot_type=None) -> Reply:
+        provider = bot_type or self.btype["chat"]
+        api_key = context.get("openai_api_key") if context else None
+        limiter = Limiter()
+        if not limiter.acquire(provider, api_key):
+            return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
+        token = limiter.bind(provider, api_key)
+        deadline_token = bind_deadline(context.get("deadline") if context else None)
+        start = time.time()
+        try:
+            reply = self._chat_bot(provider).reply(query, context)
+        except Exception as e:
+            limiter.release(provider, success=_release_result(e))
+            self._record_latency(provider, start, None)
+            raise
+        finally:
+            limiter.unbind(token)
+            reset_deadline(deadline_token)
+        self._record_latency(provider, start, reply)
+        return self._release_after_reply(provider, api_key, reply)
+
+    async def _fetch_limited_async(self, query, context: Context, bot_type=None) -> Reply:
+        provider = bot_type or self.btype["chat"]
+        api_key = context.get("openai_api_key") if context else None
+        limiter = Limiter()
+        if not await limiter.acquire_async(provider, api_key):
+            return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
+        token = limiter.bind(provider, api_key)
+        deadline_token = bind_deadline(context.get("deadline") if context else None)
+        start = time.time()
+        try:
+            reply = await self._chat_bot(provider).reply_async(query, context)
+        except asyncio.CancelledError:
+            limiter.release(provider)
+            raise
+        except Exception as e:
+            limiter.release(provider, success=_release_result(e))
+            self._record_latency(provider, start, None)
+            raise
+        finally:
+            limiter.unbind(token)
+            reset_deadline(deadline_token)
+        self._record_latency(provider, start, reply)
+        return self._release_after_reply(provider, api_key, reply)
+
+    def _chat_bot(self, bot_type):
+        if bot_type == self.btype["chat"]:
+            return self.get_bot("chat")
+        return self.find_chat_bot(bot_type)
+
+    def _record_latency(self, bot_type, start, reply: Reply):
+        if reply and reply.type == ReplyType.STREAM:  # 流式回复的耗时不代表完整回复的耗时
+            return
+        stats = self.latency.get(bot_type)
+        if stats is None:
+            stats = self.latency.setdefault(bot_type, LatencyStats(max_samples=conf().get("router_window", 100)))
+        cost = time.time() - start
+        error = reply is None or reply.type == ReplyType.ERROR
+        stats.record(cost, error=error)
+        BOT_REPLY_SECONDS.observe(cost, bot=bot_type)
+        if error:
+            BOT_ERRORS.inc(bot=bot_type)
+
+    def _release_after_reply(self, provider, api_key, reply: Reply) -> Reply:
+        if reply and reply.type == ReplyType.STREAM:  # 流式回复在输出完毕后才释放
+            reply.content = self._release_after_stream(provider, api_key, reply.content)
+        else:
+            Limiter().release(provider, success=True if reply and reply.type != ReplyType.ERROR else None)
+        return reply
+
+    def _release_after_stream(self, provider, api_key, deltas):
+        limiter = Limiter()
+        token = limiter.bind(provider, api_key)
+        success = None  # 提前关闭(GeneratorExit)时只释放名额，不调整窗口
+        try:
+            yield from deltas
+            success = True
+        except Exception as e:
+            success = _release_result(e)
+            raise
+        finally:
+            limiter.release(provider, success=success)
+            try:
+                limiter.unbind(token)
+            except ValueError:  # 在其他线程中被关闭
+                pass
+
+    def _session_manager(self, context: Context):
+        bot_type = self.router.session_bot(context["session_id"]) if self.router else None
+        return getattr(self._chat_bot(bot_type or self.btype["chat"]), "sessions", None)
+
+    def _reply_cache_enabled(self, cache: ReplyCache, query, context: Context) -> bool:
+        if not cache.enabled_for(query, context):
+            return False
+        # 已有对话历史时问题可能是追问，回答依赖上下文，不能复用其他会话的回答
+        sessions = self._session_manager(context)
+        try:
+            return sessions is None or not sessions.has_history(context["session_id"])
+        except Exception as e:
+            logger.warning("[Bridge] check session history failed: {}".format(e))
+            return False
+
+    def _record_reply(self, query, context: Context, reply: Reply):
+        # 命中缓存或对冲请求生效时，由Bridge把问答写入会话历史，保证后续追问有上下文
+        sessions = self._session_manager(context)
+        if sessions is None or reply.type != ReplyType.TEXT:
+            return
+        try:
+            sessions.session_query(query, context["session_id"])
+            sessions.session_reply(reply.content, context["session_id"])
+        except Exception as e:
+            logger.warning("[Bridge] record cached reply to session failed: {}".format(e))
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
-        return self.get_bot("voice_to_text").voiceToText(voiceFile)
+        with VOICE_SECONDS.time(op="voice_to_text", engine=self.btype["voice_to_text"]):
+            return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
     def fetch_text_to_voice(self, text) -> Reply:
-        return self.get_bot("text_to_voice").textToVoice(text)
+        with VOICE_SECONDS.time(op="text_to_voice", engine=self.btype["text_to_voice"]):
+            return self.get_bot("text_to_voice").textToVoice(text)
 
     def fetch_translate(self, text, from_lang="", to_lang="en") -> Reply:
         return self.get_bot("translate").translate(text, from_lang, to_lang)
@@ -101,3 +423,18 @@ class Bridge(object):
         重置bot路由
         """
         self.__init__()
+
+
+def _collect_router_metrics():
+    router = Bridge().router
+    if router is None:
+        return []
+    stats = router.stats()
+    return [
+        ("cow_router_healthy", "gauge", "Whether the router currently sends traffic to the bot", [({"bot": bot}, int(s["healthy"])) for bot, s in stats.items()]),
+        ("cow_router_error_rate", "gauge", "Recent error rate of the bot used by the router", [({"bot": bot}, s["error_rate"]) for bot, s in stats.items()]),
+        ("cow_router_p50_seconds", "gauge", "Recent p50 latency of the bot used by the router", [({"bot": bot}, s["p50"]) for bot, s in stats.items()]),
+    ]
+
+
+metrics.register_collector(_collect_router_metrics)
@@ -0,0 +1,212 @@
+"""
+回复缓存：相同或相近的问题直接返回之前的回答，不再请求LLM
+缓存key由bot类型、知识库版本和归一化后的问题组成，知识库更新后旧回答自然失效
+回答依赖上下文的问题不走缓存：会话中已有历史消息的追问，以及"好的"、"继续"这类过短的问题
+先按归一化问题精确匹配，未命中时用字符n-gram的MinHash + LSH找候选，再按Jaccard相似度确认
+"""
+import random
+import re
+import threading
+import unicodedata
+import zlib
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common import metrics
+from common.expired_dict import ExpiredDict
+from common.knowledge_cache import KnowledgeCache
+from common.log import logger
+from common.singleton import singleton
+from config import conf
+
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+_PRIME = (1 << 61) - 1
+_rand = random.Random(20240501)
+_PERMS = [(_rand.randrange(1, _PRIME), _rand.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+_PUNCTUATION = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize_query(query: str) -> str:
+    """
+    全角转半角、转小写，去掉空白和标点
+    """
+    query = unicodedata.normalize("NFKC", query).lower()
+    return _PUNCTUATION.sub("", query)
+
+
+def shingles(text: str, n=2) -> set:
+    if len(text) <= n:
+        return {text}
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+def minhash(grams: set) -> list:
+    hashes = [zlib.crc32(g.encode("utf-8")) for g in grams]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMS]
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class CacheEntry(object):
+    def __init__(self, scope, query, grams, signature, content):
+        self.scope = scope
+        self.query = query
+        self.grams = grams
+        self.signature = signature
+        self.content = content
+
+
+@singleton
+class ReplyCache(object):
+    def __init__(self):
+        self.lock = threading.RLock()  # 写入时淘汰旧条目会在持有锁时回调_on_evict
+        self.entries = ExpiredDict(conf().get("reply_cache_ttl", 3600), max_size=conf().get("reply_cache_max_size", 2000), on_evict=self._on_evict)
+        self.buckets = {}  # (scope, band, band_hash) -> set of entry key
+        self.bypass_sessions = set(conf().get("reply_cache_bypass_sessions", []))
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def set_bypass(self, session_id, bypass=True):
+        """
+        设置某个会话是否跳过回复缓存
+        """
+        with self.lock:
+            if bypass:
+                self.bypass_sessions.add(session_id)
+            else:
+                self.bypass_sessions.discard(session_id)
+
+    def enabled_for(self, query, context: Context) -> bool:
+        if not conf().get("reply_cache", False) or context is None or context.type != ContextType.TEXT:
+            return False
+        if not query or query.startswith("#") or context.get("no_reply_cache"):
+            return False
+        if len(normalize_query(query)) < conf().get("reply_cache_min_length", 4):
+            return False
+        return context.get("session_id") not in self.bypass_sessions
+
+    def get(self, scope, query) -> Reply:
+        """
+        :param scope: bot类型，不同bot的回答互不共用
+        :return: 命中时返回新的TEXT回复，未命中返回None
+        """
+        norm = normalize_query(query)
+        if not norm:
+            return None
+        scope = (scope, KnowledgeCache().peek_version())
+        entry = self.entries.get((scope, norm))
+        if entry is not None:
+            self._record("exact")
+            logger.info("[ReplyCache] exact hit, query={}".format(query))
+            return Reply(ReplyType.TEXT, entry.content)
+        entry, score = self._find_similar(scope, norm)
+        if entry is not None:
+            self._record("near")
+            logger.info("[ReplyCache] near hit, query={}, cached_query={}, similarity={:.2f}".format(query, entry.query, score))
+            return Reply(ReplyType.TEXT, entry.content)
+        self._record("miss")
+        return None
+
+    def put(self, scope, query, reply: Reply) -> Reply:
+        """
+        缓存文本回复，流式回复在输出完毕后缓存
+        :return: 原回复，流式回复的content会被包装
+        """
+        if reply is None or not reply.content:
+            return reply
+        if reply.type == ReplyType.STREAM:
+            reply.content = self._capture_stream(scope, query, reply.content)
+        elif reply.type == ReplyType.TEXT:
+            self._put(scope, query, reply.content)
+        return reply
+
+    def _capture_stream(self, scope, query, deltas):
+        content = ""
+        for delta in deltas:
+            content += delta
+            yield delta
+        self._put(scope, query, content)
+
+    def _put(self, scope, query, content):
+        norm = normalize_query(query)
+        if not norm or not content:
+            return
+        # 回答生成后知识库已加载，此时的版本号才是回答所依据的版本
+        scope = (scope, KnowledgeCache().peek_version())
+        grams = shingles(norm)
+        entry = CacheEntry(scope, query, grams, minhash(grams), content)
+        key = (scope, norm)
+        with self.lock:
+            self.entries[key] = entry
+            for band_key in self._band_keys(scope, entry.signature):
+                self.buckets.setdefault(band_key, set()).add(key)
+
+    def _find_similar(self, scope, norm):
+        threshold = conf().get("reply_cache_threshold", 0.8)
+        grams = shingles(norm)
+        signature = minhash(grams)
+        best, best_score = None, 0.0
+        with self.lock:
+            candidates = set()
+            for band_key in self._band_keys(scope, signature):
+                candidates |= self.buckets.get(band_key, set())
+        for key in candidates:
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            score = jaccard(grams, entry.grams)
+            if score >= threshold and score > best_score:
+                best, best_score = entry, score
+        return best, best_score
+
+    def _band_keys(self, scope, signature):
+        return [(scope, band, hash(tuple(signature[band * ROWS : (band + 1) * ROWS]))) for band in range(BANDS)]
+
+    def _on_evict(self, key, entry):
+        with self.lock:
+            for band_key in self._band_keys(entry.scope, entry.signature):
+                keys = self.buckets.get(band_key)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.buckets[band_key]
+
+    def _record(self, kind):
+        with self.lock:
+            if kind == "exact":
+                self.exact_hits += 1
+            elif kind == "near":
+                self.near_hits += 1
+            else:
+                self.misses += 1
+            total = self.exact_hits + self.near_hits + self.misses
+        if total % 100 == 0:
+            logger.info("[ReplyCache] stats={}".format(self.stats()))
+
+    def stats(self) -> dict:
+        total = self.exact_hits + self.near_hits + self.misses
+        return {
+            "size": len(self.entries),
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.near_hits) / total if total else 0.0,
+        }
+
+
+def _collect_metrics():
+    stats = ReplyCache().stats()
+    return [
+        ("cow_reply_cache_entries", "gauge", "Cached replies", [({}, stats["size"])]),
+        ("cow_reply_cache_lookups_total", "counter", "Reply cache lookups by result", [({"result": "exact"}, stats["exact_hits"]), ({"result": "near"}, stats["near_hits"]), ({"result": "miss"}, stats["misses"])]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
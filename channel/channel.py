@@ -34,9 +34,22 @@ class Channel(object):
         """
         raise NotImplementedError
 
+    def send_stream(self, reply: Reply, context: Context, handle=None, finished=False):
+        """
+        原地更新方式发送流式回复，支持编辑消息的渠道实现
+        :param reply: 文本回复，content为截至目前的完整文本
+        :param handle: 上一次调用返回的消息句柄，首次调用为None
+        :param finished: 是否为最后一次更新
+        :return: 消息句柄，用于后续更新同一条消息
+        """
+        raise NotImplementedError
+
     def build_reply_content(self, query, context: Context = None) -> Reply:
         return Bridge().fetch_reply_content(query, context)
 
+    async def build_reply_content_async(self, query, context: Context = None) -> Reply:
+        return await Bridge().fetch_reply_content_async(query, context)
+
     def build_voice_to_text(self, voice_file) -> Reply:
         return Bridge().fetch_voice_to_text(voice_file)
 
@@ -3,12 +3,18 @@ import re
 import threading
 import time
 from asyncio import CancelledError
+from collections import deque
 from concurrent.futures import Future, ThreadPoolExecutor
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.send_pipeline import SendPipeline
+from common.async_engine import AsyncEngine, is_async_engine
+from common.attachment_index import AttachmentIndex
 from common.dequeue import Dequeue
+from common import metrics
+from common.stream_chunker import iter_chunks
 from common import memory
 from plugins import *
 
@@ -19,6 +25,12 @@ except Exception as e:
 
 handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
 
+COMPOSE_SECONDS = metrics.histogram("cow_compose_context_seconds", "Time spent composing context from a received message")
+QUEUE_WAIT_SECONDS = metrics.histogram("cow_queue_wait_seconds", "Time a message waits in the session queue or for a handler", ["stage"])
+HANDLE_SECONDS = metrics.histogram("cow_handle_seconds", "Time from handler start to reply sent", ["type"])
+SEND_SECONDS = metrics.histogram("cow_send_seconds", "Time spent sending a reply", ["type"])
+SEND_ERRORS = metrics.counter("cow_send_errors_total", "Failed reply sends", ["type"])
+
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
 class ChatChannel(Channel):
@@ -27,13 +39,21 @@ class ChatChannel(Channel):
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
     lock = threading.Lock()  # 用于控制对sessions的访问
+    cond = threading.Condition(lock)  # 有session就绪时唤醒消费者线程
+    ready_queue = deque()  # 就绪队列，存放有待处理消息且有空闲并发额度的session_id
+    ready_session_ids = set()  # 已在就绪队列中的session_id，避免重复入队
+    merging = {}  # (session_id, 群成员id) -> [contexts, 首条到达时间, 截止时间]，合并窗口内连续发送的文本消息
+    image_index = AttachmentIndex("./images", conf().get("attachment_refresh_interval", 5))  # 回复中可引用的参考图片
+    file_index = AttachmentIndex("./files", conf().get("attachment_refresh_interval", 5))  # 回复中可引用的参考文档和视频
 
     def __init__(self):
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
+        self.send_pipeline = SendPipeline(self) if conf().get("send_pipeline", False) else None
 
     # 根据消息构造context，消息内容相关的触发项写在这里
+    @metrics.timed(COMPOSE_SECONDS)
     def _compose_context(self, ctype: ContextType, content, **kwargs):
         context = Context(ctype, content)
         context.kwargs = kwargs
@@ -160,6 +180,8 @@ class ChatChannel(Channel):
             context.content = content.strip()
             if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
+            if conf().get("stream_reply") and context.get("desire_rtype") != ReplyType.VOICE:
+                context["stream"] = True  # 支持流式输出的bot会返回ReplyType.STREAM
         elif context.type == ContextType.VOICE:
             if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
@@ -168,19 +190,64 @@ class ChatChannel(Channel):
     def _handle(self, context: Context):
         if context is None or not context.content:
             return
+        self._observe_handle_start(context)
         logger.debug("[chat_channel] ready to handle context: {}".format(context))
         # reply的构建步骤
         reply = self._generate_reply(context)
 
         logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
 
+        if reply and reply.type == ReplyType.STREAM:
+            self._send_stream_reply(context, reply)
         # reply的包装步骤
-        if reply and reply.content:
+        elif reply and reply.content:
             reply = self._decorate_reply(context, reply)
 
             # reply的发送步骤
             self._send_reply(context, reply)
 
+    # asyncio引擎下的处理流程，LLM请求以协程方式执行，插件和发送等阻塞步骤卸载到线程中
+    async def _handle_async(self, context: Context):
+        if context is None or not context.content:
+            return
+        self._observe_handle_start(context)
+        logger.debug("[chat_channel] ready to handle context async: {}".format(context))
+        engine = AsyncEngine()
+        reply = await self._generate_reply_async(context)
+
+        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+
+        if reply and reply.type == ReplyType.STREAM:
+            await engine.run_blocking(self._send_stream_reply, context, reply)
+        elif reply and reply.content:
+            reply = await engine.run_blocking(self._decorate_reply, context, reply)
+            await engine.run_blocking(self._send_reply, context, reply)
+
+    # 记录消息从分发到开始处理的等待时间，处理总耗时在任务结束回调中记录
+    def _observe_handle_start(self, context: Context):
+        now = time.monotonic()
+        if "dispatch_time" in context:
+            QUEUE_WAIT_SECONDS.observe(now - context["dispatch_time"], stage="worker")
+        context["handle_start_time"] = now
+
+    async def _generate_reply_async(self, context: Context, reply: Reply = Reply()) -> Reply:
+        engine = AsyncEngine()
+        if context.type != ContextType.TEXT and context.type != ContextType.IMAGE_CREATE:  # 语音、图片等消息仍走同步流程
+            return await engine.run_blocking(self._generate_reply, context, reply)
+        e_context = await engine.run_blocking(
+            PluginManager().emit_event,
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": reply},
+            ),
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
+            context["channel"] = e_context["channel"]
+            reply = await super().build_reply_content_async(context.content, context)
+        return reply
+
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
         e_context = PluginManager().emit_event(
             EventContext(
@@ -256,13 +323,7 @@ class ChatChannel(Channel):
                     if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                         reply = super().build_text_to_voice(reply.content)
                         return self._decorate_reply(context, reply)
-                    if context.get("isgroup", False):
-                        if not context.get("no_need_at", False):
-                            reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
-                        reply_text = conf().get("group_chat_reply_prefix", "") + reply_text + conf().get("group_chat_reply_suffix", "")
-                    else:
-                        reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
-                    reply.content = reply_text
+                    reply.content = self._wrap_reply_text(context, reply_text)
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
                 elif reply.type == ReplyType.IMAGE_URL or reply.type == ReplyType.VOICE or reply.type == ReplyType.IMAGE or reply.type == ReplyType.FILE or reply.type == ReplyType.VIDEO or reply.type == ReplyType.VIDEO_URL:
@@ -274,57 +335,165 @@ class ChatChannel(Channel):
                 logger.warning("[chat_channel] desire_rtype: {}, but reply type: {}".format(context.get("desire_rtype"), reply.type))
             return reply
 
+    # 给回复文本加上@和前后缀；流式回复只在第一个片段加@和前缀，最后一个片段加后缀
+    def _wrap_reply_text(self, context: Context, reply_text, first=True, last=True):
+        if context.get("isgroup", False):
+            if first and not context.get("no_need_at", False):
+                reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
+            prefix, suffix = conf().get("group_chat_reply_prefix", ""), conf().get("group_chat_reply_suffix", "")
+        else:
+            prefix, suffix = conf().get("single_chat_reply_prefix", ""), conf().get("single_chat_reply_suffix", "")
+        return (prefix if first else "") + reply_text + (suffix if last else "")
+
     def _send_reply(self, context: Context, reply: Reply):
         print('================================')
         print(reply.content)
-        if reply and reply.type:
-            e_context = PluginManager().emit_event(
-                EventContext(
-                    Event.ON_SEND_REPLY,
-                    {"channel": self, "context": context, "reply": reply},
-                )
+        reply = self._emit_send_reply(context, reply)
+        if reply:
+            self._deliver(context, reply)
+            self._send_attachments(context, reply.content)
+
+    # 触发ON_SEND_REPLY事件，返回插件处理后的回复，插件阻止发送时返回None
+    def _emit_send_reply(self, context: Context, reply: Reply):
+        if not reply or not reply.type:
+            return None
+        e_context = PluginManager().emit_event(
+            EventContext(
+                Event.ON_SEND_REPLY,
+                {"channel": self, "context": context, "reply": reply},
             )
-            reply = e_context["reply"]            
-            if not e_context.is_pass() and reply and reply.type:
-                logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
-                self._send(reply, context)
-                img_list = os.listdir('./images')
-                imgs = separate_text_and_images(img_list,reply.content)
-                if imgs:
-                    reply_img = reply
-                    context_img = context
-                    for img in imgs:
-                        img = f'./images/{img}'
-                        reply_img.type = ReplyType.IMAGE
-                        reply_img.content = img
-                        context_img.type = ReplyType.IMAGE
-                        self._send(reply_img, context_img)
-
-                file_list = os.listdir('./files')
-                files =  process_files(file_list,reply.content)
-                if files:
-                    for file in files:
-                        file = f'./files/{file}'
-                        if file.lower().endswith('.mp4'):
-                            # 如果是 MP4 文件，进行特殊处理
-                            reply.type = ReplyType.VIDEO  # 假设有一个 ReplyType.VIDEO 类型
-                            reply.content = file
-                        else:
-                            reply.type = ReplyType.FILE
-                            reply.content = file
-                        self._send(reply, context)
-                    
+        )
+        reply = e_context["reply"]
+        if e_context.is_pass() or not reply or not reply.type:
+            return None
+        logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
+        return reply
+
+    def _deliver(self, context: Context, reply: Reply):
+        if self.send_pipeline is not None:
+            # 接收者没有待发送的附件时直接发送，否则排在后面，保证顺序
+            self.send_pipeline.submit(reply, context, prepare=False, inline=True)
+        else:
+            self._send(reply, context)
+
+    # 发送回复文本中引用的参考图片和文档，开启发送流水线时并发准备、按顺序发送，不等待发送完成
+    def _send_attachments(self, context: Context, text):
+        attachments = [Reply(ReplyType.IMAGE, f'./images/{img}') for img in self.image_index.match(text)]
+        for file in self.file_index.match(text):
+            file = f'./files/{file}'
+            # 如果是 MP4 文件，作为视频发送
+            attachments.append(Reply(ReplyType.VIDEO if file.lower().endswith('.mp4') else ReplyType.FILE, file))
+        for attachment in attachments:
+            if self.send_pipeline is not None:
+                self.send_pipeline.submit(attachment, context)
+            else:
+                self._send(attachment, context)
+
+    # 流式回复的发送步骤：支持编辑消息的渠道原地更新同一条消息，其余渠道每凑够一句/一段就作为一条消息发送
+    # 两种方式都只对完整回复触发一次ON_SEND_REPLY、匹配一次附件：逐段发送时在第一个片段触发，插件阻止时整条回复都不发送
+    def _send_stream_reply(self, context: Context, reply: Reply):
+        chunks = iter_chunks(reply.content, conf().get("stream_chunk_mode", "paragraph"), conf().get("stream_min_chars", 20))
+        text = ""
+        handle = None
+        editable = True
+        edit_failed = False
+        pending = None  # 逐段发送时暂缓一个片段，流结束后才知道哪个是最后一段
+        first = True
+        try:
+            for chunk in chunks:
+                text += chunk
+                if editable:
+                    if edit_failed:
+                        continue
+                    try:
+                        handle = self._update_stream_reply(context, text, handle, False)
+                        continue
+                    except NotImplementedError:
+                        editable = False
+                        chunk = text
+                    except Exception as e:
+                        logger.error("[chat_channel] update stream reply failed, send full text when finished: {}".format(e))
+                        edit_failed = True
+                        continue
+                if not chunk.strip():
+                    continue
+                if pending is not None:
+                    if not self._send_stream_chunk(context, pending, first, False):
+                        return
+                    first = False
+                pending = chunk
+        except Exception as e:
+            logger.error("[chat_channel] stream reply interrupted: {}".format(e))
+            if not text.strip():
+                self._send_reply(context, self._decorate_reply(context, Reply(ReplyType.ERROR, "机器人故障，请稍后再试")))
+                return
+        if not text.strip():
+            return
+        if not editable:
+            if pending is not None and not self._send_stream_chunk(context, pending, first, True):
+                return
+        elif not edit_failed:
+            if not self._finish_stream_reply(context, text, handle):
+                return
+        else:
+            # 编辑消息失败，把完整回复作为普通消息发送
+            self._send_reply(context, self._decorate_reply(context, Reply(ReplyType.TEXT, text.strip())))
+            return
+        self._send_attachments(context, text)
+
+    # 逐段发送一个片段，不再经过装饰插件和附件匹配；返回False表示插件阻止了这条回复
+    def _send_stream_chunk(self, context: Context, chunk, first, last) -> bool:
+        reply = Reply(ReplyType.TEXT, self._wrap_reply_text(context, chunk.strip(), first, last))
+        if first:
+            reply = self._emit_send_reply(context, reply)
+            if reply is None:
+                return False
+        self._deliver(context, reply)
+        return True
+
+    def _update_stream_reply(self, context: Context, text, handle, finished):
+        reply = self._decorate_reply(context, Reply(ReplyType.TEXT, text.strip()))
+        if not reply or reply.type != ReplyType.TEXT:
+            return handle
+        return self.send_stream(reply, context, handle, finished)
+
+    # 以完整回复结束可编辑的流式消息并触发ON_SEND_REPLY，插件阻止发送时返回False
+    def _finish_stream_reply(self, context: Context, text, handle) -> bool:
+        reply = self._decorate_reply(context, Reply(ReplyType.TEXT, text.strip()))
+        if not reply or reply.type != ReplyType.TEXT:
+            return True
+        reply = self._emit_send_reply(context, reply)
+        if reply is None:
+            return False
+        try:
+            self.send_stream(reply, context, handle, True)
+        except Exception as e:
+            logger.error("[chat_channel] finish stream reply failed, send full text instead: {}".format(e))
+            self._deliver(context, reply)
+        return True
+
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
+        if self._send_once(reply, context) and retry_cnt < 2:
+            time.sleep(3 + 3 * retry_cnt)
+            self._send(reply, context, retry_cnt + 1)
+
+    # 发送一次，返回是否需要重试
+    def _send_once(self, reply: Reply, context: Context) -> bool:
         try:
-            self.send(reply, context)
+            with SEND_SECONDS.time(type=reply.type.name):
+                self.send(reply, context)
+            return False
         except Exception as e:
             logger.error("[chat_channel] sendMsg error: {}".format(str(e)))
             if isinstance(e, NotImplementedError):
-                return
+                return False
+            SEND_ERRORS.inc(type=reply.type.name)
             logger.exception(e)
-            if retry_cnt < 2:
-                time.sleep(3 + 3 * retry_cnt)
-                self._send(reply, context, retry_cnt + 1)
+            return True
+
+    # 发送前的准备工作(上传素材、压缩、格式转换等)，在发送流水线中与其他回复并发执行，由具体渠道实现，发送时复用准备的结果
+    def prepare_reply(self, reply: Reply, context: Context):
+        pass
 
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         logger.debug("Worker return success, session_id = {}".format(session_id))
@@ -344,68 +513,164 @@ class ChatChannel(Channel):
                 logger.info("Worker cancelled, session_id = {}".format(session_id))
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
-            with self.lock:
-                self.sessions[session_id][1].release()
+            context = kwargs.get("context")
+            if context is not None and "handle_start_time" in context:
+                HANDLE_SECONDS.observe(time.monotonic() - context["handle_start_time"], type=context.type.name)
+            with self.cond:
+                if session_id not in self.sessions:
+                    return
+                context_queue, semaphore = self.sessions[session_id]
+                semaphore.release()
+                if context_queue.empty() and semaphore._initial_value == semaphore._value:  # 所有任务都处理完毕，回收session
+                    self.futures.pop(session_id, None)
+                    self.ready_session_ids.discard(session_id)
+                    del self.sessions[session_id]
+                else:
+                    self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+                    self._schedule(session_id)
 
         return func
 
+    # 调用方需持有lock。session同时满足有待处理的消息和有空闲的并发额度时，放入就绪队列并唤醒消费者
+    def _schedule(self, session_id):
+        if session_id in self.ready_session_ids:
+            return
+        context_queue, semaphore = self.sessions[session_id]
+        if semaphore._value > 0 and not context_queue.empty():
+            self.ready_session_ids.add(session_id)
+            self.ready_queue.append(session_id)
+            self.cond.notify()
+
     def produce(self, context: Context):
         session_id = context["session_id"]
-        with self.lock:
-            if session_id not in self.sessions:
-                self.sessions[session_id] = [
-                    Dequeue(),
-                    threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
-                ]
+        merge_window = conf().get("message_merge_window", 0)
+        with self.cond:
+            self._ensure_session(session_id)
+            context["enqueue_time"] = time.monotonic()
             if context.type == ContextType.TEXT and context.content.startswith("#"):
                 self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+            elif context.type == ContextType.TEXT and merge_window > 0:
+                # 窗口内没有新消息才分发，每来一条消息顺延窗口，但总等待不超过message_merge_max_wait
+                now = time.monotonic()
+                merging = self.merging.setdefault(self._merge_key(context), [[], now, now])
+                merging[0].append(context)
+                merging[2] = min(now + merge_window, merging[1] + conf().get("message_merge_max_wait", 10))
+                self.cond.notify()
+                return
             else:
+                self._flush_session_merging(session_id)  # 先分发之前的文本消息，保持顺序
                 self.sessions[session_id][0].put(context)
-
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+            self._schedule(session_id)
+
+    # 调用方需持有lock
+    def _ensure_session(self, session_id):
+        if session_id not in self.sessions:
+            self.sessions[session_id] = [
+                Dequeue(),
+                threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
+            ]
+
+    # 群聊共享会话时不同成员的消息分别合并，只合并同一个人连续发送的消息
+    @staticmethod
+    def _merge_key(context: Context):
+        member = context["msg"].actual_user_id if context.get("isgroup", False) and context.get("msg") else None
+        return context["session_id"], member
+
+    # 调用方需持有lock。分发session中所有等待合并的消息，merging按首条消息到达的顺序插入，遍历顺序即到达顺序
+    def _flush_session_merging(self, session_id):
+        for key in [key for key in self.merging if key[0] == session_id]:
+            self._flush_merging(key)
+
+    # 调用方需持有lock。把合并窗口内的文本消息合并成一条放入session的消息队列
+    def _flush_merging(self, key):
+        merging = self.merging.pop(key, None)
+        if not merging:
+            return
+        session_id = key[0]
+        self._ensure_session(session_id)  # 等待期间空闲的session可能已被回收
+        contexts = merging[0]
+        context = contexts[-1]  # 以最后一条消息为准回复
+        if len(contexts) > 1:
+            context.content = "\n".join(c.content for c in contexts)
+            logger.info("[chat_channel] merge {} messages in session {}".format(len(contexts), session_id))
+        context["enqueue_time"] = time.monotonic()  # 合并等待不计入排队时间
+        self.sessions[session_id][0].put(context)
+        self._schedule(session_id)
+
+    # 调用方需持有lock。分发合并窗口已到期的session，返回距离下一个窗口到期的秒数，没有等待中的窗口时返回None
+    def _flush_due_merging(self):
+        now = time.monotonic()
+        timeout = None
+        for key, merging in list(self.merging.items()):
+            if merging[2] <= now:
+                self._flush_merging(key)
+            elif timeout is None or merging[2] - now < timeout:
+                timeout = merging[2] - now
+        return timeout
+
+    # 消费者函数，单独线程，由produce和任务结束回调唤醒，每次从就绪队列中取出一个session分发一条消息
     def consume(self):
         while True:
-            with self.lock:
-                session_ids = list(self.sessions.keys())
-                for session_id in session_ids:
-                    context_queue, semaphore = self.sessions[session_id]
-                    if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                        if not context_queue.empty():
-                            context = context_queue.get()
-                            logger.debug("[chat_channel] consume context: {}".format(context))
-                            future: Future = handler_pool.submit(self._handle, context)
-                            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                        elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                        else:
-                            semaphore.release()
-            time.sleep(0.1)
+            with self.cond:
+                while True:
+                    timeout = self._flush_due_merging()
+                    if self.ready_queue:
+                        break
+                    self.cond.wait(timeout)
+                session_id = self.ready_queue.popleft()
+                self.ready_session_ids.discard(session_id)
+                if session_id not in self.sessions:
+                    continue
+                context_queue, semaphore = self.sessions[session_id]
+                if context_queue.empty() or not semaphore.acquire(blocking=False):  # 消息已被取消或并发额度已用完
+                    continue
+                context = context_queue.get()
+                logger.debug("[chat_channel] consume context: {}".format(context))
+                context["dispatch_time"] = time.monotonic()
+                if "enqueue_time" in context:
+                    QUEUE_WAIT_SECONDS.observe(context["dispatch_time"] - context["enqueue_time"], stage="session")
+                if is_async_engine():
+                    future: Future = AsyncEngine().submit(self._handle_async(context))
+                else:
+                    future: Future = handler_pool.submit(self._handle, context)
+                self.futures.setdefault(session_id, []).append(future)
+                self._schedule(session_id)
+            # 回调可能在当前线程同步执行，需在释放lock后注册
+            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
-        with self.lock:
-            if session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+        with self.cond:
+            if session_id not in self.sessions:
+                return
+            futures = list(self.futures.get(session_id, []))
+            for key in [key for key in self.merging if key[0] == session_id]:
+                del self.merging[key]
+            cnt = self.sessions[session_id][0].qsize()
+            if cnt > 0:
+                logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+            self.sessions[session_id][0] = Dequeue()
+        # future.cancel()会同步触发回调，回调中需要获取lock
+        for future in futures:
+            future.cancel()
 
     def cancel_all_session(self):
-        with self.lock:
+        futures = []
+        with self.cond:
+            self.merging.clear()
             for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
+                futures.extend(self.futures.get(session_id, []))
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
                 self.sessions[session_id][0] = Dequeue()
+        for future in futures:
+            future.cancel()
+
+
+metrics.gauge("cow_active_sessions", "Sessions with queued or running messages", func=lambda: len(ChatChannel.sessions))
+metrics.gauge("cow_queued_messages", "Messages waiting in session queues", func=lambda: sum(s[0].qsize() for s in list(ChatChannel.sessions.values())))
+metrics.gauge("cow_merging_sessions", "Sessions waiting for the message merge window", func=lambda: len(ChatChannel.merging))
 
 
 def check_prefix(content, prefix_list):
@@ -424,20 +689,3 @@ def check_contain(content, keyword_list):
         if content.find(ky) != -1:
             return ky
     return None
-
-def separate_text_and_images(img_list,text):
-    imgs = []
-    # 遍历文件名列表
-    for img in img_list:
-        if img in text:
-            imgs.append(img)
-    return imgs
-
-def process_files(file_list, text):
-    files = []
-    # 遍历文件名列表
-    for filename in file_list:
-        if filename in text:
-            files.append(filename)
-    return files
-        
@@ -199,6 +199,21 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
         else:
             self.reply_text(reply.content, incoming_message)
 
+    def send_stream(self, reply: Reply, context: Context, handle=None, finished=False):
+        # 开启卡片时以AI卡片流式更新，否则按片段逐条发送
+        if not conf().get("dingtalk_card_enabled"):
+            raise NotImplementedError
+        incoming_message = context.kwargs['msg'].incoming_message
+        if handle is None:
+            handle = self.ai_markdown_card_start(incoming_message, "", "📌 内容由AI生成")
+        if finished:
+            handle.ai_finish(markdown=reply.content)
+            if context.kwargs['msg'].is_group:
+                self.reply_text("📢 您有一条新的消息，请查看。", incoming_message)
+        else:
+            handle.ai_streaming(markdown=reply.content, append=False)
+        return handle
+
 
     def generate_button_markdown_content(self, context, reply):
         image_url = context.kwargs.get("image_url")
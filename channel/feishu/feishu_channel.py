@@ -9,7 +9,6 @@
 import uuid
 
 import requests
-import web
 from channel.feishu.feishu_message import FeishuMessage
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
@@ -18,12 +17,17 @@ from common.singleton import singleton
 from config import conf
 from common.expired_dict import ExpiredDict
 from bridge.context import ContextType
-from channel.chat_channel import ChatChannel, check_prefix
-from common import utils
+from channel.chat_channel import COMPOSE_SECONDS, ChatChannel, check_prefix
+from channel import webhook
+from channel.webhook import WebhookRequest
+from common import metrics, utils
+from common.access_token import AccessTokenManager
 import json
 import os
 
 URL_VERIFICATION = "url_verification"
+# tenant_access_token无效或已过期
+INVALID_TOKEN_CODES = (99991661, 99991663)
 
 
 @singleton
@@ -36,6 +40,7 @@ class FeiShuChanel(ChatChannel):
         super().__init__()
         # 历史消息id暂存，用于幂等控制
         self.receivedMsgs = ExpiredDict(60 * 60 * 7.1)
+        self.token_manager = AccessTokenManager("feishu", self._request_access_token)
         logger.info("[FeiShu] app_id={}, app_secret={} verification_token={}".format(
             self.feishu_app_id, self.feishu_app_secret, self.feishu_token))
         # 无需群校验和前缀
@@ -43,20 +48,47 @@ class FeiShuChanel(ChatChannel):
         conf()["single_chat_prefix"] = [""]
 
     def startup(self):
-        urls = (
-            '/', 'channel.feishu.feishu_channel.FeishuController'
+        routes = (
+            ('/', 'channel.feishu.feishu_channel.FeishuController'),
         )
-        app = web.application(urls, globals(), autoreload=False)
-        port = conf().get("feishu_port", 9891)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        webhook.serve("FeiShu", routes, conf().get("feishu_port", 9891))
+
+    def _access_token(self, context: Context) -> str:
+        # 使用缓存的token，不再沿用收到消息时的token，避免处理耗时较长时token已过期
+        return self.fetch_access_token()
 
     def send(self, reply: Reply, context: Context):
+        self._send_message(reply, context)
+
+    def send_stream(self, reply: Reply, context: Context, handle=None, finished=False):
+        # 首次发送文本消息，之后通过编辑消息接口原地更新
+        if handle is None:
+            res = self._send_message(reply, context)
+            message_id = (res.get("data") or {}).get("message_id")
+            if not message_id:
+                raise Exception("[FeiShu] send stream message failed, res={}".format(res))
+            return {"message_id": message_id, "text": reply.content}
+        if handle["text"] == reply.content:
+            return handle
+        url = f"https://open.feishu.cn/open-apis/im/v1/messages/{handle['message_id']}"
+        headers = {
+            "Authorization": "Bearer " + self._access_token(context),
+            "Content-Type": "application/json",
+        }
+        data = {
+            "msg_type": "text",
+            "content": json.dumps({"text": reply.content})
+        }
+        res = requests.put(url=url, headers=headers, json=data, timeout=(5, 10)).json()
+        if res.get("code") != 0:
+            raise Exception(f"[FeiShu] update message failed, code={res.get('code')}, msg={res.get('msg')}")
+        handle["text"] = reply.content
+        return handle
+
+    def _send_message(self, reply: Reply, context: Context) -> dict:
         msg = context.get("msg")
         is_group = context["isgroup"]
-        if msg:
-            access_token = msg.access_token
-        else:
-            access_token = self.fetch_access_token()
+        access_token = self._access_token(context)
         headers = {
             "Authorization": "Bearer " + access_token,
             "Content-Type": "application/json",
@@ -70,7 +102,7 @@ class FeiShuChanel(ChatChannel):
             reply_content = self._upload_image_url(reply.content, access_token)
             if not reply_content:
                 logger.warning("[FeiShu] upload file failed")
-                return
+                return {}
             msg_type = "image"
             content_key = "image_key"
         if is_group:
@@ -95,9 +127,19 @@ class FeiShuChanel(ChatChannel):
             logger.info(f"[FeiShu] send message success")
         else:
             logger.error(f"[FeiShu] send message failed, code={res.get('code')}, msg={res.get('msg')}")
+            if res.get("code") in INVALID_TOKEN_CODES:
+                self.token_manager.invalidate()
+        return res
 
 
     def fetch_access_token(self) -> str:
+        try:
+            return self.token_manager.get()
+        except Exception as e:
+            logger.error(f"[FeiShu] fetch token error, {e}")
+            return ""
+
+    def _request_access_token(self):
         url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
         headers = {
             "Content-Type": "application/json"
@@ -107,16 +149,13 @@ class FeiShuChanel(ChatChannel):
             "app_secret": self.feishu_app_secret
         }
         data = bytes(json.dumps(req_body), encoding='utf8')
-        response = requests.post(url=url, data=data, headers=headers)
-        if response.status_code == 200:
-            res = response.json()
-            if res.get("code") != 0:
-                logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
-                return ""
-            else:
-                return res.get("tenant_access_token")
-        else:
-            logger.error(f"[FeiShu] fetch token error, res={response}")
+        response = requests.post(url=url, data=data, headers=headers, timeout=(5, 10))
+        if response.status_code != 200:
+            raise Exception(f"res={response}")
+        res = response.json()
+        if res.get("code") != 0:
+            raise Exception(f"get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
+        return res.get("tenant_access_token"), res.get("expire", 7200)
 
 
     def _upload_image_url(self, img_url, access_token):
@@ -152,13 +191,19 @@ class FeishuController:
     MESSAGE_RECEIVE_TYPE = "im.message.receive_v1"
 
     def GET(self):
-        return "Feishu service start success!"
+        return self.handle_get(WebhookRequest.from_webpy())
 
     def POST(self):
+        return self.handle_post(WebhookRequest.from_webpy())
+
+    def handle_get(self, webhook_request: WebhookRequest):
+        return "Feishu service start success!"
+
+    def handle_post(self, webhook_request: WebhookRequest):
         try:
             channel = FeiShuChanel()
 
-            request = json.loads(web.data().decode("utf-8"))
+            request = json.loads(webhook_request.body.decode("utf-8"))
             logger.debug(f"[FeiShu] receive request: {request}")
 
             # 1.事件订阅回调验证
@@ -225,6 +270,7 @@ class FeishuController:
             logger.error(e)
             return self.FAILED_MSG
 
+    @metrics.timed(COMPOSE_SECONDS)
     def _compose_context(self, ctype: ContextType, content, **kwargs):
         context = Context(ctype, content)
         context.kwargs = kwargs
@@ -0,0 +1,145 @@
+"""
+回复发送流水线：回复中引用的图片、文件等先并发准备(上传、压缩、格式转换)，再按加入顺序逐个发送给同一接收者
+发送失败时定时重试，等待期间不占用线程，处理消息的线程把回复交给流水线后即可处理新消息
+"""
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from bridge.context import Context
+from bridge.reply import Reply
+from common.log import logger
+from config import conf
+
+
+class _SendJob(object):
+    def __init__(self, reply: Reply, context: Context):
+        self.reply = reply
+        self.context = context
+        self.prepared = None  # 准备步骤的future，为None时无需准备
+        self.retry_cnt = 0
+        self.not_before = 0.0  # 重试的最早时间
+
+
+class _ReceiverQueue(object):
+    def __init__(self):
+        self.jobs = deque()
+        self.busy = False  # 有回复正在发送，同一接收者同时只发送一条
+
+
+class SendPipeline(object):
+    def __init__(self, channel, workers=None, max_pending=None, max_retries=2):
+        """
+        :param channel: 提供prepare_reply(reply, context)和_send_once(reply, context) -> 是否需要重试
+        :param max_pending: 每个接收者最多排队的回复数，超出时提交方等待
+        """
+        self.channel = channel
+        self.max_pending = max_pending or conf().get("send_queue_size", 20)
+        self.max_retries = max_retries
+        self.pool = ThreadPoolExecutor(max_workers=workers or conf().get("send_workers", 4), thread_name_prefix="send")
+        self.cond = threading.Condition()
+        self.queues = {}  # 接收者 -> _ReceiverQueue
+        self.timers = []  # (触发时间, 序号, 函数)
+        self.timer_seq = itertools.count()
+        self.timer_cond = threading.Condition()
+        _thread = threading.Thread(target=self._run_timers, name="send-retry", daemon=True)
+        _thread.start()
+
+    @staticmethod
+    def _receiver(context: Context):
+        return context.get("receiver") or context.get("session_id")
+
+    def pending(self, receiver) -> int:
+        with self.cond:
+            q = self.queues.get(receiver)
+            return len(q.jobs) + int(q.busy) if q else 0
+
+    def submit(self, reply: Reply, context: Context, prepare=True, inline=False):
+        """
+        :param prepare: 是否先在线程池中执行准备步骤
+        :param inline: 接收者没有待发送的回复时直接在当前线程发送，失败后的重试交给流水线
+        """
+        receiver = self._receiver(context)
+        job = _SendJob(reply, context)
+        with self.cond:
+            q = self.queues.setdefault(receiver, _ReceiverQueue())
+            while len(q.jobs) >= self.max_pending:
+                self.cond.wait()
+                q = self.queues.setdefault(receiver, _ReceiverQueue())
+            run_inline = inline and not q.jobs and not q.busy
+            if run_inline:
+                q.busy = True
+            else:
+                q.jobs.append(job)
+                if prepare:
+                    job.prepared = self.pool.submit(self._prepare, job)
+        if run_inline:
+            self._send(receiver, job, inline=True)
+        elif job.prepared is not None:
+            job.prepared.add_done_callback(lambda _: self._kick(receiver))
+        else:
+            self._kick(receiver)
+
+    def _prepare(self, job: _SendJob):
+        try:
+            self.channel.prepare_reply(job.reply, job.context)
+        except Exception as e:
+            # 准备失败时仍然发送，由发送步骤处理错误
+            logger.warning("[SendPipeline] prepare {} reply failed: {}".format(job.reply.type, e))
+
+    def _kick(self, receiver):
+        # 队首的回复准备完成且到了重试时间时，提交到线程池发送
+        with self.cond:
+            q = self.queues.get(receiver)
+            if q is None or q.busy or not q.jobs:
+                return
+            job = q.jobs[0]
+            if job.prepared is not None and not job.prepared.done():
+                return  # 准备完成的回调会再次触发
+            if job.not_before > time.time():
+                return  # 重试定时器会再次触发
+            q.busy = True
+        self.pool.submit(self._send, receiver, job)
+
+    def _send(self, receiver, job: _SendJob, inline=False):
+        retry = False
+        try:
+            retry = self.channel._send_once(job.reply, job.context)
+        except Exception as e:
+            logger.exception("[SendPipeline] send failed: {}".format(e))
+        with self.cond:
+            q = self.queues[receiver]
+            q.busy = False
+            if retry and job.retry_cnt < self.max_retries:
+                delay = 3 + 3 * job.retry_cnt
+                job.retry_cnt += 1
+                job.not_before = time.time() + delay
+                if inline:
+                    q.jobs.appendleft(job)
+                self._later(delay, lambda: self._kick(receiver))
+            else:
+                if not inline:
+                    q.jobs.popleft()
+                if not q.jobs:
+                    del self.queues[receiver]
+            self.cond.notify_all()
+        self._kick(receiver)
+
+    def _later(self, delay, func):
+        with self.timer_cond:
+            heapq.heappush(self.timers, (time.time() + delay, next(self.timer_seq), func))
+            self.timer_cond.notify()
+
+    def _run_timers(self):
+        while True:
+            with self.timer_cond:
+                while not self.timers or self.timers[0][0] > time.time():
+                    self.timer_cond.wait(self.timers[0][0] - time.time() if self.timers else None)
+                _, _, func = heapq.heappop(self.timers)
+            try:
+                func()
+            except Exception as e:
+                logger.exception("[SendPipeline] timer error: {}".format(e))
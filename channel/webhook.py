@@ -0,0 +1,155 @@
+"""
+公众号、企业微信、飞书等回调渠道的HTTP服务
+默认使用web.py自带的单进程服务器；webhook_server配置为aiohttp时使用异步服务器，
+验签、解密、生成context在线程池中执行后立即交给produce，等待回复时不占用线程，单核即可保持上千个并发回调连接
+"""
+import asyncio
+import concurrent.futures
+import importlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import web
+
+from common.log import logger
+from config import conf
+
+try:
+    from aiohttp import web as aioweb
+except Exception as e:
+    aioweb = None
+
+
+class WebhookRequest(object):
+    """
+    与web框架无关的回调请求
+    """
+
+    def __init__(self, params: dict, body: bytes = b"", remote_addr=None, remote_port=None):
+        self.params = web.storage(params)  # 与web.input()一致，支持属性访问
+        self.body = body
+        self.remote_addr = remote_addr
+        self.remote_port = remote_port
+
+    @classmethod
+    def from_webpy(cls):
+        return cls(web.input(), web.data(), web.ctx.env.get("REMOTE_ADDR"), web.ctx.env.get("REMOTE_PORT"))
+
+
+class DeferredResponse(object):
+    """
+    需要等待回复的响应：future完成或超时后调用finish生成响应，finish可以再返回DeferredResponse
+    同步服务器中阻塞等待，异步服务器中在事件循环里等待
+    """
+
+    def __init__(self, future: concurrent.futures.Future, timeout, finish):
+        """
+        :param future: 为None时只等待timeout秒
+        :param finish: finish(是否等到了future) -> 响应
+        """
+        self.future = future
+        self.timeout = max(timeout, 0)
+        self.finish = finish
+
+    def wait(self) -> bool:
+        if self.future is None:
+            time.sleep(self.timeout)
+            return False
+        done, _ = concurrent.futures.wait([self.future], timeout=self.timeout)
+        return bool(done)
+
+    async def wait_async(self) -> bool:
+        if self.future is None:
+            await asyncio.sleep(self.timeout)
+            return False
+        done, _ = await asyncio.wait([asyncio.wrap_future(self.future)], timeout=self.timeout)
+        return bool(done)
+
+
+def resolve(response):
+    """
+    同步服务器中得到最终响应
+    """
+    while isinstance(response, DeferredResponse):
+        response = response.finish(response.wait())
+    return response
+
+
+async def resolve_async(response):
+    while isinstance(response, DeferredResponse):
+        done = await response.wait_async()
+        response = await asyncio.get_running_loop().run_in_executor(None, response.finish, done)
+    return response
+
+
+def serve(name, routes, port):
+    """
+    :param name: 用于日志
+    :param routes: ((路径, 处理类的完整路径), ...)，处理类实现handle_get/handle_post(WebhookRequest)，并提供web.py使用的GET/POST
+    """
+    server = conf().get("webhook_server", "webpy")
+    if server == "aiohttp":
+        if aioweb is not None:
+            _serve_aiohttp(name, routes, port)
+            return
+        logger.warning("[{}] aiohttp not installed, fall back to web.py server".format(name))
+    urls = tuple(item for route in routes for item in route)
+    app = web.application(urls, globals(), autoreload=False)
+    web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+
+
+def _load_handler(path):
+    module_name, class_name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def _call_handler(method, request: WebhookRequest):
+    # 处理类中创建web.HTTPError时会写入web.ctx，线程池中需要先初始化；异常被处理类捕获时状态码仍以web.ctx为准，与web.py一致
+    web.ctx.headers = []
+    web.ctx.status = "200 OK"
+    response = method(request)
+    return int(str(web.ctx.status).split()[0]), response
+
+
+def _serve_aiohttp(name, routes, port):
+    # 同步的处理逻辑(验签、解密、插件、produce)在线程池中执行，线程只在处理请求时占用，等待回复时释放
+    pool = ThreadPoolExecutor(max_workers=conf().get("webhook_workers", 16), thread_name_prefix="webhook")
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(pool)
+    inflight = asyncio.Semaphore(conf().get("webhook_max_inflight", 4096))
+
+    def make_handler(handler_cls):
+        async def handle(request):
+            async with inflight:
+                peer = request.transport.get_extra_info("peername") if request.transport else None
+                webhook_request = WebhookRequest(dict(request.query), await request.read(), request.remote, peer[1] if peer else None)
+                method = handler_cls().handle_get if request.method == "GET" else handler_cls().handle_post
+                try:
+                    status, response = await loop.run_in_executor(None, _call_handler, method, webhook_request)
+                    response = await resolve_async(response)
+                except web.HTTPError as e:
+                    return aioweb.Response(status=int(str(e.args[0]).split()[0]), text=str(e.data or ""))
+                if response is None:
+                    response = ""
+                if isinstance(response, bytes):
+                    return aioweb.Response(status=status, body=response)
+                return aioweb.Response(status=status, text=str(response), content_type="text/plain")
+
+        return handle
+
+    app = aioweb.Application(client_max_size=10 * 1024 * 1024)
+    for path, handler_path in routes:
+        handler = make_handler(_load_handler(handler_path))
+        app.router.add_route("GET", path, handler)
+        app.router.add_route("POST", path, handler)
+
+    asyncio.set_event_loop(loop)
+    runner = aioweb.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(aioweb.TCPSite(runner, "0.0.0.0", port, backlog=1024).start())
+    logger.info("[{}] aiohttp webhook server listening on port {}, workers={}".format(name, port, conf().get("webhook_workers", 16)))
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(runner.cleanup())
+        pool.shutdown(wait=False)
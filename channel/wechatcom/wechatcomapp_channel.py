@@ -12,10 +12,14 @@ from wechatpy.exceptions import InvalidSignatureException, WeChatClientException
 
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
+from channel import webhook
 from channel.chat_channel import ChatChannel
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
+from channel.webhook import WebhookRequest
+from common import media_cache
 from common.log import logger
+from common.media_cache import MediaCache
 from common.singleton import singleton
 from common.utils import compress_imgfile, fsize, split_string_by_utf8_length
 from config import conf, subscribe_msg
@@ -41,13 +45,12 @@ class WechatComAppChannel(ChatChannel):
         )
         self.crypto = WeChatCrypto(self.token, self.aes_key, self.corp_id)
         self.client = WechatComAppClient(self.corp_id, self.secret)
+        self.media_cache = MediaCache("wechatcom", conf().get("media_cache_max_entries", 500))
 
     def startup(self):
         # start message listener
-        urls = ("/wxcomapp", "channel.wechatcom.wechatcomapp_channel.Query")
-        app = web.application(urls, globals(), autoreload=False)
-        port = conf().get("wechatcomapp_port", 9898)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        routes = (("/wxcomapp", "channel.wechatcom.wechatcomapp_channel.Query"),)
+        webhook.serve("wechatcom", routes, conf().get("wechatcomapp_port", 9898))
 
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
@@ -71,9 +74,15 @@ class WechatComAppChannel(ChatChannel):
                 if len(files) > 1:
                     logger.info("[wechatcom] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
                 for path in files:
-                    response = self.client.media.upload("voice", open(path, "rb"))
-                    logger.debug("[wechatcom] upload voice response: {}".format(response))
-                    media_ids.append(response["media_id"])
+                    with open(path, "rb") as f:
+                        digest = media_cache.read_digest(f)
+                        media_id = self.media_cache.get("voice", digest=digest)
+                        if media_id is None:
+                            response = self.client.media.upload("voice", f)
+                            logger.debug("[wechatcom] upload voice response: {}".format(response))
+                            media_id = response["media_id"]
+                            self.media_cache.put("voice", digest, media_id, media_cache.TEMP_MEDIA_EXPIRES)
+                    media_ids.append(media_id)
             except WeChatClientException as e:
                 logger.error("[wechatcom] upload voice failed: {}".format(e))
                 return
@@ -87,49 +96,65 @@ class WechatComAppChannel(ChatChannel):
                 self.client.message.send_voice(self.agent_id, receiver, media_id)
                 time.sleep(1)
             logger.info("[wechatcom] sendVoice={}, receiver={}".format(reply.content, receiver))
-        elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
-            img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
-            image_storage = io.BytesIO()
-            for block in pic_res.iter_content(1024):
-                image_storage.write(block)
-            sz = fsize(image_storage)
-            if sz >= 10 * 1024 * 1024:
-                logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
-                image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
-                logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
-            image_storage.seek(0)
+        elif reply.type in (ReplyType.IMAGE_URL, ReplyType.IMAGE):
             try:
-                response = self.client.media.upload("image", image_storage)
-                logger.debug("[wechatcom] upload image response: {}".format(response))
+                media_id = self._upload_image(reply)
             except WeChatClientException as e:
                 logger.error("[wechatcom] upload image failed: {}".format(e))
                 return
+            self.client.message.send_image(self.agent_id, receiver, media_id)
+            if reply.type == ReplyType.IMAGE_URL:
+                logger.info("[wechatcom] sendImage url={}, receiver={}".format(reply.content, receiver))
+            else:
+                logger.info("[wechatcom] sendImage, receiver={}".format(receiver))
 
-            self.client.message.send_image(self.agent_id, receiver, response["media_id"])
-            logger.info("[wechatcom] sendImage url={}, receiver={}".format(img_url, receiver))
-        elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
-            image_storage = reply.content
-            sz = fsize(image_storage)
-            if sz >= 10 * 1024 * 1024:
-                logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
-                image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
-                logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
-            image_storage.seek(0)
-            try:
-                response = self.client.media.upload("image", image_storage)
-                logger.debug("[wechatcom] upload image response: {}".format(response))
-            except WeChatClientException as e:
-                logger.error("[wechatcom] upload image failed: {}".format(e))
-                return
-            self.client.message.send_image(self.agent_id, receiver, response["media_id"])
-            logger.info("[wechatcom] sendImage, receiver={}".format(receiver))
+    def prepare_reply(self, reply: Reply, context: Context):
+        # 提前下载、压缩、上传图片，发送时命中素材缓存
+        if reply.type in (ReplyType.IMAGE_URL, ReplyType.IMAGE):
+            self._upload_image(reply)
+
+    def _upload_image(self, reply: Reply) -> str:
+        """
+        上传回复中的图片，内容或下载地址相同时复用已上传的media_id，跳过下载、压缩和上传
+        """
+        url = reply.content if reply.type == ReplyType.IMAGE_URL else None
+        if url:
+            media_id = self.media_cache.get("image", url=url)
+            if media_id is not None:
+                return media_id
+            pic_res = requests.get(url, stream=True)  # 从网络下载图片
+            image_storage = io.BytesIO()
+            for block in pic_res.iter_content(1024):
+                image_storage.write(block)
+        else:
+            image_storage = reply.content  # 从文件读取图片
+        digest = media_cache.read_digest(image_storage)
+        media_id = self.media_cache.get("image", digest=digest, url=url)
+        if media_id is not None:
+            return media_id
+        sz = fsize(image_storage)
+        if sz >= 10 * 1024 * 1024:
+            logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
+            image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
+            logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
+        image_storage.seek(0)
+        response = self.client.media.upload("image", image_storage)
+        logger.debug("[wechatcom] upload image response: {}".format(response))
+        media_id = response["media_id"]
+        self.media_cache.put("image", digest, media_id, media_cache.TEMP_MEDIA_EXPIRES, url=url)
+        return media_id
 
 
 class Query:
     def GET(self):
+        return self.handle_get(WebhookRequest.from_webpy())
+
+    def POST(self):
+        return self.handle_post(WebhookRequest.from_webpy())
+
+    def handle_get(self, request: WebhookRequest):
         channel = WechatComAppChannel()
-        params = web.input()
+        params = request.params
         logger.info("[wechatcom] receive params: {}".format(params))
         try:
             signature = params.msg_signature
@@ -141,15 +166,15 @@ class Query:
             raise web.Forbidden()
         return echostr
 
-    def POST(self):
+    def handle_post(self, request: WebhookRequest):
         channel = WechatComAppChannel()
-        params = web.input()
+        params = request.params
         logger.info("[wechatcom] receive params: {}".format(params))
         try:
             signature = params.msg_signature
             timestamp = params.timestamp
             nonce = params.nonce
-            message = channel.crypto.decrypt_message(web.data(), signature, timestamp, nonce)
+            message = channel.crypto.decrypt_message(request.body, signature, timestamp, nonce)
         except (InvalidSignatureException, InvalidCorpIdException):
             raise web.Forbidden()
         msg = parse_message(message)
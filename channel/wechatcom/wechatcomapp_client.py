@@ -1,21 +1,16 @@
-import threading
-import time
-
 from wechatpy.enterprise import WeChatClient
 
+from common.access_token import AccessTokenManager
+
 
 class WechatComAppClient(WeChatClient):
     def __init__(self, corp_id, secret, access_token=None, session=None, timeout=None, auto_retry=True):
         super(WechatComAppClient, self).__init__(corp_id, secret, access_token, session, timeout, auto_retry)
-        self.fetch_access_token_lock = threading.Lock()
+        self.token_manager = AccessTokenManager("wechatcom", self._request_access_token)
+
+    def fetch_access_token(self):  # 重载父类方法，多线程只获取一次access_token，并在过期前后台刷新
+        return self.token_manager.get()
 
-    def fetch_access_token(self):  # 重载父类方法，加锁避免多线程重复获取access_token
-        with self.fetch_access_token_lock:
-            access_token = self.session.get(self.access_token_key)
-            if access_token:
-                if not self.expires_at:
-                    return access_token
-                timestamp = time.time()
-                if self.expires_at - timestamp > 60:
-                    return access_token
-            return super().fetch_access_token()
+    def _request_access_token(self):
+        result = super().fetch_access_token()  # 父类方法会把token写入session，供请求时使用
+        return result["access_token"], result.get("expires_in", 7200)
@@ -1,6 +1,5 @@
 import time
 
-import web
 from wechatpy import parse_message
 from wechatpy.replies import create_reply
 
@@ -9,6 +8,7 @@ from bridge.reply import *
 from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_channel import WechatMPChannel
 from channel.wechatmp.wechatmp_message import WeChatMPMessage
+from channel.webhook import WebhookRequest
 from common.log import logger
 from config import conf, subscribe_msg
 
@@ -16,15 +16,21 @@ from config import conf, subscribe_msg
 # This class is instantiated once per query
 class Query:
     def GET(self):
-        return verify_server(web.input())
+        return self.handle_get(WebhookRequest.from_webpy())
 
     def POST(self):
+        return self.handle_post(WebhookRequest.from_webpy())
+
+    def handle_get(self, request: WebhookRequest):
+        return verify_server(request.params)
+
+    def handle_post(self, request: WebhookRequest):
         # Make sure to return the instance that first created, @singleton will do that.
         try:
-            args = web.input()
+            args = request.params
             verify_server(args)
             channel = WechatMPChannel()
-            message = web.data()
+            message = request.body
             encrypt_func = lambda x: x
             if args.get("encrypt_type") == "aes":
                 logger.debug("[wechatmp] Receive encrypted post data:\n" + message.decode("utf-8"))
@@ -43,8 +49,8 @@ class Query:
 
                 logger.info(
                     "[wechatmp] {}:{} Receive post query {} {}: {}".format(
-                        web.ctx.env.get("REMOTE_ADDR"),
-                        web.ctx.env.get("REMOTE_PORT"),
+                        request.remote_addr,
+                        request.remote_port,
                         from_user,
                         message_id,
                         content,
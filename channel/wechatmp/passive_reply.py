@@ -1,7 +1,6 @@
 import asyncio
 import time
 
-import web
 from wechatpy import parse_message
 from wechatpy.replies import ImageReply, VoiceReply, create_reply
 import textwrap
@@ -10,6 +9,7 @@ from bridge.reply import *
 from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_channel import WechatMPChannel
 from channel.wechatmp.wechatmp_message import WeChatMPMessage
+from channel.webhook import DeferredResponse, WebhookRequest, resolve
 from common.log import logger
 from common.utils import split_string_by_utf8_length
 from config import conf, subscribe_msg
@@ -18,15 +18,21 @@ from config import conf, subscribe_msg
 # This class is instantiated once per query
 class Query:
     def GET(self):
-        return verify_server(web.input())
+        return self.handle_get(WebhookRequest.from_webpy())
 
     def POST(self):
+        return resolve(self.handle_post(WebhookRequest.from_webpy()))
+
+    def handle_get(self, request: WebhookRequest):
+        return verify_server(request.params)
+
+    def handle_post(self, request: WebhookRequest):
         try:
-            args = web.input()
+            args = request.params
             verify_server(args)
             request_time = time.time()
             channel = WechatMPChannel()
-            message = web.data()
+            message = request.body
             encrypt_func = lambda x: x
             if args.get("encrypt_type") == "aes":
                 logger.debug("[wechatmp] Receive encrypted post data:\n" + message.decode("utf-8"))
@@ -49,8 +55,7 @@ class Query:
 
                 # New request
                 if (
-                    channel.cache_dict.get(from_user) is None
-                    and from_user not in channel.running
+                    not channel.replies.is_pending(from_user)
                     or content.startswith("#")
                     and message_id not in channel.request_cnt  # insert the godcmd
                 ):
@@ -62,7 +67,9 @@ class Query:
                     logger.debug("[wechatmp] context: {} {} {}".format(context, wechatmp_msg, supported))
 
                     if supported and context:
-                        channel.running.add(from_user)
+                        # 微信服务器最多等待15秒(3次请求)，bot的重试不能超过这个时间
+                        context["deadline"] = request_time + 15
+                        channel.replies.start(from_user, message_id)
                         channel.produce(context)
                     else:
                         trigger_prefix = conf().get("single_chat_prefix", [""])[0]
@@ -96,103 +103,18 @@ class Query:
                 channel.request_cnt[message_id] = request_cnt
                 logger.info(
                     "[wechatmp] Request {} from {} {} {}:{}\n{}".format(
-                        request_cnt, from_user, message_id, web.ctx.env.get("REMOTE_ADDR"), web.ctx.env.get("REMOTE_PORT"), content
+                        request_cnt, from_user, message_id, request.remote_addr, request.remote_port, content
                     )
                 )
 
-                task_running = True
-                waiting_until = request_time + 4
-                while time.time() < waiting_until:
-                    if from_user in channel.running:
-                        time.sleep(0.1)
-                    else:
-                        task_running = False
-                        break
-
-                reply_text = ""
-                if task_running:
-                    if request_cnt < 3:
-                        # waiting for timeout (the POST request will be closed by Wechat official server)
-                        time.sleep(2)
-                        # and do nothing, waiting for the next request
-                        return "success"
-                    else:  # request_cnt == 3:
-                        # return timeout message
-                        reply_text = "【正在思考中，回复任意文字尝试获取回复】"
-                        replyPost = create_reply(reply_text, msg)
-                        return encrypt_func(replyPost.render())
-
-                # reply is ready
-                channel.request_cnt.pop(message_id)
-
-                # no return because of bandwords or other reasons
-                if from_user not in channel.cache_dict and from_user not in channel.running:
-                    return "success"
-
-                # Only one request can access to the cached data
-                try:
-                    (reply_type, reply_content) = channel.cache_dict[from_user].pop(0)
-                    if not channel.cache_dict[from_user]:  # If popping the message makes the list empty, delete the user entry from cache
-                        del channel.cache_dict[from_user]
-                except IndexError:
-                    return "success"
-
-                if reply_type == "text":
-                    if len(reply_content.encode("utf8")) <= MAX_UTF8_LEN:
-                        reply_text = reply_content
-                    else:
-                        continue_text = "\n【未完待续，回复任意文字以继续】"
-                        splits = split_string_by_utf8_length(
-                            reply_content,
-                            MAX_UTF8_LEN - len(continue_text.encode("utf-8")),
-                            max_split=1,
-                        )
-                        reply_text = splits[0] + continue_text
-                        channel.cache_dict[from_user].append(("text", splits[1]))
-
-                    logger.info(
-                        "[wechatmp] Request {} do send to {} {}: {}\n{}".format(
-                            request_cnt,
-                            from_user,
-                            message_id,
-                            content,
-                            reply_text,
-                        )
-                    )
-                    replyPost = create_reply(reply_text, msg)
-                    return encrypt_func(replyPost.render())
-
-                elif reply_type == "voice":
-                    media_id = reply_content
-                    asyncio.run_coroutine_threadsafe(channel.delete_media(media_id), channel.delete_media_loop)
-                    logger.info(
-                        "[wechatmp] Request {} do send to {} {}: {} voice media_id {}".format(
-                            request_cnt,
-                            from_user,
-                            message_id,
-                            content,
-                            media_id,
-                        )
-                    )
-                    replyPost = VoiceReply(message=msg)
-                    replyPost.media_id = media_id
-                    return encrypt_func(replyPost.render())
-
-                elif reply_type == "image":
-                    media_id = reply_content
-                    asyncio.run_coroutine_threadsafe(channel.delete_media(media_id), channel.delete_media_loop)
-                    logger.info(
-                        "[wechatmp] Request {} do send to {} {}: {} image media_id {}".format(
-                            request_cnt,
-                            from_user,
-                            message_id,
-                            content,
-                            media_id,
-                        )
-                    )
-                    replyPost = ImageReply(message=msg)
-                    replyPost.media_id = media_id
-                    return encrypt_func(replyPost.render())
+                future = channel.replies.future(from_user, message_id)
+                if future is None:
+                    return self._reply(channel, msg, encrypt_func, from_user, message_id, content, request_cnt, True)
+                return DeferredResponse(
+                    future,
+                    request_time + 4 - time.time(),
+                    lambda ready: self._reply(channel, msg, encrypt_func, from_user, message_id, content, request_cnt, ready),
+                )
 
             elif msg.type == "event":
                 logger.info("[wechatmp] Event {} from {}".format(msg.event, msg.source))
@@ -209,3 +131,87 @@ class Query:
         except Exception as exc:
             logger.exception(exc)
             return exc
+
+    def _reply(self, channel, msg, encrypt_func, from_user, message_id, content, request_cnt, ready):
+        try:
+            if not ready:
+                if request_cnt < 3:
+                    # waiting for timeout (the POST request will be closed by Wechat official server)
+                    # and do nothing, waiting for the next request
+                    return DeferredResponse(None, 2, lambda _: "success")
+                else:  # request_cnt == 3:
+                    # return timeout message
+                    reply_text = "【正在思考中，回复任意文字尝试获取回复】"
+                    replyPost = create_reply(reply_text, msg)
+                    return encrypt_func(replyPost.render())
+
+            # reply is ready
+            channel.request_cnt.pop(message_id, None)
+
+            # no return because of bandwords or other reasons
+            popped = channel.replies.pop(from_user)
+            if popped is None:
+                return "success"
+            (reply_msg_id, (reply_type, reply_content)) = popped
+
+            if reply_type == "text":
+                if len(reply_content.encode("utf8")) <= MAX_UTF8_LEN:
+                    reply_text = reply_content
+                else:
+                    continue_text = "\n【未完待续，回复任意文字以继续】"
+                    splits = split_string_by_utf8_length(
+                        reply_content,
+                        MAX_UTF8_LEN - len(continue_text.encode("utf-8")),
+                        max_split=1,
+                    )
+                    reply_text = splits[0] + continue_text
+                    channel.replies.push_front(from_user, reply_msg_id, ("text", splits[1]))
+
+                logger.info(
+                    "[wechatmp] Request {} do send to {} {}: {}\n{}".format(
+                        request_cnt,
+                        from_user,
+                        message_id,
+                        content,
+                        reply_text,
+                    )
+                )
+                replyPost = create_reply(reply_text, msg)
+                return encrypt_func(replyPost.render())
+
+            elif reply_type == "voice":
+                media_id = reply_content
+                asyncio.run_coroutine_threadsafe(channel.delete_media(media_id), channel.delete_media_loop)
+                logger.info(
+                    "[wechatmp] Request {} do send to {} {}: {} voice media_id {}".format(
+                        request_cnt,
+                        from_user,
+                        message_id,
+                        content,
+                        media_id,
+                    )
+                )
+                replyPost = VoiceReply(message=msg)
+                replyPost.media_id = media_id
+                return encrypt_func(replyPost.render())
+
+            elif reply_type == "image":
+                media_id = reply_content
+                asyncio.run_coroutine_threadsafe(channel.delete_media(media_id), channel.delete_media_loop)
+                logger.info(
+                    "[wechatmp] Request {} do send to {} {}: {} image media_id {}".format(
+                        request_cnt,
+                        from_user,
+                        message_id,
+                        content,
+                        media_id,
+                    )
+                )
+                replyPost = ImageReply(message=msg)
+                replyPost.media_id = media_id
+                return encrypt_func(replyPost.render())
+
+            return "success"
+        except Exception as exc:
+            logger.exception(exc)
+            return exc
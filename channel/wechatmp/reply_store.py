@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+
+class PendingReply(object):
+    """
+    单条消息的回复：future在缓存第一条回复或处理结束时完成，等待回复的HTTP请求据此唤醒
+    """
+
+    def __init__(self, expires_at, running=True):
+        self.future = Future()
+        self.replies = deque()  # (回复类型, 内容)
+        self.running = running
+        self.expires_at = expires_at
+
+    def wake(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class PassiveReplyStore(object):
+    """
+    被动回复模式下按(用户, 消息id)缓存回复，线程安全，超过ttl未取走的回复自动丢弃
+    同一用户的多条消息按收到的顺序取回复
+    """
+
+    def __init__(self, ttl=1800):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.users = {}  # 用户 -> OrderedDict(消息id -> PendingReply)，按收到的顺序排列
+        self.next_sweep = time.time() + 60
+
+    def _items(self, user) -> OrderedDict:
+        now = time.time()
+        if now >= self.next_sweep:
+            self._sweep(now)
+        items = self.users.get(user)
+        if items:
+            for msg_id in [msg_id for msg_id, item in items.items() if item.expires_at <= now]:
+                items.pop(msg_id).wake()
+        return items or OrderedDict()
+
+    def _sweep(self, now):
+        self.next_sweep = now + 60
+        for user in list(self.users):
+            items = self.users[user]
+            for msg_id in [msg_id for msg_id, item in items.items() if item.expires_at <= now]:
+                items.pop(msg_id).wake()
+            if not items:
+                del self.users[user]
+
+    def _find(self, user, msg_id):
+        # 合并后的消息等情况下消息id对不上时，归入用户最早一条正在处理的消息
+        items = self._items(user)
+        item = items.get(msg_id)
+        if item is None:
+            item = next((item for item in items.values() if item.running), None)
+        return item
+
+    def _remove(self, user, msg_id):
+        items = self.users.get(user)
+        if items is not None:
+            items.pop(msg_id, None)
+            if not items:
+                del self.users[user]
+
+    def start(self, user, msg_id) -> PendingReply:
+        with self.lock:
+            item = PendingReply(time.time() + self.ttl)
+            self.users.setdefault(user, OrderedDict())[msg_id] = item
+            return item
+
+    def is_pending(self, user) -> bool:
+        """
+        :return: 用户是否有正在处理或尚未取走回复的消息
+        """
+        with self.lock:
+            return bool(self._items(user))
+
+    def future(self, user, msg_id):
+        """
+        :return: 等待该消息回复的future，消息已处理完成时返回None
+        """
+        with self.lock:
+            item = self._find(user, msg_id)
+            if item is None or not item.running:
+                return None
+            return item.future
+
+    def put(self, user, msg_id, reply):
+        with self.lock:
+            item = self._find(user, msg_id)
+            if item is None:
+                item = self.users.setdefault(user, OrderedDict())[msg_id] = PendingReply(0, running=False)
+            item.replies.append(reply)
+            item.expires_at = time.time() + self.ttl
+        item.wake()
+
+    def finish(self, user, msg_id):
+        """
+        消息处理结束，没有回复时直接删除
+        """
+        with self.lock:
+            items = self._items(user)
+            key = msg_id if msg_id in items else next((k for k, item in items.items() if item.running), None)
+            if key is None:
+                return
+            item = items[key]
+            item.running = False
+            if not item.replies:
+                self._remove(user, key)
+        item.wake()
+
+    def pop(self, user):
+        """
+        :return: (消息id, 回复) 用户最早的一条回复，没有时返回None
+        """
+        with self.lock:
+            for msg_id, item in self._items(user).items():
+                if not item.replies:
+                    continue
+                reply = item.replies.popleft()
+                if not item.replies and not item.running:
+                    self._remove(user, msg_id)
+                return msg_id, reply
+        return None
+
+    def push_front(self, user, msg_id, reply):
+        """
+        放回未发送完的回复，下次pop时优先取出
+        """
+        with self.lock:
+            items = self.users.setdefault(user, OrderedDict())
+            item = items.get(msg_id)
+            if item is None:
+                item = items[msg_id] = PendingReply(0, running=False)
+                items.move_to_end(msg_id, last=False)
+            item.replies.appendleft(reply)
+            item.expires_at = time.time() + self.ttl
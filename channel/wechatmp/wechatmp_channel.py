@@ -7,17 +7,20 @@ import threading
 import time
 
 import requests
-import web
 from wechatpy.crypto import WeChatCrypto
 from wechatpy.exceptions import WeChatClientException
-from collections import defaultdict
 
 from bridge.context import *
 from bridge.reply import *
+from channel import webhook
 from channel.chat_channel import ChatChannel
 from channel.wechatmp.common import *
+from channel.wechatmp.reply_store import PassiveReplyStore
 from channel.wechatmp.wechatmp_client import WechatMPClient
+from common import media_cache
+from common.expired_dict import ExpiredDict
 from common.log import logger
+from common.media_cache import MediaCache
 from common.singleton import singleton
 from common.utils import split_string_by_utf8_length
 from config import conf
@@ -45,13 +48,13 @@ class WechatMPChannel(ChatChannel):
         self.crypto = None
         if aes_key:
             self.crypto = WeChatCrypto(token, aes_key, appid)
+        # 只缓存主动回复上传的临时素材(3天后自动失效)；被动回复上传的是永久素材，数量有上限，发送后即删除，不缓存
+        self.media_cache = None if passive_reply else MediaCache("wechatmp", conf().get("media_cache_max_entries", 500))
         if self.passive_reply:
-            # Cache the reply to the user's first message
-            self.cache_dict = defaultdict(list)
-            # Record whether the current message is being processed
-            self.running = set()
-            # Count the request from wechat official server by message_id
-            self.request_cnt = dict()
+            # Cache the replies by (user, message_id), waiting requests are woken up when the first reply is cached
+            self.replies = PassiveReplyStore()
+            # Count the request from wechat official server by message_id, wechat retries within 15 seconds
+            self.request_cnt = ExpiredDict(60)
             # The permanent media need to be deleted to avoid media number limit
             self.delete_media_loop = asyncio.new_event_loop()
             t = threading.Thread(target=self.start_loop, args=(self.delete_media_loop,))
@@ -60,12 +63,10 @@ class WechatMPChannel(ChatChannel):
 
     def startup(self):
         if self.passive_reply:
-            urls = ("/wx", "channel.wechatmp.passive_reply.Query")
+            routes = (("/wx", "channel.wechatmp.passive_reply.Query"),)
         else:
-            urls = ("/wx", "channel.wechatmp.active_reply.Query")
-        app = web.application(urls, globals(), autoreload=False)
-        port = conf().get("wechatmp_port", 8080)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+            routes = (("/wx", "channel.wechatmp.active_reply.Query"),)
+        webhook.serve("wechatmp", routes, conf().get("wechatmp_port", 8080))
 
     def start_loop(self, loop):
         asyncio.set_event_loop(loop)
@@ -79,11 +80,28 @@ class WechatMPChannel(ChatChannel):
 
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
-        if self.passive_reply:
+        if reply.type in (ReplyType.IMAGE_URL, ReplyType.IMAGE, ReplyType.VIDEO_URL, ReplyType.VIDEO):
+            # 图片、视频在两种模式下的上传逻辑相同，只是被动回复上传永久素材并缓存回复，主动回复上传临时素材后直接发送
+            media_type = "image" if reply.type in (ReplyType.IMAGE_URL, ReplyType.IMAGE) else "video"
+            try:
+                media_id = self._upload_reply_media(media_type, reply, receiver, context)
+            except WeChatClientException as e:
+                logger.error("[wechatmp] upload {} failed: {}".format(media_type, e))
+                return
+            if self.passive_reply:
+                logger.info("[wechatmp] {} uploaded, receiver {}, media_id {}".format(media_type, receiver, media_id))
+                self.replies.put(receiver, context["msg"].msg_id, (media_type, media_id))
+            elif media_type == "image":
+                self.client.message.send_image(receiver, media_id)
+                logger.info("[wechatmp] Do send image to {}".format(receiver))
+            else:
+                self.client.message.send_video(receiver, media_id)
+                logger.info("[wechatmp] Do send video to {}".format(receiver))
+        elif self.passive_reply:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = reply.content
                 logger.info("[wechatmp] text cached, receiver {}\n{}".format(receiver, reply_text))
-                self.cache_dict[receiver].append(("text", reply_text))
+                self.replies.put(receiver, context["msg"].msg_id, ("text", reply_text))
             elif reply.type == ReplyType.VOICE:
                 voice_file_path = reply.content
                 duration, files = split_audio(voice_file_path, 60 * 1000)
@@ -104,77 +122,7 @@ class WechatMPChannel(ChatChannel):
                         return
                     media_id = response["media_id"]
                     logger.info("[wechatmp] voice uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                    self.cache_dict[receiver].append(("voice", media_id))
-
-            elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
-                img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.material.add("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
-            elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
-                image_storage = reply.content
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.material.add("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
-            elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
-                video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
-                video_storage = io.BytesIO()
-                for block in video_res.iter_content(1024):
-                    video_storage.write(block)
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.material.add("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
-
-            elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
-                video_storage = reply.content
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.material.add("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
+                    self.replies.put(receiver, context["msg"].msg_id, ("voice", media_id))
 
         else:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
@@ -209,9 +157,15 @@ class WechatMPChannel(ChatChannel):
                         logger.info("[wechatmp] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
                     for path in files:
                         # support: <2M, <60s, AMR\MP3
-                        response = self.client.media.upload("voice", (os.path.basename(path), open(path, "rb"), file_type))
-                        logger.debug("[wechatcom] upload voice response: {}".format(response))
-                        media_ids.append(response["media_id"])
+                        with open(path, "rb") as f:
+                            digest = media_cache.read_digest(f)
+                            media_id = self.media_cache.get("voice", digest=digest)
+                            if media_id is None:
+                                response = self.client.media.upload("voice", (os.path.basename(path), f, file_type))
+                                logger.debug("[wechatcom] upload voice response: {}".format(response))
+                                media_id = response["media_id"]
+                                self.media_cache.put("voice", digest, media_id, media_cache.TEMP_MEDIA_EXPIRES)
+                        media_ids.append(media_id)
                         os.remove(path)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload voice failed: {}".format(e))
@@ -226,79 +180,58 @@ class WechatMPChannel(ChatChannel):
                     self.client.message.send_voice(receiver, media_id)
                     time.sleep(1)
                 logger.info("[wechatmp] Do send voice to {}".format(receiver))
-            elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
-                img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.media.upload("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                self.client.message.send_image(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send image to {}".format(receiver))
-            elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
-                image_storage = reply.content
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.media.upload("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                self.client.message.send_image(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send image to {}".format(receiver))
-            elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
-                video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
-                video_storage = io.BytesIO()
-                for block in video_res.iter_content(1024):
-                    video_storage.write(block)
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.media.upload("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                self.client.message.send_video(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send video to {}".format(receiver))
-            elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
-                video_storage = reply.content
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.media.upload("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                self.client.message.send_video(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send video to {}".format(receiver))
         return
 
+    def prepare_reply(self, reply: Reply, context: Context):
+        # 提前上传图片、视频，发送时命中素材缓存；被动回复不缓存素材，在发送时上传
+        if self.media_cache is None:
+            return
+        if reply.type in (ReplyType.IMAGE_URL, ReplyType.IMAGE):
+            self._upload_reply_media("image", reply, context["receiver"], context)
+        elif reply.type in (ReplyType.VIDEO_URL, ReplyType.VIDEO):
+            self._upload_reply_media("video", reply, context["receiver"], context)
+
+    def _upload_reply_media(self, media_type, reply: Reply, receiver, context: Context) -> str:
+        """
+        上传回复中的图片、视频，主动回复时内容或下载地址相同则复用已上传的临时素材
+        """
+        cache = self.media_cache
+        url = reply.content if reply.type in (ReplyType.IMAGE_URL, ReplyType.VIDEO_URL) else None
+        if url:
+            media_id = cache.get(media_type, url=url) if cache else None
+            if media_id is not None:
+                return media_id
+            res = requests.get(url, stream=True)  # 从网络下载
+            storage = io.BytesIO()
+            for block in res.iter_content(1024):
+                storage.write(block)
+        else:
+            storage = reply.content  # 从文件读取
+        storage.seek(0)
+        if cache:
+            digest = media_cache.read_digest(storage)
+            media_id = cache.get(media_type, digest=digest, url=url)
+            if media_id is not None:
+                return media_id
+        file_type = imghdr.what(storage) if media_type == "image" else "mp4"
+        filename = receiver + "-" + str(context["msg"].msg_id) + "." + file_type
+        content_type = media_type + "/" + file_type
+        if self.passive_reply:
+            response = self.client.material.add(media_type, (filename, storage, content_type))
+        else:
+            response = self.client.media.upload(media_type, (filename, storage, content_type))
+        logger.debug("[wechatmp] upload {} response: {}".format(media_type, response))
+        media_id = response["media_id"]
+        if cache:
+            cache.put(media_type, digest, media_id, media_cache.TEMP_MEDIA_EXPIRES, url=url)
+        return media_id
+
     def _success_callback(self, session_id, context, **kwargs):  # 线程异常结束时的回调函数
         logger.debug("[wechatmp] Success to generate reply, msgId={}".format(context["msg"].msg_id))
         if self.passive_reply:
-            self.running.remove(session_id)
+            self.replies.finish(session_id, context["msg"].msg_id)
 
     def _fail_callback(self, session_id, exception, context, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("[wechatmp] Fail to generate reply to user, msgId={}, exception={}".format(context["msg"].msg_id, exception))
         if self.passive_reply:
-            assert session_id not in self.cache_dict
-            self.running.remove(session_id)
+            self.replies.finish(session_id, context["msg"].msg_id)
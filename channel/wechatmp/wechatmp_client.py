@@ -5,13 +5,14 @@ from wechatpy.client import WeChatClient
 from wechatpy.exceptions import APILimitedException
 
 from channel.wechatmp.common import *
+from common.access_token import AccessTokenManager
 from common.log import logger
 
 
 class WechatMPClient(WeChatClient):
     def __init__(self, appid, secret, access_token=None, session=None, timeout=None, auto_retry=True):
         super(WechatMPClient, self).__init__(appid, secret, access_token, session, timeout, auto_retry)
-        self.fetch_access_token_lock = threading.Lock()
+        self.token_manager = AccessTokenManager("wechatmp", self._request_access_token)
         self.clear_quota_lock = threading.Lock()
         self.last_clear_quota_time = -1
 
@@ -21,16 +22,12 @@ class WechatMPClient(WeChatClient):
     def clear_quota_v2(self):
         return self.post("clear_quota/v2", params={"appid": self.appid, "appsecret": self.secret})
 
-    def fetch_access_token(self):  # 重载父类方法，加锁避免多线程重复获取access_token
-        with self.fetch_access_token_lock:
-            access_token = self.session.get(self.access_token_key)
-            if access_token:
-                if not self.expires_at:
-                    return access_token
-                timestamp = time.time()
-                if self.expires_at - timestamp > 60:
-                    return access_token
-            return super().fetch_access_token()
+    def fetch_access_token(self):  # 重载父类方法，多线程只获取一次access_token，并在过期前后台刷新
+        return self.token_manager.get()
+
+    def _request_access_token(self):
+        result = super().fetch_access_token()  # 父类方法会把token写入session，供请求时使用
+        return result["access_token"], result.get("expires_in", 7200)
 
     def _request(self, method, url_or_endpoint, **kwargs):  # 重载父类方法，遇到API限流时，清除quota后重试
         try:
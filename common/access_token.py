@@ -0,0 +1,68 @@
+"""
+access_token缓存：同一时间只有一个线程请求新token，到期前在后台提前刷新，消息处理时直接使用缓存
+飞书、公众号、企业微信等需要定期换取access_token的渠道共用
+"""
+import threading
+import time
+
+from common.log import logger
+
+
+class AccessTokenManager(object):
+    def __init__(self, name, fetch, refresh_ahead=300, min_ttl=60, retry_delay=30):
+        """
+        :param name: 用于日志
+        :param fetch: 请求新token的函数，返回 (token, 有效期秒数)，失败时抛出异常
+        :param refresh_ahead: 距离过期还有多少秒时在后台刷新
+        :param min_ttl: 剩余有效期不足该秒数时不再使用缓存，同步请求新token
+        :param retry_delay: 后台刷新失败后的重试间隔
+        """
+        self.name = name
+        self.fetch = fetch
+        self.refresh_ahead = refresh_ahead
+        self.min_ttl = min_ttl
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.cached = (None, 0.0)  # (token, 过期时间)，整体替换，读取时不加锁
+        self.timer = None
+
+    def get(self) -> str:
+        token, expires_at = self.cached
+        if token and expires_at - time.time() > self.min_ttl:
+            return token
+        with self.lock:
+            token, expires_at = self.cached
+            if token and expires_at - time.time() > self.min_ttl:  # 等锁期间其他线程已经刷新
+                return token
+            return self._refresh()
+
+    def invalidate(self):
+        """
+        token被服务端判定无效时调用，下次get时重新请求
+        """
+        self.cached = (None, 0.0)
+
+    def _refresh(self) -> str:
+        token, expires_in = self.fetch()
+        if not token:
+            raise Exception("[AccessToken] {} fetch returned empty token".format(self.name))
+        self.cached = (token, time.time() + expires_in)
+        logger.debug("[AccessToken] {} token refreshed, expires in {}s".format(self.name, expires_in))
+        # 有效期很短时在一半时间后刷新
+        self._schedule(expires_in - self.refresh_ahead if expires_in > 2 * self.refresh_ahead else expires_in / 2)
+        return token
+
+    def _schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(max(delay, 1), self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _background_refresh(self):
+        with self.lock:
+            try:
+                self._refresh()
+            except Exception as e:
+                logger.warning("[AccessToken] {} background refresh failed, retry in {}s: {}".format(self.name, self.retry_delay, e))
+                self._schedule(self.retry_delay)
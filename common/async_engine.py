@@ -0,0 +1,79 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common.log import logger
+from common.singleton import singleton
+from config import conf
+
+try:
+    import aiohttp
+except Exception as e:
+    aiohttp = None
+
+
+def is_async_engine() -> bool:
+    return conf().get("handler_engine", "thread") == "asyncio"
+
+
+@singleton
+class AsyncEngine(object):
+    """
+    asyncio消息处理引擎：在独立线程中运行一个事件循环，LLM请求在事件循环中以协程方式并发执行，
+    插件、语音转换、渠道发送等阻塞调用卸载到blocking_pool中执行
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.blocking_pool = ThreadPoolExecutor(max_workers=conf().get("async_blocking_workers", 8))
+        self.loop.set_default_executor(self.blocking_pool)
+        self._http_session = None
+        self._inflight = None
+        self._ready = threading.Event()
+        _thread = threading.Thread(target=self._run_loop, name="async-engine")
+        _thread.setDaemon(True)
+        _thread.start()
+        self._ready.wait()  # 信号量需在事件循环线程中创建，创建完成后才能提交协程
+        logger.info("[AsyncEngine] event loop started, max_inflight={}".format(conf().get("async_max_inflight", 256)))
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._inflight = asyncio.Semaphore(conf().get("async_max_inflight", 256))
+        self.loop.call_soon(self._ready.set)
+        self.loop.run_forever()
+
+    async def _limited(self, coro):
+        try:
+            await self._inflight.acquire()
+        except asyncio.CancelledError:
+            coro.close()  # 排队时被取消，协程从未开始执行，关闭以免产生never awaited警告
+            raise
+        try:
+            return await coro
+        finally:
+            self._inflight.release()
+
+    def submit(self, coro):
+        """
+        从任意线程提交协程到事件循环
+        :return: concurrent.futures.Future，可以注册回调或取消
+        """
+        return asyncio.run_coroutine_threadsafe(self._limited(coro), self.loop)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        在blocking_pool中执行阻塞函数，不占用事件循环，contextvars随调用传入线程
+        """
+        ctx = contextvars.copy_context()
+        return await self.loop.run_in_executor(self.blocking_pool, lambda: ctx.run(func, *args, **kwargs))
+
+    def http_session(self):
+        """
+        事件循环内共享的aiohttp会话，未安装aiohttp时返回None
+        """
+        if aiohttp is None:
+            return None
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=conf().get("request_timeout", 180)))
+        return self._http_session
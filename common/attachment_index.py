@@ -0,0 +1,60 @@
+import os
+import threading
+import time
+
+from common.log import logger
+from common.words_search import WordsSearch
+
+
+class AttachmentIndex(object):
+    """
+    目录下文件名的Aho-Corasick索引，用于在回复文本中一次线性扫描找出提到的所有文件
+    通过轮询目录的mtime感知文件增删，目录未变化时不会重新listdir
+    """
+
+    def __init__(self, directory, refresh_interval=5):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.searcher = None
+        self.dir_mtime = None
+        self.next_check = 0
+
+    def match(self, text):
+        """
+        :return: 回复中出现的文件名列表，按首次出现的位置排序并去重
+        """
+        searcher = self._get_searcher()
+        if searcher is None or not isinstance(text, str):
+            return []
+        names = []
+        for result in searcher.FindAll(text):
+            if result["Keyword"] not in names:
+                names.append(result["Keyword"])
+        return names
+
+    def _get_searcher(self):
+        now = time.monotonic()
+        if now < self.next_check:
+            return self.searcher
+        with self.lock:
+            if now < self.next_check:
+                return self.searcher
+            self.next_check = now + self.refresh_interval
+            try:
+                mtime = os.stat(self.directory).st_mtime_ns
+            except FileNotFoundError:
+                self.searcher, self.dir_mtime = None, None
+                return None
+            if mtime != self.dir_mtime:
+                self.searcher = self._build(os.listdir(self.directory))
+                self.dir_mtime = mtime
+            return self.searcher
+
+    def _build(self, names):
+        logger.debug("[AttachmentIndex] rebuild index of {}, files={}".format(self.directory, len(names)))
+        if not names:
+            return None
+        searcher = WordsSearch()
+        searcher.SetKeywords(names)
+        return searcher
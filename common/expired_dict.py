@@ -1,42 +1,117 @@
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+class ExpiredDict(MutableMapping):
+    """
+    带过期时间的字典，读写某个key会刷新它的过期时间
+    内部按最近访问顺序保存（最早访问的在最前，也就是最先过期的在最前），过期清理和LRU淘汰都是O(1)
+    过期的key在访问时惰性删除，并在读写时按sweep_interval周期从头部批量清理
+    :param expires_in_seconds: 过期时间
+    :param max_size: 最多保存的key数量，超出时淘汰最久未访问的key，0表示不限制
+    :param on_evict: 因过期或超出容量被删除时的回调 on_evict(key, value)，主动del不会触发
+    """
+
+    def __init__(self, expires_in_seconds, max_size=0, on_evict=None):
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.sweep_interval = min(expires_in_seconds or 60, 60)
+        self._data = OrderedDict()  # key -> (value, expiry_time)
+        self._lock = threading.RLock()
+        self._next_sweep = time.monotonic() + self.sweep_interval
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
+        now = time.monotonic()
+        with self._lock:
+            value, expiry_time = self._data[key]
+            expired = now > expiry_time
+            if expired:
+                del self._data[key]
+                evicted = [(key, value)]
+            else:
+                self._data[key] = (value, now + self.expires_in_seconds)
+                self._data.move_to_end(key)
+                evicted = self._maybe_sweep(now)
+        self._notify(evicted)
+        if expired:
             raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
         return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        now = time.monotonic()
+        with self._lock:
+            self._data[key] = (value, now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            evicted = self._maybe_sweep(now)
+            while self.max_size and len(self._data) > self.max_size:
+                old_key, (old_value, _) = self._data.popitem(last=False)
+                evicted.append((old_key, old_value))
+        self._notify(evicted)
 
-    def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
 
     def __contains__(self, key):
-        try:
-            self[key]
-            return True
-        except KeyError:
-            return False
+        # 仅检查是否存在且未过期，不刷新过期时间
+        item = self._data.get(key)
+        return item is not None and time.monotonic() <= item[1]
+
+    def __len__(self):
+        self.sweep()
+        return len(self._data)
 
-    def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+    def __iter__(self):
+        self.sweep()
+        with self._lock:
+            keys = list(self._data.keys())
+        return iter(keys)
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        self.sweep()
+        with self._lock:
+            return [(key, value) for key, (value, _) in self._data.items()]
 
-    def __iter__(self):
-        return self.keys().__iter__()
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def sweep(self):
+        """
+        清理所有已过期的key
+        """
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._sweep(now)
+        self._notify(evicted)
+
+    def _maybe_sweep(self, now):
+        if now < self._next_sweep:
+            return []
+        return self._sweep(now)
+
+    def _sweep(self, now):
+        self._next_sweep = now + self.sweep_interval
+        evicted = []
+        while self._data:
+            key, (value, expiry_time) = next(iter(self._data.items()))
+            if expiry_time >= now:
+                break
+            del self._data[key]
+            evicted.append((key, value))
+        return evicted
+
+    def _notify(self, evicted):
+        if self.on_evict is None:
+            return
+        for key, value in evicted:
+            self.on_evict(key, value)
+
+    def __repr__(self):
+        return "{}({}, expires_in_seconds={})".format(type(self).__name__, dict(self.items()), self.expires_in_seconds)
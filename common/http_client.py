@@ -0,0 +1,129 @@
+"""
+bot共用的HTTP客户端：按host复用连接池并保持长连接，统一默认超时，记录每次请求的耗时
+开启http2且安装了httpx[http2]时使用HTTP/2，否则使用requests
+"""
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import metrics
+from common.latency_stats import LatencyStats
+from common.log import logger
+from config import conf
+
+try:
+    import httpx
+except Exception as e:
+    httpx = None
+
+_clients = {}
+_clients_lock = threading.Lock()
+_stats = {}  # host -> LatencyStats
+_OTHER_HOST = "other"  # 超出http_pool_max_hosts的host不再单独建池，统计也合并到这一项
+
+
+def _use_http2():
+    return conf().get("http2", False) and httpx is not None
+
+
+def _client(host):
+    """
+    :return: (client, 统计使用的host)，超出http_pool_max_hosts时返回(None, "other")，由调用方直接用requests发起请求
+    """
+    client = _clients.get(host)
+    if client is not None:
+        return client, host
+    with _clients_lock:
+        client = _clients.get(host)
+        if client is None:
+            if len(_clients) >= conf().get("http_pool_max_hosts", 16):
+                _stats.setdefault(_OTHER_HOST, LatencyStats())
+                return None, _OTHER_HOST
+            pool_maxsize = conf().get("http_pool_maxsize", 20)
+            if _use_http2():
+                limits = httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize)
+                client = httpx.Client(http2=True, limits=limits)
+            else:
+                client = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+                client.mount("http://", adapter)
+                client.mount("https://", adapter)
+            _clients[host] = client
+            _stats[host] = LatencyStats()
+            logger.debug("[HTTP] create {} client for {}, pool_maxsize={}".format("http2" if _use_http2() else "http1", host, pool_maxsize))
+        return client, host
+
+
+def _default_timeout():
+    return conf().get("http_connect_timeout", 5), conf().get("request_timeout", 180)
+
+
+def _to_httpx_kwargs(kwargs):
+    timeout = kwargs.pop("timeout")
+    if isinstance(timeout, tuple):
+        kwargs["timeout"] = httpx.Timeout(timeout[1], connect=timeout[0])
+    else:
+        kwargs["timeout"] = timeout
+    data = kwargs.get("data")
+    if isinstance(data, (str, bytes)):
+        kwargs["content"] = kwargs.pop("data")
+    return kwargs
+
+
+def request(method, url, **kwargs):
+    """
+    与requests.request用法一致，未指定timeout时使用(http_connect_timeout, request_timeout)
+    """
+    host = urlparse(url).netloc
+    client, stats_host = _client(host)
+    kwargs.setdefault("timeout", _default_timeout())
+    if httpx is not None and isinstance(client, httpx.Client):
+        kwargs = _to_httpx_kwargs(kwargs)
+    start = time.time()
+    error = True
+    try:
+        if client is None:
+            response = requests.request(method, url, **kwargs)
+        else:
+            response = client.request(method, url, **kwargs)
+        error = response.status_code >= 500 or response.status_code == 429
+        return response
+    finally:
+        cost = time.time() - start
+        _stats[stats_host].record(cost, error)
+        logger.debug("[HTTP] {} {} cost={:.3f}s".format(method, host, cost))
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def stats() -> dict:
+    """
+    :return: {host: LatencyStats.summary()}
+    """
+    return {host: s.summary() for host, s in list(_stats.items())}
+
+
+def _collect_metrics():
+    hosts = stats()
+    families = [
+        ("cow_http_requests_total", "counter", "HTTP requests to bot backends", [({"host": host}, s["count"]) for host, s in hosts.items()]),
+        ("cow_http_errors_total", "counter", "HTTP requests to bot backends that failed with 5xx or 429", [({"host": host}, s["errors"]) for host, s in hosts.items()]),
+    ]
+    samples = []
+    for host, s in hosts.items():
+        for quantile in ("p50", "p95", "p99"):
+            samples.append(({"host": host, "quantile": "0." + quantile[1:]}, s[quantile]))
+    families.append(("cow_http_request_seconds", "gauge", "Recent HTTP request latency quantiles per host", samples))
+    return families
+
+
+metrics.register_collector(_collect_metrics)
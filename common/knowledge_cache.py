@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from common.log import logger
+from common.singleton import singleton
+from config import conf, get_appdata_dir
+
+DEFAULT_KNOWLEDGE_FILE_ID = "1736833122_c97254d492df4115b80ea72d4092d4e6"
+
+
+class KnowledgeEntry(object):
+    def __init__(self, content, fetched_at):
+        self.content = content
+        self.fetched_at = fetched_at
+        # 以内容摘要作为版本号，内容不变时版本不变
+        self.version = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+@singleton
+class KnowledgeCache(object):
+    """
+    进程级的知识库文件缓存，以file_id为key
+    首次使用时拉取（或从磁盘缓存加载），过期后在后台线程刷新，刷新期间继续返回旧内容
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.fetch_locks = {}
+        self.refreshing = set()
+        self.listeners = []
+
+    def get(self, file_id=None) -> KnowledgeEntry:
+        file_id = file_id or conf().get("knowledge_file_id") or DEFAULT_KNOWLEDGE_FILE_ID
+        entry = self.entries.get(file_id)
+        if entry is None:
+            entry = self._load(file_id)
+        elif time.time() - entry.fetched_at > conf().get("knowledge_refresh_seconds", 600):
+            self._refresh_in_background(file_id)
+        return entry
+
+    def get_content(self, file_id=None) -> str:
+        return self.get(file_id).content
+
+    def peek_version(self, file_id=None) -> str:
+        """
+        返回已加载的知识库版本号，未加载时返回空字符串，不触发拉取
+        """
+        file_id = file_id or conf().get("knowledge_file_id") or DEFAULT_KNOWLEDGE_FILE_ID
+        entry = self.entries.get(file_id)
+        return entry.version if entry else ""
+
+    def add_listener(self, func):
+        """
+        注册知识库更新回调，func(file_id, entry)，仅在内容版本变化时调用
+        """
+        self.listeners.append(func)
+
+    def _load(self, file_id) -> KnowledgeEntry:
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(file_id, threading.Lock())
+        # 同一file_id只允许一个线程拉取，其余线程等待结果
+        with fetch_lock:
+            entry = self.entries.get(file_id)
+            if entry is not None:
+                return entry
+            entry = self._read_disk(file_id)
+            if entry is None:
+                entry = KnowledgeEntry(self._fetch(file_id), time.time())
+                self._write_disk(file_id, entry)
+            self.entries[file_id] = entry
+            return entry
+
+    def _refresh_in_background(self, file_id):
+        with self.lock:
+            if file_id in self.refreshing:
+                return
+            self.refreshing.add(file_id)
+        _thread = threading.Thread(target=self._refresh, args=(file_id,))
+        _thread.setDaemon(True)
+        _thread.start()
+
+    def _refresh(self, file_id):
+        try:
+            old = self.entries.get(file_id)
+            entry = KnowledgeEntry(self._fetch(file_id), time.time())
+            self.entries[file_id] = entry
+            self._write_disk(file_id, entry)
+            if old is None or old.version != entry.version:
+                logger.info("[KnowledgeCache] knowledge updated, file_id={}, version={}".format(file_id, entry.version))
+                for func in self.listeners:
+                    func(file_id, entry)
+        except Exception as e:
+            logger.warning("[KnowledgeCache] refresh failed, keep stale content, file_id={}, err={}".format(file_id, e))
+            old = self.entries.get(file_id)
+            if old is not None:  # 失败后推迟下次刷新，避免每次访问都触发
+                old.fetched_at = time.time()
+        finally:
+            with self.lock:
+                self.refreshing.discard(file_id)
+
+    def _fetch(self, file_id) -> str:
+        from zhipuai import ZhipuAI
+
+        logger.info("[KnowledgeCache] fetch knowledge file, file_id={}".format(file_id))
+        client = ZhipuAI(api_key=conf().get("zhipu_ai_api_key"))
+        return json.loads(client.files.content(file_id=file_id).content)["content"]
+
+    def _disk_path(self, file_id):
+        cache_dir = conf().get("knowledge_cache_dir", "knowledge")
+        if not cache_dir:
+            return None
+        return os.path.join(get_appdata_dir(), cache_dir, "{}.json".format(file_id))
+
+    def _read_disk(self, file_id):
+        path = self._disk_path(file_id)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            logger.info("[KnowledgeCache] knowledge loaded from disk, file_id={}".format(file_id))
+            # 保留原拉取时间，过期后仍会在后台刷新
+            return KnowledgeEntry(data["content"], data["fetched_at"])
+        except Exception as e:
+            logger.warning("[KnowledgeCache] read disk cache failed: {}".format(e))
+            return None
+
+    def _write_disk(self, file_id, entry: KnowledgeEntry):
+        path = self._disk_path(file_id)
+        if not path:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"content": entry.content, "fetched_at": entry.fetched_at}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning("[KnowledgeCache] write disk cache failed: {}".format(e))
@@ -0,0 +1,173 @@
+"""
+知识库的本地BM25检索索引：把知识库切分成问答片段，提问时只把最相关的若干片段放进system prompt
+知识库更新后按片段内容摘要增量更新索引，只有新增和删除的片段需要重新分词
+"""
+import hashlib
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+from common.knowledge_cache import DEFAULT_KNOWLEDGE_FILE_ID, KnowledgeCache, KnowledgeEntry
+from common.log import logger
+from common.singleton import singleton
+from config import conf
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+_TERM = re.compile(r"[a-z0-9]+|[一-鿿]+")
+
+
+def tokenize(text: str) -> list:
+    """
+    英文和数字按词切分，中文按字的2-gram切分，不依赖分词词典
+    """
+    terms = []
+    for word in _TERM.findall(unicodedata.normalize("NFKC", text).lower()):
+        if word[0] < "一" or len(word) == 1:
+            terms.append(word)
+        else:
+            terms.extend(word[i : i + 2] for i in range(len(word) - 1))
+    return terms
+
+
+def split_chunks(content: str, max_chars=800) -> list:
+    """
+    有markdown标题时按标题切分，每个片段带上上级标题作为上下文；否则按空行切分
+    超过max_chars的片段再按行切开
+    """
+    lines = content.splitlines()
+    blocks = []
+    if any(_HEADING.match(line) for line in lines):
+        titles = []  # 当前片段的各级标题 [(level, line)]
+        body = []
+
+        def flush():
+            if any(line.strip() for line in body):
+                blocks.append("\n".join([t[1] for t in titles] + body).strip())
+
+        for line in lines:
+            m = _HEADING.match(line)
+            if m:
+                flush()
+                body = []
+                level = len(m.group(1))
+                while titles and titles[-1][0] >= level:
+                    titles.pop()
+                titles.append((level, line))
+            else:
+                body.append(line)
+        flush()
+    else:
+        blocks = [block.strip() for block in re.split(r"\n\s*\n", content) if block.strip()]
+    chunks = []
+    for block in blocks:
+        while len(block) > max_chars:
+            cut = block.rfind("\n", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            chunks.append(block[:cut].strip())
+            block = block[cut:].strip()
+        if block:
+            chunks.append(block)
+    return chunks
+
+
+class Bm25Index(object):
+    """
+    以片段内容摘要为文档id的BM25倒排索引，支持按片段增删
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = {}  # doc_id -> (text, term_freq, length)
+        self.order = {}  # doc_id -> 片段在知识库中的顺序，分数相同时靠前的优先
+        self.postings = {}  # term -> {doc_id: tf}
+        self.total_length = 0
+
+    def update(self, chunks: list):
+        """
+        :return: (新增片段数, 删除片段数)
+        """
+        ids = [hashlib.sha1(chunk.encode("utf-8")).hexdigest() for chunk in chunks]
+        new_ids = set(ids)
+        removed = [doc_id for doc_id in self.docs if doc_id not in new_ids]
+        for doc_id in removed:
+            _, tf, length = self.docs.pop(doc_id)
+            self.total_length -= length
+            for term in tf:
+                posting = self.postings[term]
+                del posting[doc_id]
+                if not posting:
+                    del self.postings[term]
+        added = 0
+        for doc_id, chunk in zip(ids, chunks):
+            if doc_id in self.docs:
+                continue
+            terms = tokenize(chunk)
+            tf = Counter(terms)
+            self.docs[doc_id] = (chunk, tf, len(terms))
+            self.total_length += len(terms)
+            for term, freq in tf.items():
+                self.postings.setdefault(term, {})[doc_id] = freq
+            added += 1
+        self.order = {doc_id: i for i, doc_id in enumerate(ids)}
+        return added, len(removed)
+
+    def search(self, query: str, top_k=5) -> list:
+        if not self.docs:
+            return []
+        n = len(self.docs)
+        avg_length = self.total_length / n or 1
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                length = self.docs[doc_id][2]
+                score = idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_length))
+                scores[doc_id] = scores.get(doc_id, 0.0) + score
+        ranked = sorted(scores, key=lambda doc_id: (-scores[doc_id], self.order.get(doc_id, 0)))
+        return [self.docs[doc_id][0] for doc_id in ranked[:top_k]]
+
+
+@singleton
+class KnowledgeIndex(object):
+    """
+    每个知识库文件一个BM25索引，知识库版本变化时增量更新
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes = {}  # file_id -> Bm25Index
+        self.versions = {}  # file_id -> 已建立索引的知识库版本
+        KnowledgeCache().add_listener(self._on_knowledge_updated)
+
+    def search(self, query: str, top_k=None, file_id=None) -> list:
+        """
+        :return: 与query最相关的片段，按相关度从高到低排列
+        """
+        file_id = file_id or conf().get("knowledge_file_id") or DEFAULT_KNOWLEDGE_FILE_ID
+        entry = KnowledgeCache().get(file_id)
+        with self.lock:
+            index = self._ensure_index(file_id, entry)
+            return index.search(query, top_k or conf().get("knowledge_top_k", 5))
+
+    def _on_knowledge_updated(self, file_id, entry: KnowledgeEntry):
+        # 在知识库的后台刷新线程中更新索引，不占用提问时间
+        with self.lock:
+            self._ensure_index(file_id, entry)
+
+    def _ensure_index(self, file_id, entry: KnowledgeEntry) -> Bm25Index:
+        index = self.indexes.get(file_id)
+        if index is None:
+            index = self.indexes[file_id] = Bm25Index()
+        if self.versions.get(file_id) != entry.version:
+            chunks = split_chunks(entry.content, conf().get("knowledge_chunk_max_chars", 800))
+            added, removed = index.update(chunks)
+            self.versions[file_id] = entry.version
+            logger.info("[KnowledgeIndex] index updated, file_id={}, version={}, chunks={}, added={}, removed={}".format(file_id, entry.version, len(chunks), added, removed))
+        return index
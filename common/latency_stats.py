@@ -0,0 +1,51 @@
+from collections import deque
+
+
+class LatencyStats(object):
+    """
+    请求耗时统计，保留最近的耗时样本用于计算分位数
+    """
+
+    def __init__(self, max_samples=1000):
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.samples = deque(maxlen=max_samples)
+        self.outcomes = deque(maxlen=max_samples)  # 最近的请求是否出错，用于计算滚动错误率
+
+    def record(self, seconds, error=False):
+        self.count += 1
+        self.total_seconds += seconds
+        self.samples.append(seconds)
+        self.outcomes.append(bool(error))
+        if error:
+            self.errors += 1
+
+    def percentile(self, p):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    def error_rate(self) -> float:
+        outcomes = list(self.outcomes)
+        return sum(outcomes) / len(outcomes) if outcomes else 0.0
+
+    def summary(self) -> dict:
+        """
+        :return: {"count", "errors", "error_rate", "avg", "p50", "p95", "p99"}，耗时单位为秒，error_rate为最近样本的错误率
+        """
+        samples = sorted(self.samples)
+
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else 0.0
+
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "error_rate": self.error_rate(),
+            "avg": self.total_seconds / self.count if self.count else 0.0,
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+        }
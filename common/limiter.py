@@ -0,0 +1,232 @@
+"""
+LLM请求限流：全局并发上限 + 每个bot类型(provider)的RPM/TPM和AIMD并发窗口 + 每个API key的RPM/TPM
+所有限制都按时间戳计算，没有后台线程；同步调用在线程中等待，asyncio调用在事件循环中等待，并发名额释放时立即唤醒等待者
+并发窗口在遇到429/超时时减半，请求成功时逐步增大，避免持续触发服务商限流
+"""
+import asyncio
+import contextvars
+import threading
+import time
+
+from common import metrics
+from common.log import logger
+from common.singleton import singleton
+from common.token_bucket import TokenBucket
+from config import conf
+
+# 当前请求所属的(provider, api_key)，由Bridge设置，bot中上报429和token用量时无需传入
+_current_call = contextvars.ContextVar("llm_call", default=None)
+
+TOKENS = metrics.counter("cow_llm_tokens_total", "Tokens reported by chat bots", ["provider"])
+ACQUIRE_TIMEOUTS = metrics.counter("cow_llm_limit_timeouts_total", "Requests rejected after waiting for a limiter slot", ["provider"])
+
+
+class AimdWindow(object):
+    """
+    加性增、乘性减的并发窗口
+    """
+
+    def __init__(self, max_limit, min_limit=1, decrease_factor=0.5, decrease_interval=5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval  # 同一波限流只减一次窗口
+        self.limit = float(max_limit)
+        self.inflight = 0
+        self.last_decrease = 0.0
+
+    def available(self) -> bool:
+        return self.inflight < max(self.min_limit, int(self.limit))
+
+    def on_success(self):
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_overload(self):
+        now = time.monotonic()
+        if now - self.last_decrease < self.decrease_interval:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+
+
+class ProviderLimit(object):
+    def __init__(self, name, options: dict):
+        self.name = name
+        self.options = options
+        self.rpm = TokenBucket(options["rpm"]) if options.get("rpm") else None
+        self.tpm = TokenBucket(options["tpm"]) if options.get("tpm") else None
+        # 未配置并发窗口时以全局上限为准，只在遇到过载后收缩
+        self.window = AimdWindow(options.get("concurrency") or conf().get("llm_max_inflight", 64), options.get("min_concurrency", 1))
+        self.keys = {}  # api_key -> (rpm_bucket, tpm_bucket)
+
+    def key_buckets(self, api_key):
+        buckets = self.keys.get(api_key)
+        if buckets is None:
+            key_rpm = self.options.get("key_rpm")
+            key_tpm = self.options.get("key_tpm")
+            buckets = self.keys[api_key] = (TokenBucket(key_rpm) if key_rpm else None, TokenBucket(key_tpm) if key_tpm else None)
+        return buckets
+
+
+@singleton
+class Limiter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)  # 同步调用等待并发名额
+        self.async_waiters = set()  # (事件循环, future)，asyncio调用等待并发名额
+        self.providers = {}
+        self.inflight = 0
+
+    def provider(self, name) -> ProviderLimit:
+        limit = self.providers.get(name)
+        if limit is None:
+            limits = conf().get("llm_limits", {})
+            limit = self.providers[name] = ProviderLimit(name, limits.get(name) or limits.get("default") or {})
+        return limit
+
+    def _try_acquire(self, name, api_key):
+        """
+        调用方需持有self.lock
+        所有限制都满足时占用一个名额并返回0，否则不占用，返回建议等待的秒数，等待并发名额释放时返回None
+        """
+        limit = self.provider(name)
+        key_rpm, key_tpm = limit.key_buckets(api_key)
+        if self.inflight >= conf().get("llm_max_inflight", 64) or not limit.window.available():
+            return None
+        # TPM按欠账方式计算，桶里还有余额即可发起请求，结束后按实际用量扣除
+        buckets = [b for b in (limit.rpm, key_rpm, limit.tpm, key_tpm) if b]
+        wait = max([b.wait_time(1) for b in buckets], default=0)
+        if wait > 0:
+            return wait
+        for bucket in (limit.rpm, key_rpm):
+            if bucket:
+                bucket.try_acquire()
+        self.inflight += 1
+        limit.window.inflight += 1
+        return 0
+
+    def _timeout(self, name):
+        logger.warning("[Limiter] acquire timeout, provider={}".format(name))
+        ACQUIRE_TIMEOUTS.inc(provider=name)
+        return False
+
+    def acquire(self, name, api_key=None, timeout=None) -> bool:
+        """
+        阻塞等待直到可以发起请求，超时返回False
+        """
+        deadline = time.monotonic() + (timeout if timeout is not None else conf().get("llm_limit_timeout", 60))
+        with self.released:
+            while True:
+                wait = self._try_acquire(name, api_key)
+                if wait == 0:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self._timeout(name)
+                self.released.wait(remaining if wait is None else min(wait, remaining))
+
+    async def acquire_async(self, name, api_key=None, timeout=None) -> bool:
+        deadline = time.monotonic() + (timeout if timeout is not None else conf().get("llm_limit_timeout", 60))
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                wait = self._try_acquire(name, api_key)
+                if wait == 0:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self._timeout(name)
+                # 在持有锁时登记，release不会漏掉唤醒
+                waiter = (loop, loop.create_future())
+                self.async_waiters.add(waiter)
+            try:
+                await asyncio.wait([waiter[1]], timeout=remaining if wait is None else min(wait, remaining))
+            finally:
+                with self.lock:
+                    self.async_waiters.discard(waiter)
+
+    def release(self, name, success=None):
+        """
+        :param success: True请求成功，扩大并发窗口；False遇到过载，缩小并发窗口；None不调整
+        """
+        with self.lock:
+            limit = self.provider(name)
+            self.inflight -= 1
+            limit.window.inflight -= 1
+            if success:
+                limit.window.on_success()
+            elif success is False:
+                self._on_overload(limit)
+            self.released.notify_all()
+            waiters = list(self.async_waiters)
+            self.async_waiters.clear()
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:  # 事件循环已关闭
+                pass
+
+    def bind(self, name, api_key=None):
+        """
+        标记当前线程/协程中的请求属于哪个provider，返回值用于unbind
+        """
+        return _current_call.set((name, api_key))
+
+    def unbind(self, token):
+        _current_call.reset(token)
+
+    def report_overload(self):
+        """
+        bot遇到429或超时时调用，缩小当前provider的并发窗口
+        """
+        call = _current_call.get()
+        if call is None:
+            return
+        with self.lock:
+            self._on_overload(self.provider(call[0]))
+
+    def report_tokens(self, tokens):
+        """
+        bot拿到实际token用量后调用，计入TPM
+        """
+        call = _current_call.get()
+        if call is None or not tokens:
+            return
+        TOKENS.inc(tokens, provider=call[0])
+        with self.lock:
+            limit = self.provider(call[0])
+            _, key_tpm = limit.key_buckets(call[1])
+        for bucket in (limit.tpm, key_tpm):
+            if bucket:
+                bucket.consume(tokens)
+
+    def _on_overload(self, limit: ProviderLimit):
+        before = limit.window.limit
+        limit.window.on_overload()
+        if limit.window.limit != before:
+            logger.warning("[Limiter] provider {} overloaded, concurrency window {:.1f} -> {:.1f}".format(limit.name, before, limit.window.limit))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "inflight": self.inflight,
+                "providers": {name: {"inflight": p.window.inflight, "window": round(p.window.limit, 2)} for name, p in self.providers.items()},
+            }
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _collect_metrics():
+    stats = Limiter().stats()
+    providers = stats["providers"]
+    return [
+        ("cow_llm_inflight", "gauge", "Chat bot requests in flight", [({}, stats["inflight"])]),
+        ("cow_llm_provider_inflight", "gauge", "Chat bot requests in flight per provider", [({"provider": name}, p["inflight"]) for name, p in providers.items()]),
+        ("cow_llm_concurrency_window", "gauge", "Current AIMD concurrency window per provider", [({"provider": name}, p["window"]) for name, p in providers.items()]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
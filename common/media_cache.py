@@ -0,0 +1,77 @@
+"""
+已上传临时素材的缓存：按内容的SHA-256查找media_id，下载地址作为别名，重复发送相同的图片、语音时跳过下载、压缩和上传
+永久素材有数量上限，需要在发送后删除，不能放入缓存
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from common import metrics
+
+MEDIA_CACHE_REQUESTS = metrics.counter("cow_media_cache_requests_total", "Media upload cache lookups", ["cache", "result"])
+
+# 临时素材有效期为3天，提前1小时过期，避免发送时素材刚好失效
+TEMP_MEDIA_EXPIRES = 3 * 24 * 3600 - 3600
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_digest(storage) -> str:
+    """
+    计算文件对象的内容摘要，读取后回到开头
+    """
+    storage.seek(0)
+    value = digest(storage.read())
+    storage.seek(0)
+    return value
+
+
+class MediaCache(object):
+    def __init__(self, name, max_entries=500):
+        """
+        :param name: 用于日志和指标
+        :param max_entries: 最多缓存的素材数量，超出时淘汰最久未使用的
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (类型, 摘要) -> (media_id, 过期时间)
+        self.aliases = OrderedDict()  # (类型, 下载地址) -> 摘要
+
+    def get(self, kind, digest=None, url=None):
+        """
+        :return: 未过期的media_id，没有时返回None
+        """
+        with self.lock:
+            if digest is None and url is not None:
+                digest = self.aliases.get((kind, url))
+            entry = self.entries.get((kind, digest)) if digest is not None else None
+            if entry is not None and entry[1] <= time.time():
+                del self.entries[(kind, digest)]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end((kind, digest))
+                if url is not None:
+                    self.aliases[(kind, url)] = digest
+                    self.aliases.move_to_end((kind, url))
+        MEDIA_CACHE_REQUESTS.inc(cache=self.name, result="hit" if entry else "miss")
+        return entry[0] if entry else None
+
+    def put(self, kind, digest, media_id, expires_in, url=None):
+        with self.lock:
+            key = (kind, digest)
+            self.entries[key] = (media_id, time.time() + expires_in)
+            self.entries.move_to_end(key)
+            if url is not None:
+                self.aliases[(kind, url)] = digest
+                self.aliases.move_to_end((kind, url))
+            now = time.time()
+            while self.entries and next(iter(self.entries.values()))[1] <= now:  # 头部为最久未使用的素材，顺带清理已过期的
+                self.entries.popitem(last=False)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            while len(self.aliases) > 2 * self.max_entries:
+                self.aliases.popitem(last=False)
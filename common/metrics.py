@@ -0,0 +1,305 @@
+"""
+进程内的指标注册表：计数器、直方图、仪表盘，可选通过HTTP以Prometheus文本格式暴露(/metrics)
+计数器和直方图按线程分片记录，记录时不加锁，采集时再把各线程的分片相加
+队列长度等当前值用回调函数在采集时计算，热路径上没有额外开销
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common.log import logger
+
+# 默认的耗时分桶，单位秒，覆盖从插件的毫秒级处理到LLM请求的分钟级耗时
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items()) + "}"
+
+
+class _ShardedMetric(object):
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()  # 只在线程首次记录时使用
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> dict:
+        return dict(zip(self.labelnames, key))
+
+    def _snapshots(self):
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            yield dict(shard)
+
+
+class Counter(_ShardedMetric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def collect(self) -> dict:
+        """
+        :return: {标签值元组: 累计值}
+        """
+        totals = {}
+        for shard in self._snapshots():
+            for key, value in shard.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self) -> list:
+        return ["{}{} {}".format(self.name, _format_labels(self._labels(key)), value) for key, value in sorted(self.collect().items())]
+
+
+class Histogram(_ShardedMetric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self._observe(value, self._key(labels))
+
+    def labels(self, **labels) -> "_BoundHistogram":
+        """
+        预先计算标签，热路径上重复记录同一组标签时使用
+        """
+        return _BoundHistogram(self, self._key(labels))
+
+    def _observe(self, value, key):
+        shard = self._shard()
+        data = shard.get(key)
+        if data is None:
+            data = shard[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # [各分桶计数(最后一个为+Inf), 总和, 次数]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self) -> dict:
+        """
+        :return: {标签值元组: (各分桶计数, 总和, 次数)}
+        """
+        totals = {}
+        for shard in self._snapshots():
+            for key, (counts, total, count) in shard.items():
+                merged = totals.get(key)
+                if merged is None:
+                    totals[key] = (list(counts), total, count)
+                else:
+                    totals[key] = ([a + b for a, b in zip(merged[0], counts)], merged[1] + total, merged[2] + count)
+        return totals
+
+    def quantile(self, q, **labels) -> float:
+        """
+        按分桶估算分位数，返回所在分桶的上界
+        """
+        data = self.collect().get(self._key(labels))
+        if not data or not data[2]:
+            return 0.0
+        rank = q * data[2]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), data[0]):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> list:
+        lines = []
+        for key, (counts, total, count) in sorted(self.collect().items()):
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(dict(labels, le=le)), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(labels), total))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(labels), count))
+        return lines
+
+
+class _BoundHistogram(object):
+    def __init__(self, metric: Histogram, key: tuple):
+        self.metric = metric
+        self.key = key
+
+    def observe(self, value):
+        self.metric._observe(value, self.key)
+
+
+class Gauge(object):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        """
+        :param func: 采集时调用，返回当前值；不传时用set设置
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self.values = {}
+
+    def set(self, value, **labels):
+        self.values[tuple(str(labels.get(name, "")) for name in self.labelnames)] = value
+
+    def render(self) -> list:
+        if self.func is not None:
+            return ["{} {}".format(self.name, self.func())]
+        return ["{}{} {}".format(self.name, _format_labels(dict(zip(self.labelnames, key))), value) for key, value in sorted(list(self.values.items()))]
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = []
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def register_collector(self, func):
+        """
+        :param func: 采集时调用，返回 [(指标名, 类型, 说明, [(标签dict, 值)])]，用于把已有模块的统计数据转换成指标
+        """
+        with self.lock:
+            self.collectors.append(func)
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors)
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.render()
+            except Exception as e:
+                logger.warning("[Metrics] collect {} failed: {}".format(metric.name, e))
+                continue
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            lines.extend(samples)
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logger.warning("[Metrics] collector {} failed: {}".format(getattr(collector, "__name__", collector), e))
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append("# HELP {} {}".format(name, documentation))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                for labels, value in samples:
+                    lines.append("{}{} {}".format(name, _format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()) -> Counter:
+    return REGISTRY._get_or_create(Counter, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+
+def gauge(name, documentation, labelnames=(), func=None) -> Gauge:
+    return REGISTRY._get_or_create(Gauge, name, documentation, labelnames, func)
+
+
+def register_collector(func):
+    REGISTRY.register_collector(func)
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+def timed(metric: Histogram, **labels):
+    """
+    记录函数耗时的装饰器
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with metric.time(**labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def start_server(port, host="0.0.0.0"):
+    """
+    在后台线程中启动/metrics接口，与消息通道无关，任何channel都可以开启
+    """
+    global _server
+    if _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("[Metrics] serving metrics on http://{}:{}/metrics".format(host, port))
+    return _server
@@ -0,0 +1,155 @@
+"""
+bot调用的重试策略：指数退避 + 随机抖动，避免大量请求在同一时刻重试
+请求带有截止时间(如公众号被动回复的15秒窗口)时，来不及完成的重试直接放弃
+asyncio引擎下用asyncio.sleep等待，等待期间不占用线程
+"""
+import asyncio
+import contextvars
+import random
+import time
+
+from common.limiter import Limiter
+from common.log import logger
+
+# 当前请求的截止时间(time.time()时间戳)，由Bridge根据context["deadline"]设置
+_deadline = contextvars.ContextVar("reply_deadline", default=None)
+
+
+class RetryableError(Exception):
+    """
+    bot在遇到可重试的失败响应(如5xx、429)时抛出
+    """
+
+    def __init__(self, message, status=None, delay=None):
+        super().__init__(message)
+        self.status = status
+        self.delay = delay  # 服务端建议的等待秒数(Retry-After)
+
+
+def bind_deadline(deadline):
+    """
+    :param deadline: time.time()时间戳，None表示不限
+    :return: 用于reset_deadline的token
+    """
+    return _deadline.set(deadline)
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+def remaining_time():
+    """
+    :return: 距截止时间的秒数，没有截止时间时返回None
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def classify(e: Exception):
+    """
+    判断异常是否值得重试
+    :return: None不可重试，"overload"限流或超时(需要同时缩小并发窗口)，"error"其他临时性错误
+    """
+    if isinstance(e, RetryableError):
+        return "overload" if e.status == 429 else "error"
+    status = getattr(e, "status_code", None) or getattr(e, "http_status", None)
+    if isinstance(status, int):
+        if status == 429:
+            return "overload"
+        if status >= 500:
+            return "error"
+    names = [cls.__name__ for cls in type(e).__mro__]
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)) or any("Timeout" in name or "RateLimit" in name for name in names):
+        return "overload"
+    if isinstance(e, ConnectionError) or any("Connection" in name for name in names):
+        return "error"
+    return None
+
+
+class RetryPolicy(object):
+    """
+    :param max_retries: 最多重试次数
+    :param base_delay: 首次重试的退避时间，之后每次翻倍
+    :param max_delay: 单次退避时间上限
+    :param overload_delay: 遇到限流或超时时的首次退避时间
+    :param min_attempt_time: 距截止时间不足退避时间加上该值时不再重试
+    :param hedge_bot: 主bot响应慢时同时请求的备用bot类型，None表示不对冲
+    :param hedge_delay: 等待多少秒后发起对冲请求，None表示按主bot最近的p95耗时
+    :param hedge_min_delay: 按p95计算时的最小等待秒数
+    """
+
+    def __init__(self, name="", max_retries=2, base_delay=1.0, max_delay=20.0, overload_delay=5.0, min_attempt_time=2.0, hedge_bot=None, hedge_delay=None, hedge_min_delay=3.0):
+        self.name = name
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.overload_delay = overload_delay
+        self.min_attempt_time = min_attempt_time
+        self.hedge_bot = hedge_bot
+        self.hedge_delay = hedge_delay
+        self.hedge_min_delay = hedge_min_delay
+
+    def backoff(self, attempt, kind="error", hint=None) -> float:
+        """
+        等值抖动：在[上限/2, 上限]之间随机，既打散重试时间又保证有足够的退避
+        """
+        base = self.overload_delay if kind == "overload" else self.base_delay
+        cap = min(self.max_delay, base * (2**attempt))
+        delay = cap / 2 + random.uniform(0, cap / 2)
+        if hint:
+            delay = max(delay, min(self.max_delay, hint))
+        return delay
+
+    def next_delay(self, attempt, e: Exception):
+        """
+        :return: 下次重试前的等待秒数，不应再重试时返回None
+        """
+        kind = classify(e)
+        if kind is None:
+            return None
+        if kind == "overload":
+            Limiter().report_overload()
+            e.overload_reported = True  # 异常最终抛给Bridge时不再重复缩小并发窗口
+        if attempt >= self.max_retries:
+            logger.warn("[Retry] {} failed after {} retries: {}".format(self.name, attempt, e))
+            return None
+        delay = self.backoff(attempt, kind, getattr(e, "delay", None))
+        remaining = remaining_time()
+        if remaining is not None and remaining < delay + self.min_attempt_time:
+            logger.warn("[Retry] {} give up retry, {:.1f}s left before deadline: {}".format(self.name, remaining, e))
+            return None
+        logger.warn("[Retry] {} retry {} in {:.1f}s: {}".format(self.name, attempt + 1, delay, e))
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        """
+        调用func，遇到可重试的异常时退避后重试，重试用尽或不可重试时抛出最后一次的异常
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                delay = self.next_delay(attempt, e)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, func, *args, **kwargs):
+        """
+        :param func: 返回协程的函数，每次重试重新调用
+        """
+        attempt = 0
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                delay = self.next_delay(attempt, e)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
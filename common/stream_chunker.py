@@ -0,0 +1,42 @@
+"""
+把LLM流式输出的增量文本切分成句子或段落大小的片段，凑够一句/一段就立即交给渠道发送
+"""
+
+SENTENCE_ENDS = "。！？!?；;…\n"
+PARAGRAPH_ENDS = "\n"
+
+
+def iter_chunks(deltas, mode="sentence", min_chars=10, max_chars=500):
+    """
+    :param deltas: 增量文本的迭代器
+    :param mode: sentence按句切分，paragraph按段切分
+    :param min_chars: 片段的最少字数，避免切出过短的片段
+    :param max_chars: 迟迟没有遇到分隔符时，缓冲超过该长度也强制切出
+    :return: 片段迭代器，片段首尾保留原始空白，拼接后即为完整文本
+    """
+    ends = PARAGRAPH_ENDS if mode == "paragraph" else SENTENCE_ENDS
+    buffer = ""
+    for delta in deltas:
+        if not delta:
+            continue
+        buffer += delta
+        while True:
+            cut = _find_cut(buffer, ends, min_chars)
+            if cut <= 0 and len(buffer) >= max_chars:
+                cut = max_chars
+            if cut <= 0:
+                break
+            chunk, buffer = buffer[:cut], buffer[cut:]
+            yield chunk
+    if buffer:
+        yield buffer
+
+
+def _find_cut(buffer, ends, min_chars):
+    # 在min_chars之后找最后一个分隔符，连续的分隔符一起切出
+    for i in range(len(buffer) - 1, min_chars - 2, -1):
+        if i < 0:
+            break
+        if buffer[i] in ends:
+            return i + 1
+    return 0
@@ -1,39 +1,86 @@
+import asyncio
 import threading
 import time
 
 
 class TokenBucket:
-    def __init__(self, tpm, timeout=None):
-        self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
+    """
+    令牌桶，根据上次取令牌以来经过的时间计算补充的令牌数，不需要后台线程
+    令牌数允许为负（先用后补），用于请求结束后才知道实际消耗量的场景（如TPM）
+    """
+
+    def __init__(self, tpm, timeout=None, capacity=None):
+        self.capacity = int(capacity or tpm)  # 令牌桶容量
+        self.tokens = float(self.capacity)  # 初始为满桶，允许突发
         self.rate = int(tpm) / 60  # 令牌每秒生成速率
         self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount=1) -> float:
+        """
+        返回还需等待多少秒才有amount个令牌，不消耗令牌
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= amount:
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def try_acquire(self, amount=1) -> float:
+        """
+        令牌足够时立即扣除并返回0，否则不扣除，返回需要等待的秒数
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        """
+        直接扣除令牌，令牌不足时记为欠账，后续请求需等待补足
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
 
     def get_token(self):
         """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:  # 超时
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    async def get_token_async(self):
+        """asyncio中获取令牌，等待期间不占用线程"""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
                     return False
-            self.tokens -= 1
-        return True
+                wait = min(wait, remaining)
+            await asyncio.sleep(wait)
 
     def close(self):
-        self.is_running = False
+        # 没有后台线程，保留接口兼容旧代码
+        pass
 
 
 if __name__ == "__main__":
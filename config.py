@@ -26,6 +26,9 @@ available_setting = {
     "single_chat_prefix": ["bot", "@bot"],  # 私聊时文本需要包含该前缀才能触发机器人回复
     "single_chat_reply_prefix": "[bot] ",  # 私聊时自动回复的前缀，用于区分真人
     "single_chat_reply_suffix": "",  # 私聊时自动回复的后缀，\n 可以换行
+    "stream_reply": False,  # 是否流式回复，边生成边按句/段发送，需要bot支持
+    "stream_chunk_mode": "paragraph",  # 流式回复的切分方式，sentence按句，paragraph按段
+    "stream_min_chars": 20,  # 流式回复每个片段的最少字数
     "group_chat_prefix": ["@bot"],  # 群聊时包含该前缀则会触发机器人回复
     "group_chat_reply_prefix": "",  # 群聊时自动回复的前缀
     "group_chat_reply_suffix": "",  # 群聊时自动回复的后缀，\n 可以换行
@@ -48,22 +51,62 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "message_merge_window": 0,  # 合并同一会话连续发送的文本消息，窗口内没有新消息才请求bot，单位秒，0表示不合并
+    "message_merge_max_wait": 10,  # 合并消息时最长等待时间，单位秒
+    "handler_engine": "thread",  # 消息处理引擎，thread为固定大小线程池，asyncio为事件循环，LLM请求不占用线程
+    "async_max_inflight": 256,  # asyncio引擎下同时处理中的消息数上限
+    "async_blocking_workers": 8,  # asyncio引擎下执行插件、发送等阻塞调用的线程数
+    "send_pipeline": False,  # 是否开启发送流水线，回复引用的图片、文件并发上传、按顺序发送，失败重试不占用处理消息的线程；开启后附件在消息处理结束后异步发送
+    "send_workers": 4,  # 发送流水线中准备(上传、压缩、转换)和发送的线程数
+    "send_queue_size": 20,  # 每个接收者在发送流水线中最多排队的回复数，超出时等待
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_max_count": 0,  # 最多保存的会话数，超出时淘汰最久未使用的会话，0表示不限制
+    "session_store": "",  # 会话历史持久化存储，支持memory, sqlite, redis，为空则只保存在内存中
+    "session_store_path": "sessions",  # sqlite存储目录(相对appdata_dir)
+    "session_store_shards": 4,  # sqlite存储分片数
+    "session_store_redis_url": "redis://localhost:6379/0",  # redis存储地址
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
+    # LLM请求限流，所有bot共用
+    "llm_max_inflight": 64,  # 所有bot同时进行中的请求数上限
+    "llm_limit_timeout": 60,  # 等待限流名额的最长时间，单位秒，超时直接回复提问太快
+    # 按bot类型配置的限流，default对未配置的bot生效，例如 {"glm-4-air": {"rpm": 60, "tpm": 200000, "key_rpm": 30, "key_tpm": 100000, "concurrency": 8}}
+    # rpm/tpm为每分钟请求数/token数，key_rpm/key_tpm为每个api key的限制，concurrency为并发窗口上限(不配置时等于llm_max_inflight)，遇到429或超时时自动减半
+    "llm_limits": {},
+    # 按bot类型配置的重试和对冲策略，default对所有bot生效，例如 {"glm-4-air": {"max_retries": 2, "base_delay": 2, "hedge_bot": "moonshot", "hedge_delay": 8}}
+    # 重试按指数退避并随机抖动，超过请求截止时间(如公众号被动回复的15秒)不再重试；配置hedge_bot后主bot超过hedge_delay(默认按最近p95耗时)未回复时同时请求备用bot，先返回的结果生效
+    # 对冲只用于文本提问，两个请求都在临时会话中执行，只有生效的回答写入会话历史；流式回复、#开头的指令、配置了router_bots时不对冲；
+    # 会自行向用户推送消息或在服务端保存对话的bot(linkai、claude网页版)不参与对冲
+    "retry_policies": {},
+    # 多bot路由，配置两个以上bot类型时按最近的耗时和错误率选择bot，失败时自动切换，切换时迁移会话历史，例如 ["glm-4-air", "moonshot", "qwen-plus"]
+    "router_bots": [],
+    "router_window": 100,  # 统计耗时和错误率的最近请求数
+    "router_min_samples": 5,  # 样本数不足时优先尝试该bot
+    "router_max_error_rate": 0.5,  # 最近错误率超过该值的bot暂时熔断
+    "router_failure_threshold": 3,  # 连续失败次数达到该值的bot暂时熔断
+    "router_cooldown": 30,  # 熔断时长，单位秒，之后放行请求试探是否恢复
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
     "top_p": 1,
     "frequency_penalty": 0,
     "presence_penalty": 0,
     "request_timeout": 180,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
+    "http_connect_timeout": 5,  # bot后端HTTP请求的连接超时时间，读取超时使用request_timeout
+    "http_pool_maxsize": 20,  # 每个后端host保持的长连接数
+    "http_pool_max_hosts": 16,  # 最多为多少个后端host建立连接池，超出的host不复用连接，耗时统计合并为other
+    "http2": False,  # 是否使用HTTP/2请求bot后端，需要安装httpx[http2]
+    "metrics_port": 0,  # Prometheus格式指标接口(/metrics)的端口，0表示不开启，所有channel都可用
+    "metrics_host": "0.0.0.0",  # 指标接口监听的地址
+    "plugin_time_budget": 0,  # 插件处理单个事件的时间预算，单位秒，超出时记录日志，0表示不检查
+    "plugin_slow_limit": 3,  # 插件连续超出时间预算的次数达到该值时执行plugin_slow_action
+    "plugin_slow_action": "log",  # 慢插件的处理方式：log只记录，disable临时禁用(#enablep恢复)，offload移到后台线程执行(插件对消息的修改不再生效)
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
     # Baidu 文心一言参数
     "baidu_wenxin_model": "eb-instant",  # 默认使用ERNIE-Bot-turbo模型
@@ -124,6 +167,11 @@ available_setting = {
     "hot_reload": False,  # 是否开启热重载
     # wechaty的配置
     "wechaty_puppet_service_token": "",  # wechaty的token
+    # 回调类渠道(wechatmp、wechatcomapp、feishu)的HTTP服务配置
+    "webhook_server": "webpy",  # webpy为web.py单进程服务器，aiohttp为异步服务器，需要安装aiohttp
+    "webhook_workers": 16,  # aiohttp服务器中执行验签、解密、生成context的线程数
+    "webhook_max_inflight": 4096,  # aiohttp服务器同时处理(含等待回复)的最大请求数，超出时排队
+    "media_cache_max_entries": 500,  # wechatmp主动回复、wechatcomapp缓存的已上传临时素材数量，内容相同时复用media_id；公众号被动回复的永久素材发送后即删除，不缓存
     # wechatmp的配置
     "wechatmp_token": "",  # 微信公众平台的Token
     "wechatmp_port": 8080,  # 微信公众平台的端口,需要端口转发到80或443
@@ -162,9 +210,22 @@ available_setting = {
     "use_global_plugin_config": False,
     "max_media_send_count": 3,  # 单次最大发送媒体资源的个数
     "media_send_interval": 1,  # 发送图片的事件间隔，单位秒
+    "attachment_refresh_interval": 5,  # 检查./images和./files目录变化的间隔，单位秒
     # 智谱AI 平台配置
     "zhipu_ai_api_key": "",
     "zhipu_ai_api_base": "https://open.bigmodel.cn/api/paas/v4",
+    "knowledge_file_id": "1736833122_c97254d492df4115b80ea72d4092d4e6",  # 智谱AI上已上传的知识库文件id
+    "knowledge_refresh_seconds": 600,  # 知识库缓存过期时间，过期后在后台刷新
+    "knowledge_cache_dir": "knowledge",  # 知识库磁盘缓存目录(相对appdata_dir)，为空则不落盘
+    "knowledge_retrieval": False,  # 是否只把与问题最相关的知识库片段放进prompt(本地BM25检索)，关闭时放入整个知识库
+    "knowledge_top_k": 5,  # 检索时放进prompt的片段数
+    "knowledge_chunk_max_chars": 800,  # 知识库切分片段的最大字数
+    "reply_cache": False,  # 是否开启回复缓存，相同或相近的问题直接返回之前的回答
+    "reply_cache_ttl": 3600,  # 回复缓存过期时间，单位秒
+    "reply_cache_max_size": 2000,  # 回复缓存最多保存的问题数
+    "reply_cache_min_length": 4,  # 去掉标点后少于该字数的问题不使用回复缓存，如"好的"、"继续"
+    "reply_cache_threshold": 0.8,  # 相近问题的相似度阈值(字符2-gram的Jaccard相似度)
+    "reply_cache_bypass_sessions": [],  # 不使用回复缓存的session_id
     "moonshot_api_key": "",
     "moonshot_base_url": "https://api.moonshot.cn/v1/chat/completions",
     # LinkAI平台配置
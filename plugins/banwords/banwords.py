@@ -9,7 +9,7 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from plugins import *
 
-from .lib.WordsSearch import WordsSearch
+from common.words_search import WordsSearch
 
 
 @plugins.register(
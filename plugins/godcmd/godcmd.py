@@ -92,6 +92,10 @@ ADMIN_COMMANDS = {
         "alias": ["plist", "插件"],
         "desc": "打印当前插件列表",
     },
+    "pstats": {
+        "alias": ["pstats", "插件耗时"],
+        "desc": "打印各插件处理每类事件的耗时统计",
+    },
     "setpri": {
         "alias": ["setpri", "设置插件优先级"],
         "args": ["插件名", "优先级"],
@@ -362,6 +366,8 @@ class Godcmd(Plugin):
                                     result += "已启用\n"
                                 else:
                                     result += "未启用\n"
+                        elif cmd == "pstats":
+                            ok, result = True, PluginManager().timing_report()
                         elif cmd == "scanp":
                             new_plugins = PluginManager().scan_plugins()
                             ok, result = True, "插件扫描完成"
@@ -5,7 +5,12 @@ import importlib.util
 import json
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from common import metrics
+from common.latency_stats import LatencyStats
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
@@ -13,6 +18,24 @@ from config import conf, write_plugin_config
 
 from .event import *
 
+PLUGIN_SECONDS = metrics.histogram("cow_plugin_seconds", "Time spent in each plugin event handler", ["plugin", "event"])
+PLUGIN_SLOW = metrics.counter("cow_plugin_slow_total", "Plugin handler calls exceeding plugin_time_budget", ["plugin", "event"])
+
+_offload_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="plugin-offload")  # 执行被移出消息处理流程的慢插件
+
+
+class PluginTiming(object):
+    """
+    单个插件处理单个事件的耗时统计
+    """
+
+    def __init__(self, name=None, event=None):
+        self.latency = LatencyStats(max_samples=200)
+        self.seconds = PLUGIN_SECONDS.labels(plugin=name, event=event.name if event else None)
+        self.max_seconds = 0.0
+        self.slow = 0  # 超出时间预算的次数
+        self.consecutive_slow = 0
+
 
 @singleton
 class PluginManager:
@@ -23,6 +46,12 @@ class PluginManager:
         self.pconf = {}
         self.current_plugin_path = None
         self.loaded = {}
+        self.timings = {}  # (插件名, 事件) -> PluginTiming
+        self.offloaded = set()  # 因超时被移出消息处理流程的(插件名, 事件)，在后台线程中执行
+        # 事件 -> ((插件名, handler, PluginTiming, 是否移到后台), ...)，只包含已开启的插件并按优先级排列
+        # 插件开启、禁用、调整优先级、重载时整体重建后替换，emit_event直接遍历，不查字典也不加锁
+        self.dispatch = {}
+        self.dispatch_lock = threading.Lock()
 
     def register(self, name: str, desire_priority: int = 0, **kwargs):
         def wrapper(plugincls):
@@ -136,6 +165,24 @@ class PluginManager:
     def refresh_order(self):
         for event in self.listening_plugins.keys():
             self.listening_plugins[event].sort(key=lambda name: self.plugins[name].priority, reverse=True)
+        self._rebuild_dispatch()
+
+    def _rebuild_dispatch(self):
+        with self.dispatch_lock:
+            dispatch = {}
+            for event, names in self.listening_plugins.items():
+                entries = []
+                for name in names:
+                    plugincls = self.plugins.get(name)
+                    instance = self.instances.get(name)
+                    if plugincls is None or not plugincls.enabled or instance is None or event not in instance.handlers:
+                        continue
+                    timing = self.timings.get((name, event))
+                    if timing is None:
+                        timing = self.timings[(name, event)] = PluginTiming(name, event)
+                    entries.append((name, instance.handlers[event], timing, (name, event) in self.offloaded))
+                dispatch[event] = tuple(entries)
+            self.dispatch = dispatch
 
     def activate_plugins(self):  # 生成新开启的插件实例
         failed_plugins = []
@@ -155,7 +202,8 @@ class PluginManager:
                 for event in instance.handlers:
                     if event not in self.listening_plugins:
                         self.listening_plugins[event] = []
-                    self.listening_plugins[event].append(name)
+                    if name not in self.listening_plugins[event]:  # 重新生成实例时不重复注册
+                        self.listening_plugins[event].append(name)
         self.refresh_order()
         return failed_plugins
 
@@ -183,17 +231,91 @@ class PluginManager:
         self.activate_plugins()
 
     def emit_event(self, e_context: EventContext, *args, **kwargs):
-        if e_context.event in self.listening_plugins:
-            for name in self.listening_plugins[e_context.event]:
-                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
-                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
-                    instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
-                    if e_context.is_break():
-                        e_context["breaked_by"] = name
-                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        budget = conf().get("plugin_time_budget", 0)
+        for name, handler, timing, offloaded in self.dispatch.get(e_context.event, ()):
+            if e_context.action != EventAction.CONTINUE:
+                break
+            logger.debug("Plugin %s triggered by event %s", name, e_context.event)
+            if offloaded:
+                self._offload(name, handler, e_context, args, kwargs)
+                continue
+            start = time.perf_counter()
+            try:
+                handler(e_context, *args, **kwargs)
+            finally:
+                self._record_timing(name, e_context.event, timing, time.perf_counter() - start, budget)
+            if e_context.is_break():
+                e_context["breaked_by"] = name
+                logger.debug("Plugin %s breaked event %s", name, e_context.event)
         return e_context
 
+    def _record_timing(self, name, event, timing: PluginTiming, seconds, budget):
+        # 并发写入时计数可能有极小误差，换取热路径上不加锁
+        timing.seconds.observe(seconds)
+        timing.latency.record(seconds)
+        if seconds > timing.max_seconds:
+            timing.max_seconds = seconds
+        if not 0 < budget < seconds:
+            timing.consecutive_slow = 0
+            return
+        timing.slow += 1
+        timing.consecutive_slow += 1
+        PLUGIN_SLOW.inc(plugin=name, event=event.name)
+        logger.warning("[PluginManager] plugin {} took {:.3f}s on {}, exceeding budget {}s".format(name, seconds, event.name, budget))
+        if timing.consecutive_slow >= conf().get("plugin_slow_limit", 3):
+            timing.consecutive_slow = 0
+            self._on_slow_plugin(name, event)
+
+    def _on_slow_plugin(self, name, event):
+        """
+        插件连续超出时间预算时按plugin_slow_action处理：log只记录日志，disable临时禁用插件，offload把该事件的处理移到后台线程
+        """
+        action = conf().get("plugin_slow_action", "log")
+        if action == "disable" and name != "GODCMD":
+            if self.plugins[name].enabled:
+                self.plugins[name].enabled = False  # 只在内存中禁用，可通过#enablep恢复
+                self._rebuild_dispatch()
+                logger.warning("[PluginManager] plugin {} is too slow, disabled until enabled again".format(name))
+        elif action == "offload" and name != "GODCMD":
+            if (name, event) not in self.offloaded:
+                self.offloaded.add((name, event))
+                self._rebuild_dispatch()
+                logger.warning("[PluginManager] plugin {} is too slow on {}, moved off the message path".format(name, event.name))
+
+    def _offload(self, name, handler, e_context: EventContext, args, kwargs):
+        # 后台执行时插件对事件的修改不再影响消息处理，只适合记录、统计类插件
+        background_context = EventContext(e_context.event, dict(e_context.econtext))
+
+        def run():
+            start = time.perf_counter()
+            try:
+                handler(background_context, *args, **kwargs)
+            except Exception as e:
+                logger.warning("[PluginManager] offloaded plugin {} failed: {}".format(name, e))
+            finally:
+                seconds = time.perf_counter() - start
+                PLUGIN_SECONDS.observe(seconds, plugin=name, event=e_context.event.name)
+
+        _offload_pool.submit(run)
+
+    def timing_report(self) -> str:
+        """
+        :return: 按累计耗时从高到低排列的插件耗时统计
+        """
+        items = [(name, event, timing.latency.summary(), timing.latency.total_seconds, timing.max_seconds, timing.slow) for (name, event), timing in list(self.timings.items()) if timing.latency.count]
+        if not items:
+            return "暂无插件耗时数据"
+        items.sort(key=lambda item: item[3], reverse=True)
+        lines = ["插件耗时统计(毫秒)："]
+        for name, event, summary, total, max_seconds, slow in items:
+            line = "{} {}: 次数{} 平均{:.1f} p95 {:.1f} 最大{:.1f}".format(name, event.name, summary["count"], summary["avg"] * 1000, summary["p95"] * 1000, max_seconds * 1000)
+            if slow:
+                line += " 超时{}次".format(slow)
+            if (name, event) in self.offloaded:
+                line += " [已移出处理流程]"
+            lines.append(line)
+        return "\n".join(lines)
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
@@ -213,6 +335,9 @@ class PluginManager:
         name = name.upper()
         if name not in self.plugins:
             return False, "插件不存在"
+        if any(key[0] == name for key in self.offloaded):  # 重新启用时恢复被移出的事件处理
+            self.offloaded = {key for key in self.offloaded if key[0] != name}
+            self._rebuild_dispatch()
         if not self.plugins[name].enabled:
             self.plugins[name].enabled = True
             rawname = self.plugins[name].name
@@ -230,6 +355,7 @@ class PluginManager:
             return False
         if self.plugins[name].enabled:
             self.plugins[name].enabled = False
+            self._rebuild_dispatch()
             rawname = self.plugins[name].name
             self.pconf["plugins"][rawname]["enabled"] = False
             self.save_config()
@@ -0,0 +1,93 @@
+# encoding:utf-8
+"""
+emit_event基准测试：加载20个空插件，对比预先生成的事件分发表与逐条查找插件的耗时
+用法: python3 scripts/bench_emit_event.py [插件数] [次数]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from config import conf  # noqa: E402
+from plugins import Event, EventAction, EventContext, Plugin, PluginManager  # noqa: E402
+from plugins.plugin_manager import PLUGIN_SECONDS, PluginTiming  # noqa: E402
+
+
+def build_plugins(pm: PluginManager, count):
+    for i in range(count):
+        name = "BENCH{}".format(i)
+
+        class BenchPlugin(Plugin):
+            def __init__(self):
+                super().__init__()
+                for event in Event:
+                    self.handlers[event] = self.on_event
+
+            def on_event(self, e_context: EventContext):
+                pass
+
+        BenchPlugin.name = name
+        BenchPlugin.priority = i
+        BenchPlugin.enabled = i % 10 != 9  # 部分插件禁用，与实际情况一致
+        pm.plugins[name] = BenchPlugin
+        instance = BenchPlugin()
+        pm.instances[name] = instance
+        for event in instance.handlers:
+            pm.listening_plugins.setdefault(event, []).append(name)
+    pm.refresh_order()
+
+
+def legacy_emit_event(pm: PluginManager, e_context: EventContext, *args, **kwargs):
+    # 改动前的实现：每条消息都查找插件是否开启、实例和handler
+    if e_context.event in pm.listening_plugins:
+        for name in pm.listening_plugins[e_context.event]:
+            if pm.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
+                instance = pm.instances[name]
+                handler = instance.handlers[e_context.event]
+                if (name, e_context.event) in pm.offloaded:
+                    continue
+                start = time.perf_counter()
+                try:
+                    handler(e_context, *args, **kwargs)
+                finally:
+                    legacy_record_timing(pm, name, e_context.event, time.perf_counter() - start)
+    return e_context
+
+
+def legacy_record_timing(pm: PluginManager, name, event, seconds):
+    PLUGIN_SECONDS.observe(seconds, plugin=name, event=event.name)
+    budget = conf().get("plugin_time_budget", 0)
+    slow = 0 < budget < seconds
+    with pm.timings_lock:
+        timing = pm.timings.get((name, event))
+        if timing is None:
+            timing = pm.timings[(name, event)] = PluginTiming()
+        timing.latency.record(seconds)
+        timing.max_seconds = max(timing.max_seconds, seconds)
+        if not slow:
+            timing.consecutive_slow = 0
+
+
+def bench(label, func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(EventContext(Event.ON_HANDLE_CONTEXT, {"context": None, "reply": None}))
+    elapsed = time.perf_counter() - start
+    print("{:<10} {:>8.2f} us/event".format(label, elapsed / rounds * 1e6))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    pm = PluginManager()
+    build_plugins(pm, count)
+    pm.timings_lock = threading.Lock()  # 仅供改动前的实现使用
+    print("{} plugins, {} events".format(count, rounds))
+    bench("legacy", lambda e_context: legacy_emit_event(pm, e_context), rounds)
+    bench("dispatch", pm.emit_event, rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# encoding:utf-8
+"""
+token计数基准测试：对比改动前每次调用都解析编码的实现与缓存编码、批量编码的耗时
+用法: python3 scripts/bench_token_count.py [会话数]
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bot.chatgpt.chat_gpt_session import count_message_tokens, num_tokens_by_character, num_tokens_from_messages  # noqa: E402
+from common import const  # noqa: E402
+from common.log import logger  # noqa: E402
+
+MODEL = "gpt-35-turbo"
+WORDS = ["洗鞋柜", "续费", "商户号", "后台管理系统", "柜体管理", "the", "cabinet", "renew", "merchant", "account", "？", "。"]
+
+
+def random_text(n):
+    return "".join(random.choice(WORDS) for _ in range(n))
+
+
+def build_histories(count):
+    histories = []
+    for _ in range(count):
+        history = [{"role": "system", "content": random_text(200)}]
+        for _ in range(20):
+            history.append({"role": "user", "content": random_text(random.randint(5, 40))})
+            history.append({"role": "assistant", "content": random_text(random.randint(20, 120))})
+        histories.append(history)
+    return histories
+
+
+def legacy_num_tokens_from_messages(messages, model):
+    # 改动前的实现：每次调用都通过tiktoken.encoding_for_model解析编码
+    if model in ["wenxin", "xunfei", const.GEMINI]:
+        return num_tokens_by_character(messages)
+
+    import tiktoken
+
+    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
+        return legacy_num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+                   "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
+                   const.GPT_4o, const.LINKAI_4o, const.LINKAI_4_TURBO]:
+        return legacy_num_tokens_from_messages(messages, model="gpt-4")
+    elif model.startswith("claude-3"):
+        return legacy_num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.debug("Warning: model not found. Using cl100k_base encoding.")
+        encoding = tiktoken.get_encoding("cl100k_base")
+    if model == "gpt-3.5-turbo":
+        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+        tokens_per_name = -1  # if there's a name, the role is omitted
+    elif model == "gpt-4":
+        tokens_per_message = 3
+        tokens_per_name = 1
+    else:
+        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+        return legacy_num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+    num_tokens = 0
+    for message in messages:
+        num_tokens += tokens_per_message
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += tokens_per_name
+    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    return num_tokens
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    random.seed(0)
+    histories = build_histories(count)
+
+    def legacy():
+        for history in histories:
+            legacy_num_tokens_from_messages(history, MODEL)
+
+    def cached():
+        for history in histories:
+            num_tokens_from_messages(history, MODEL)
+
+    def batched():
+        count_message_tokens([message for history in histories for message in history], MODEL)
+
+    for name, func in [("legacy", legacy), ("cached", cached), ("batched", batched)]:
+        cost = min(timeit.repeat(func, number=5, repeat=3)) / 5
+        print("{:<10}{:>10.2f} ms / {} histories".format(name, cost * 1000, len(histories)))
+
+
+if __name__ == "__main__":
+    main()